@@ -6,13 +6,21 @@ from channels.security.websocket import AllowedHostsOriginValidator
 
 # Set environment variable before importing Django-based modules
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+# Sets Django up, so the chat modules below can import models when a server
+# such as daphne loads this module directly
+django_asgi_app = get_asgi_application()
 
 # Import after setting the environment variable
+from chat import lifecycle
 from chat.middleware import TokenAuthMiddlewareStack
 from chat.routing import websocket_urlpatterns
 
+# Send held notifications and write queued messages when the worker stops
+lifecycle.install_daphne_hook()
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
+    "lifespan": lifecycle.lifespan,
     "websocket": AllowedHostsOriginValidator(
         TokenAuthMiddlewareStack(
             URLRouter(
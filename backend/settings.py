@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -78,12 +79,185 @@ TEMPLATES = [
 
 ASGI_APPLICATION = 'backend.asgi.application'
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",  # Use Redis in production
-    },
+# CHAT_CHANNEL_SHARDS=redis://10.0.0.1:6379,redis://10.0.0.2:6379 selects
+# the multi-process deployment (see `manage.py runworkers`): the channel
+# layer spreads user groups over those Redis servers, presence is kept on the
+# first one and workers relay relationship changes to each other. Without
+# it the channel layer lives in memory and only one worker process may run.
+CHAT_CHANNEL_SHARDS = [url for url in os.environ.get("CHAT_CHANNEL_SHARDS", "").split(",") if url]
+
+if CHAT_CHANNEL_SHARDS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat.layers.ShardedPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": CHAT_CHANNEL_SHARDS,
+                "prefix": "chat",
+                "virtual_nodes": 160,  # ring points per server
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# Worker processes started by `manage.py runworkers`: one per
+# CONNECTIONS_PER_WORKER expected sockets, at most MAX_WORKERS (None: one
+# per CPU). Each worker's open file limit is raised to cover its share of
+# the sockets plus FD_HEADROOM.
+CHAT_WORKERS = {
+    "CONNECTIONS_PER_WORKER": 5000,
+    "MAX_WORKERS": None,
+    "FD_HEADROOM": 256,
+}
+
+# Chat user directory paging
+CHAT_DIRECTORY_PAGE_SIZE = 100
+CHAT_DIRECTORY_MAX_PAGE_SIZE = 500
+# Seconds a fetched directory page is reused for every requester
+CHAT_DIRECTORY_SHARE_WINDOW = 1.0
+
+# Cache of each user's sent/pending/mutual sets. The default backend is
+# per process. With several workers BROADCAST_CHANGES (on with
+# CHAT_CHANNEL_SHARDS) is required: workers relay changes to each other over
+# the channel layer, which keeps every worker's delta journal, and so its
+# delta clients, current. The system checks refuse a shared channel layer
+# without it. The cache may then also be shared, which saves each worker
+# loading the same users:
+#     "BACKEND": "chat.cache.RedisRelationshipCache",
+#     "LOCATION": "redis://127.0.0.1:6379/1",
+CHAT_RELATIONSHIP_CACHE = {
+    "BACKEND": "chat.cache.RelationshipCache",
+    "MAX_ENTRIES": 10000,  # cached users
+    "MAX_MEMBERS": 1000000,  # usernames held across all cached sets
+    "TTL": 300,  # seconds
+    "BROADCAST_CHANGES": bool(CHAT_CHANNEL_SHARDS),
+}
+
+# Verified WebSocket access tokens, so reconnects skip JWT and user lookups
+CHAT_TOKEN_CACHE = {
+    "MAX_ENTRIES": 10000,
+    "USER_TTL": 60,  # seconds before a cached user row is reloaded
+}
+
+# In-process username search (chat/search.py). The trigram index behind
+# FUZZY costs roughly ten set entries per user; turn it off for very large
+# directories.
+CHAT_SEARCH = {
+    "FUZZY": True,
+    "THRESHOLD": 0.3,  # trigram similarity a fuzzy match needs
+    "MAX_CANDIDATES": 2000,  # usernames scored per fuzzy search
+    "MAX_RESULTS": 50,
+    "REFRESH_INTERVAL": 300,  # seconds between rebuilds from the database
+}
+
+# Friends-of-friends suggestions, cached per user for TTL seconds. At most
+# MAX_FRIENDS connections are expanded and MAX_EDGES of theirs read.
+CHAT_SUGGESTIONS = {
+    "TTL": 60,
+    "MAX_ENTRIES": 10000,
+    "MAX_FRIENDS": 100,
+    "MAX_EDGES": 10000,
+}
+
+# In-process id <-> username map, loaded on first use in each process
+CHAT_USER_MAP = {
+    "WARM_LIMIT": 1_000_000,  # users loaded up front; later ones on demand
+}
+
+# Notifications to the same user within this many seconds go out as one frame
+CHAT_NOTIFICATION_COALESCE_WINDOW = 0.05
+CHAT_NOTIFICATION_MAX_BATCH = 100
+
+# Direct messages
+CHAT_MESSAGE_MAX_LENGTH = 4000
+CHAT_HISTORY_PAGE_SIZE = 50
+
+# Batched message persistence; see chat/writebehind.py
+CHAT_WRITE_BEHIND = {
+    "MAX_SIZE": 10000,  # queued rows before senders are pushed back
+    "BATCH_SIZE": 500,
+    "FLUSH_INTERVAL": 0.05,  # seconds
+    "PUT_TIMEOUT": 1.0,  # seconds a sender waits for room in a full queue
+    "MAX_RETRY_DELAY": 5.0,  # seconds between retries while the database is unavailable
+}
+# Seconds a stopping worker waits for queued rows to be written
+CHAT_SHUTDOWN_TIMEOUT = 10.0
+
+# Online/offline tracking. LOCATION is a Redis URL shared by all workers;
+# without one socket counts are per process.
+CHAT_PRESENCE = {
+    "TTL": 90,  # seconds without a ping before a socket stops counting
+    "DEBOUNCE": 5.0,  # seconds a user must stay offline before peers are told
+    "LOCATION": CHAT_CHANNEL_SHARDS[0] if CHAT_CHANNEL_SHARDS else None,
 }
 
+# JSON library for WebSocket frames: "auto" picks the fastest installed of
+# orjson and ujson, falling back to the standard library
+CHAT_JSON_CODEC = "auto"
+# Larger text frames (in characters) are refused before they are parsed
+CHAT_MAX_FRAME_SIZE = 65536
+
+# Compression of large outgoing frames, for clients that ask for it with
+# "compression": "deflate" in init_connection
+CHAT_COMPRESSION = {
+    "ENABLED": True,
+    "THRESHOLD": 4096,  # frames shorter than this are sent as they are
+    "LEVEL": 6,
+    "DICTIONARY_SIZE": 32768,  # bytes of usernames and field names
+    "DICTIONARY_TTL": 3600,  # seconds before new sockets get a rebuilt dictionary
+}
+
+# Token-bucket limits on WebSocket actions per socket and per user (in this
+# process), as (tokens per second, burst); None leaves a scope unlimited.
+# Actions not listed use DEFAULT.
+CHAT_RATE_LIMITS = {
+    "DEFAULT": {"SOCKET": (10, 30), "USER": (30, 90)},
+    "get_users": {"SOCKET": (2, 10), "USER": (5, 20)},
+    "get_directory": {"SOCKET": (5, 20), "USER": (10, 40)},
+    "send_message": {"SOCKET": (10, 30), "USER": (20, 60)},
+    "send_requests": {"SOCKET": (1, 5), "USER": (2, 10)},
+    "approve_requests": {"SOCKET": (1, 5), "USER": (2, 10)},
+    "reject_requests": {"SOCKET": (1, 5), "USER": (2, 10)},
+    "search_users": {"SOCKET": (5, 20), "USER": (10, 40)},
+    "get_suggestions": {"SOCKET": (1, 5), "USER": (2, 10)},
+}
+# Actions a socket may have waiting to be handled before it is throttled
+CHAT_INBOUND_QUEUE_SIZE = 32
+# Most users one bulk request action (or REST call) may name or act on
+CHAT_BULK_MAX_SIZE = 500
+
+# Thread pools for the consumers' database calls: reads in parallel, writes
+# on their own pool (a single thread on SQLite, whatever WRITE_WORKERS says).
+# With ENABLED off everything runs on asgiref's single shared sync thread.
+CHAT_DB_EXECUTORS = {
+    "ENABLED": True,
+    "READ_WORKERS": 8,
+    "WRITE_WORKERS": 1,
+}
+
+# PRAGMAs run on every new SQLite connection, in order. Overrides
+# chat.sqlite.DEFAULT_PRAGMAS as a whole; a database's own "PRAGMAS" entry
+# in DATABASES takes precedence.
+CHAT_SQLITE_PRAGMAS = {
+    "busy_timeout": 20000,
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -16384,
+    "temp_store": "MEMORY",
+}
+
+# Info logs for every WebSocket frame and connection; turn off under load
+CHAT_LOG_ACTIONS = DEBUG
+
+# Bearer token required by the Prometheus endpoint at /chat/metrics/. Unset,
+# the endpoint only answers staff sessions, or anyone with DEBUG on.
+CHAT_METRICS_TOKEN = None
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework_simplejwt.authentication.JWTAuthentication",
@@ -93,12 +267,50 @@ REST_FRAMEWORK = {
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# CHAT_DB_PROFILE=postgres selects PostgreSQL with a connection pool,
+# configured through the POSTGRES_* environment variables. The default is the
+# local SQLite file (or CHAT_SQLITE_PATH) in WAL mode, so reads no longer
+# wait for a writer.
+if os.environ.get("CHAT_DB_PROFILE") == "postgres":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("POSTGRES_DB", "chatapp"),
+            'USER': os.environ.get("POSTGRES_USER", "chatapp"),
+            'PASSWORD': os.environ.get("POSTGRES_PASSWORD", ""),
+            'HOST': os.environ.get("POSTGRES_HOST", "127.0.0.1"),
+            'PORT': os.environ.get("POSTGRES_PORT", "5432"),
+            # Django requires CONN_MAX_AGE = 0 with a pool; the pool keeps
+            # connections open and checks them instead
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': {
+                'pool': {
+                    # Enough for every database executor thread of a worker
+                    'min_size': 2,
+                    'max_size': int(os.environ.get("POSTGRES_POOL_SIZE", 16)),
+                    'timeout': 10,
+                },
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get("CHAT_SQLITE_PATH", BASE_DIR / 'db.sqlite3'),
+            # Executor threads keep their connection for the life of the
+            # process, checked before it is reused after an error
+            'CONN_MAX_AGE': None,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Take the write lock when a transaction starts instead of
+                # failing to upgrade a read lock half way through
+                'transaction_mode': 'IMMEDIATE',
+            },
+            # Journal mode, lock timeout etc. are set per connection from
+            # CHAT_SQLITE_PRAGMAS, see chat/sqlite.py
+        }
     }
-}
 
 
 # Password validation
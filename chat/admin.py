@@ -1,8 +1,15 @@
 from django.contrib import admin
-from .models import UserConnection
+from .models import Message, UserConnection
 
 @admin.register(UserConnection)
 class UserConnectionAdmin(admin.ModelAdmin):
     list_display = ('sender', 'receiver', 'status', 'created_at', 'updated_at')
     list_filter = ('status',)
     search_fields = ('sender__username', 'receiver__username')
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ('sender', 'recipient', 'created_at')
+    search_fields = ('sender__username', 'recipient__username')
+    raw_id_fields = ('sender', 'recipient')
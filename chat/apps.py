@@ -4,3 +4,22 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # Hook the relationship cache and cross-worker relay up to the journal,
+        # and the id <-> username map and search index up to user saves and
+        # deletes
+        from . import cache, invalidation, search, usernames  # noqa: F401
+        # System checks
+        from . import checks  # noqa: F401
+
+        # Time every database query for the metrics endpoint
+        from django.db.backends.signals import connection_created
+        from .metrics import install_query_timer
+
+        connection_created.connect(install_query_timer, dispatch_uid="chat_query_timer")
+
+        # WAL journaling and the other pragmas on every SQLite connection
+        from .sqlite import configure_connection
+
+        connection_created.connect(configure_connection, dispatch_uid="chat_sqlite_pragmas")
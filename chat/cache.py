@@ -0,0 +1,270 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from . import deltas
+
+RELATIONSHIP_LISTS = (deltas.SENT_REQUESTS, deltas.PENDING_REQUESTS, deltas.MUTUAL_CONNECTIONS)
+
+
+class RelationshipCache:
+    """
+    Per-process LRU cache of each user's sent, pending and mutual username
+    sets, keyed by user id.
+
+    Size is capped both by the number of cached users and by the total number
+    of usernames held across all sets, which is what actually costs memory.
+    Entries expire after `ttl` seconds as a safety net; writes keep them
+    current in between by applying the same ops the delta journal records.
+    """
+
+    def __init__(self, max_entries=10000, max_members=1_000_000, ttl=300):
+        self.max_entries = max_entries
+        self.max_members = max_members
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # user_id -> (expires_at, {list name: set of usernames})
+        self._members = 0
+        self._lock = threading.Lock()
+
+        # Write epochs guard against caching a snapshot that was read from the
+        # database while a write for the same user was being applied.
+        self._epoch = 0
+        self._touched = OrderedDict()  # user_id -> epoch of its latest write
+        self._touched_floor = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """Return a copy of the cached lists for `user_id`, or None."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(user_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return {name: sorted(members) for name, members in entry[1].items()}
+
+    def begin_load(self, user_id):
+        """Token to pass to `set` for a snapshot about to be read from the database."""
+        with self._lock:
+            return self._epoch
+
+    def set(self, user_id, snapshot, token):
+        """
+        Cache `snapshot` (list name -> usernames) for `user_id`, unless a write
+        touching that user happened after `token` was taken.
+        """
+        with self._lock:
+            if self._touched.get(user_id, self._touched_floor) > token:
+                return
+            self._remove(user_id)
+            sets = {name: set(snapshot.get(name, ())) for name in RELATIONSHIP_LISTS}
+            self._entries[user_id] = (time.monotonic() + self.ttl, sets)
+            self._members += sum(len(members) for members in sets.values())
+            self._evict()
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._touch(user_id)
+                self._remove(user_id)
+
+    def apply_changes(self, changes):
+        """Apply journal ops (user id -> ops) to the cached sets in place."""
+        with self._lock:
+            for user_id, ops in changes.items():
+                self._touch(user_id)
+                entry = self._entries.get(user_id)
+                if entry is None:
+                    continue
+                sets = entry[1]
+                for op in ops:
+                    username = op["username"]
+                    source = sets.get(op["from"]) if op["op"] == "move" else None
+                    target = sets.get(op["list"])
+                    if source is not None and username in source:
+                        source.remove(username)
+                        self._members -= 1
+                    if target is None:
+                        continue
+                    if op["op"] == "remove":
+                        if username in target:
+                            target.remove(username)
+                            self._members -= 1
+                    elif username not in target:
+                        target.add(username)
+                        self._members += 1
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._members = 0
+            self._epoch += 1
+            self._touched.clear()
+            self._touched_floor = self._epoch
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "members": self._members,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _touch(self, user_id):
+        self._epoch += 1
+        self._touched[user_id] = self._epoch
+        self._touched.move_to_end(user_id)
+        # Forget old writes; anything older than the floor counts as recent
+        while len(self._touched) > 4 * self.max_entries:
+            _, epoch = self._touched.popitem(last=False)
+            self._touched_floor = epoch
+
+    def _remove(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._members -= sum(len(members) for members in entry[1].values())
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._members > self.max_members):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+
+class RedisRelationshipCache:
+    """
+    Relationship cache shared by every worker process, kept in Redis (or any
+    server speaking its protocol) as one native set per user and list.
+
+    Reads and writes are pipelined: a lookup is one round trip for the three
+    sets and the "loaded" marker that tells an empty set from a missing one.
+    A per-user version counter plays the role of the local cache's write
+    epochs. Pass `client` to run against a stand-in such as fakeredis.
+    """
+
+    def __init__(self, client=None, location="redis://localhost:6379/0", prefix="chat:relationships", ttl=300):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(location)
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+        # Counters are per process; Redis itself handles eviction
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, user_id, name):
+        return f"{self.prefix}:{user_id}:{name}"
+
+    def get(self, user_id):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.exists(self._key(user_id, "loaded"))
+        for name in RELATIONSHIP_LISTS:
+            pipe.smembers(self._key(user_id, name))
+        loaded, *members = pipe.execute()
+
+        if not loaded:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {
+            name: sorted(_decode(member) for member in values)
+            for name, values in zip(RELATIONSHIP_LISTS, members)
+        }
+
+    def begin_load(self, user_id):
+        return int(self.client.get(self._key(user_id, "version")) or 0)
+
+    def set(self, user_id, snapshot, token):
+        pipe = self.client.pipeline()
+        pipe.delete(*(self._key(user_id, name) for name in RELATIONSHIP_LISTS))
+        for name in RELATIONSHIP_LISTS:
+            if snapshot.get(name):
+                pipe.sadd(self._key(user_id, name), *snapshot[name])
+                pipe.expire(self._key(user_id, name), self.ttl)
+        pipe.set(self._key(user_id, "loaded"), 1, ex=self.ttl)
+        pipe.get(self._key(user_id, "version"))
+        version = pipe.execute()[-1]
+
+        # A write slipped in while the snapshot was read; drop what we stored
+        if int(version or 0) != token:
+            self.client.delete(self._key(user_id, "loaded"))
+
+    def invalidate(self, *user_ids):
+        pipe = self.client.pipeline()
+        for user_id in user_ids:
+            self._bump_version(pipe, user_id)
+            pipe.delete(self._key(user_id, "loaded"), *(self._key(user_id, name) for name in RELATIONSHIP_LISTS))
+        pipe.execute()
+
+    def apply_changes(self, changes):
+        pipe = self.client.pipeline()
+        for user_id, ops in changes.items():
+            self._bump_version(pipe, user_id)
+            for op in ops:
+                if op["list"] not in RELATIONSHIP_LISTS:
+                    continue
+                target = self._key(user_id, op["list"])
+                if op["op"] == "move":
+                    pipe.srem(self._key(user_id, op["from"]), op["username"])
+                if op["op"] == "remove":
+                    pipe.srem(target, op["username"])
+                else:
+                    pipe.sadd(target, op["username"])
+                pipe.expire(target, self.ttl)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=f"{self.prefix}:*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _bump_version(self, pipe, user_id):
+        pipe.incr(self._key(user_id, "version"))
+        pipe.expire(self._key(user_id, "version"), 2 * self.ttl)
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _build_cache():
+    options = dict(getattr(settings, "CHAT_RELATIONSHIP_CACHE", {}))
+    backend = import_string(options.pop("BACKEND", "chat.cache.RelationshipCache"))
+    options.pop("BROADCAST_CHANGES", None)
+    return backend(**{key.lower(): value for key, value in options.items()})
+
+
+relationship_cache = _build_cache()
+# A shared backend already holds other workers' writes, so only changes made
+# in this process need applying to it
+deltas.journal.subscribe(
+    relationship_cache.apply_changes,
+    remote=isinstance(relationship_cache, RelationshipCache),
+)
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+
+@register()
+def check_broadcast_changes(app_configs, **kwargs):
+    """
+    A channel layer that reaches other processes means several workers,
+    and each one's delta journal only hears of the others' changes through
+    BROADCAST_CHANGES. Without it delta clients miss those changes, whatever
+    the cache backend.
+    """
+    backend = settings.CHANNEL_LAYERS.get("default", {}).get("BACKEND", "")
+    broadcast = getattr(settings, "CHAT_RELATIONSHIP_CACHE", {}).get("BROADCAST_CHANGES", False)
+    if backend.endswith("InMemoryChannelLayer") or broadcast:
+        return []
+    return [
+        Error(
+            "CHAT_RELATIONSHIP_CACHE['BROADCAST_CHANGES'] is off with a channel layer shared by several processes.",
+            hint="Turn BROADCAST_CHANGES on so every worker's journal records the others' changes.",
+            id="chat.E001",
+        )
+    ]
+
+
+@register(deploy=True)
+def check_metrics_token(app_configs, **kwargs):
+    """Without a token, scrapers cannot reach the metrics endpoint outside DEBUG."""
+    if settings.DEBUG or getattr(settings, "CHAT_METRICS_TOKEN", None):
+        return []
+    return [
+        Warning(
+            "CHAT_METRICS_TOKEN is not set, so /chat/metrics/ only answers staff sessions.",
+            hint="Set CHAT_METRICS_TOKEN and have the Prometheus scraper send it as a bearer token.",
+            id="chat.W001",
+        )
+    ]
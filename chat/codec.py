@@ -0,0 +1,86 @@
+import json
+import logging
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # MessagePack frames are optional
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# WebSocket subprotocol for clients that want MessagePack binary frames
+MSGPACK = "msgpack"
+
+# Fastest first; "json" (the standard library) is always available
+BACKENDS = ("orjson", "ujson", "json")
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _load(name):
+    """Return (loads, dumps) for a codec, with dumps producing str."""
+    if name == "orjson":
+        import orjson
+
+        return orjson.loads, lambda obj: orjson.dumps(obj).decode()
+    if name == "ujson":
+        import ujson
+
+        return ujson.loads, lambda obj: ujson.dumps(obj, ensure_ascii=False)
+    if name == "json":
+        return json.loads, lambda obj: json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    raise ValueError(f"Unknown JSON codec: {name}")
+
+
+def _build():
+    preferred = getattr(settings, "CHAT_JSON_CODEC", "auto")
+    candidates = BACKENDS if preferred == "auto" else (preferred, "json")
+    for name in candidates:
+        try:
+            return (name, *_load(name))
+        except ImportError:
+            if preferred != "auto":
+                logger.warning(f"JSON codec {name} is not installed, falling back to json")
+    raise ValueError(f"Unknown JSON codec: {preferred}")
+
+
+name, _loads, dumps = _build()
+
+
+def loads(data):
+    """Parse a frame, raising DecodeError whatever the codec's own error type."""
+    try:
+        return _loads(data)
+    except (ValueError, TypeError) as e:
+        raise DecodeError(str(e)) from e
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def packb(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpackb(data):
+    """Parse a MessagePack frame, raising DecodeError for malformed input."""
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except (ValueError, TypeError) as e:
+        raise DecodeError(str(e)) from e
+
+
+def encode_broadcast(content):
+    """
+    Encode a frame for every receiving socket at once: JSON text as
+    `frame` and, when MessagePack is available, binary as `packed`.
+    """
+    encoded = {"frame": dumps(content)}
+    if msgpack is not None:
+        encoded["packed"] = packb(content)
+    return encoded
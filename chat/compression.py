@@ -0,0 +1,91 @@
+import struct
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from . import metrics
+
+ALGORITHM = "deflate"
+# Compressed frames are binary: MAGIC, the dictionary id as a big-endian
+# uint32, then raw deflate data of the frame as it would otherwise be sent.
+# "Z" is a bare integer in MessagePack, so it never starts a normal frame.
+MAGIC = b"Z"
+HEADER = struct.Struct(">cI")
+
+# Text that recurs in every snapshot; deflate finds matches near the end of
+# the dictionary cheapest, so this goes last
+STRUCTURE = (
+    '"users_next_cursor":"sent_requests":[],"pending_requests":[],"mutual_connections":[],'
+    '{"type":"directory_page","cursor":"prefix":"next_cursor":null,'
+    '{"type":"update_users","revision":,"users":["'
+)
+
+
+class FrameCompressor:
+    """
+    Compresses outgoing frames of at least `threshold` bytes for sockets that
+    opted in, using a preset deflate dictionary shared by every connection.
+
+    The dictionary is built from the start of the user directory, which is
+    what every snapshot's first page contains, plus the snapshot field
+    names. It is rebuilt every `dictionary_ttl` seconds; each socket keeps
+    the dictionary it was given at init for the rest of its connection.
+    """
+
+    def __init__(self, threshold=4096, level=6, dictionary_size=32768, dictionary_ttl=3600):
+        self.threshold = threshold
+        self.level = level
+        self.dictionary_size = min(dictionary_size, 32768)  # deflate's window
+        self.dictionary_ttl = dictionary_ttl
+        self._dictionary = None  # (id, bytes, built at)
+        self._lock = threading.Lock()
+
+    def dictionary(self):
+        """Current (id, dictionary bytes); may query the database."""
+        with self._lock:
+            if self._dictionary is None or time.monotonic() - self._dictionary[2] > self.dictionary_ttl:
+                zdict = self._build_dictionary()
+                self._dictionary = (zlib.crc32(zdict), zdict, time.monotonic())
+            return self._dictionary[:2]
+
+    def _build_dictionary(self):
+        structure = STRUCTURE.encode()
+        budget = self.dictionary_size - len(structure)
+        names = []
+        for username in User.objects.order_by("username").values_list("username", flat=True).iterator():
+            entry = f'"{username}",'.encode()
+            if len(entry) > budget:
+                break
+            names.append(entry)
+            budget -= len(entry)
+        return b"".join(names) + structure
+
+    def compress(self, frame, dictionary):
+        """Return `frame` (str or bytes) as a compressed binary frame."""
+        dictionary_id, zdict = dictionary
+        data = frame.encode() if isinstance(frame, str) else frame
+
+        started = time.thread_time()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=zdict)
+        compressed = compressor.compress(data) + compressor.flush()
+        metrics.compression_seconds.observe(time.thread_time() - started)
+        metrics.compression_ratio.observe(len(compressed) / len(data))
+        return HEADER.pack(MAGIC, dictionary_id) + compressed
+
+
+def decompress(frame, zdict):
+    """Inverse of FrameCompressor.compress, for clients and tools."""
+    decompressor = zlib.decompressobj(-15, zdict=zdict)
+    return decompressor.decompress(frame[HEADER.size:]) + decompressor.flush()
+
+
+_options = getattr(settings, "CHAT_COMPRESSION", {})
+compressor = FrameCompressor(
+    threshold=_options.get("THRESHOLD", 4096),
+    level=_options.get("LEVEL", 6),
+    dictionary_size=_options.get("DICTIONARY_SIZE", 32768),
+    dictionary_ttl=_options.get("DICTIONARY_TTL", 3600),
+) if _options.get("ENABLED", True) else None
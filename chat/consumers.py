@@ -1,18 +1,69 @@
-import json
+import asyncio
+import base64
+import functools
+import time
+from collections import deque
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import UserConnection
+from django.conf import settings
+from .models import Message
+from . import codec, compression, deltas, invalidation, metrics, notifications, search
+from .dispatch import ActionRegistry, ValidationError, optional, required
+from .executors import database_read, database_write
+from .presence import presence
+from .ratelimit import rate_limiter
+from .singleflight import SingleFlight
+from .usernames import user_map
+from .writebehind import write_queue
+from . import services
 from channels.layers import get_channel_layer
 import logging
 
 logger = logging.getLogger(__name__)
 
+# WebSocket actions understood by ChatConsumer and their payload fields
+actions = ActionRegistry()
+
+USERNAME = 150  # max_length of User.username
+# Fields naming a user take a username or, from id-mode clients, a user id
+USER = (str, int)
+BULK = services.get_bulk_max_size()
+
+# List fields of user-list frames that hold usernames
+USER_LISTS = (deltas.USERS, deltas.SENT_REQUESTS, deltas.PENDING_REQUESTS, deltas.MUTUAL_CONNECTIONS)
+# Fields holding a username in frames other sockets encoded for broadcast
+BROADCAST_USER_FIELDS = {"message": ("sender", "recipient"), "presence_update": ("username",)}
+
+# Work that is answered by its latest run, so an identical request still
+# waiting in a socket's inbox makes a new one redundant
+MERGEABLE = frozenset({"get_users", "get_directory", "refresh_user_lists"})
+
+# Sockets of the same user (several tabs) asking for the same lists at once,
+# typically right after a notification, share one fetch
+user_list_flights = SingleFlight("user_lists")
+
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         # Store the channel name associated with this user
         self.user_group_name = f"user_{self.user.id}"
+        # Last user-list revision sent to this socket. None means the client
+        # never asked for deltas and gets full `update_users` snapshots.
+        self.revision = None
+        # Clients offering the msgpack subprotocol get binary MessagePack
+        # frames; everyone else gets JSON text
+        self.binary = codec.MSGPACK in self.scope.get("subprotocols", []) and codec.msgpack_available()
+        # (id, dictionary) once the client asked for compressed frames
+        self.compression = None
+        # Id mode: user ids in place of usernames in every frame sent
+        self.user_ids = False
+        # Actions wait here to be handled one at a time, in order, by
+        # process_inbox; `queued` holds the merge keys of those waiting
+        self.inbox = deque()
+        self.inbox_ready = asyncio.Event()
+        self.queued = set()
+        self.rate_buckets = rate_limiter.socket_buckets()
         
         # Join user-specific group
         await self.channel_layer.group_add(
@@ -20,147 +71,363 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
-        logger.info(f"WebSocket connected for user: {self.user}, channel: {self.channel_name}")
+        await invalidation.ensure_listener(self.channel_layer)
+
+        await self.accept(subprotocol=codec.MSGPACK if self.binary else None)
+        self.inbox_worker = asyncio.ensure_future(self.process_inbox())
+        metrics.active_sockets.inc()
+        if self.user.is_authenticated:
+            await presence.connect(self.user, self.channel_name, self.channel_layer)
+        if metrics.log_actions():
+            logger.info(f"WebSocket connected for user: {self.user}, channel: {self.channel_name}")
 
     async def disconnect(self, close_code):
+        if getattr(self, "inbox_worker", None) is not None:
+            self.inbox_worker.cancel()
         # Leave user-specific group
         if hasattr(self, 'user_group_name'):
             await self.channel_layer.group_discard(
                 self.user_group_name,
                 self.channel_name
             )
-        logger.info(f"WebSocket disconnected for user: {self.user}, code: {close_code}")
+            metrics.active_sockets.dec()
+        if self.user.is_authenticated:
+            await presence.disconnect(self.user, self.channel_name, self.channel_layer)
+        if metrics.log_actions():
+            logger.info(f"WebSocket disconnected for user: {self.user}, code: {close_code}")
 
-    async def receive(self, text_data):
-        try:
-            data = json.loads(text_data)
-            action = data.get("action", "")
+    async def dispatch(self, message):
+        # Channels closes stale database connections before every handler,
+        # on the shared sync thread, which makes each frame and event wait
+        # behind whatever query is running. Every database call here goes
+        # through database_read or database_write, which do that cleanup.
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None:
+            raise ValueError(f"No handler for message type {message['type']}")
+        await handler(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        received = time.perf_counter()
+        data = await self.decode_frame(text_data, bytes_data)
+        if data is None:
+            return
+
+        action = data.get("action", "")
+        if metrics.log_actions():
             logger.info(f"Received action: {action} from user: {self.user}")
+        if not isinstance(action, str) or action not in actions:
+            # Unknown actions, such as the client's "disconnect", are ignored
+            return
 
-            if action == "init_connection":
-                await self.handle_init_connection()
-            elif action == "get_users":
-                await self.get_users()
-            elif action == "send_request":
-                receiver = data.get("receiver")
-                if receiver:
-                    await self.send_connection_request(receiver)
-            elif action == "approve_request":
-                sender = data.get("sender")
-                if sender:
-                    await self.approve_connection_request(sender)
-            elif action == "reject_request":
-                sender = data.get("sender")
-                if sender:
-                    await self.reject_connection_request(sender)
-            elif action == "ping":
-                await self.send_json({"type": "pong"})
-        except Exception as e:
-            logger.error(f"Error processing message: {e}")
-            await self.send_json({"type": "error", "message": str(e)})
+        token = metrics.current_action.set(action)
+        try:
+            limited = rate_limiter.check(self.user.id, self.rate_buckets, action)
+            if limited is not None:
+                scope, retry_after = limited
+                metrics.throttled.inc(action, scope.lower())
+                await self.send_throttled(action, f"Too many {action} requests", retry_after)
+                return
+
+            try:
+                handler, arguments = actions.resolve(self, action, data)
+            except ValidationError as e:
+                await self.send_json({"type": "error", "message": str(e)})
+                return
+            if not self.enqueue(action, handler, arguments, received):
+                metrics.throttled.inc(action, "inbox")
+                await self.send_throttled(action, "Too many requests in progress")
+        finally:
+            metrics.current_action.reset(token)
+
+    async def decode_frame(self, text_data, bytes_data):
+        """Parse a frame into a dict, or send an error frame and return None."""
+        # Refuse what cannot be a valid action before spending any work on it
+        if text_data is not None:
+            frame, decode = text_data, codec.loads
+        elif self.binary:
+            frame, decode = bytes_data, codec.unpackb
+        else:
+            await self.send_json({"type": "error", "message": "Binary frames are not supported"})
+            return None
+        if len(frame) > getattr(settings, "CHAT_MAX_FRAME_SIZE", 65536):
+            await self.send_json({"type": "error", "message": "Frame too large"})
+            return None
+
+        try:
+            data = decode(frame)
+        except codec.DecodeError:
+            data = None
+        if not isinstance(data, dict):
+            await self.send_json({"type": "error", "message": "Malformed frame"})
+            return None
+        return data
+
+    def enqueue(self, action, handler, arguments, received, internal=False):
+        """
+        Queue an action for process_inbox. Returns False when the inbox is
+        full; work the server queues itself (`internal`) is never refused.
+        """
+        key = (action, tuple(sorted(arguments.items()))) if action in MERGEABLE else None
+        if key is not None and key in self.queued:
+            metrics.merged.inc(action)
+            return True
+        if not internal and len(self.inbox) >= getattr(settings, "CHAT_INBOUND_QUEUE_SIZE", 32):
+            return False
+
+        self.inbox.append((action, handler, arguments, received, key))
+        if key is not None:
+            self.queued.add(key)
+        self.inbox_ready.set()
+        return True
+
+    async def process_inbox(self):
+        while True:
+            if not self.inbox:
+                self.inbox_ready.clear()
+                await self.inbox_ready.wait()
+                continue
+            action, handler, arguments, received, key = self.inbox.popleft()
+            self.queued.discard(key)
 
-    async def handle_init_connection(self):
-        logger.info(f"Initializing connection for user: {self.user}")
+            token = metrics.current_action.set(action)
+            try:
+                await handler(**arguments)
+            except Exception as e:
+                logger.error(f"Error processing message: {e}")
+                await self.send_json({"type": "error", "message": str(e)})
+            finally:
+                # From receipt, so time spent waiting in the inbox counts
+                metrics.action_seconds.observe(time.perf_counter() - received, action)
+                metrics.current_action.reset(token)
+
+    async def send_throttled(self, action, message, retry_after=None):
+        frame = {"type": "error", "code": "throttled", "action": action, "message": message}
+        if retry_after is not None:
+            frame["retry_after"] = round(retry_after, 3)
+        await self.send_json(frame)
+
+    @actions.register("ping")
+    async def handle_ping(self):
+        # Pings double as presence heartbeats
+        if self.user.is_authenticated:
+            await presence.heartbeat(self.user, self.channel_name, self.channel_layer)
+        await self.send_json({"type": "pong"})
+
+    @actions.register(
+        "init_connection",
+        revision=optional(int),
+        journal=optional(str, max_length=32),
+        compression=optional(str, max_length=16),
+        user_ids=optional(bool),
+    )
+    async def handle_init_connection(self, **data):
+        if metrics.log_actions():
+            logger.info(f"Initializing connection for user: {self.user}")
+        self.user_ids = data.get("user_ids") is True
+        if data.get("compression") == compression.ALGORITHM and compression.compressor is not None:
+            await self.enable_compression()
+        online = await presence.online_connections(self.user)
+        if self.user_ids:
+            ids = await self.ids_for(online)
+            online = [ids[username] for username in online if username in ids]
+        await self.send_json({
+            "type": "presence",
+            "online": online,
+        })
+        if "revision" not in data:
+            await self.get_users()
+            return
+
+        # The client speaks the delta protocol; resume from its last revision
+        # when it came from this worker's journal and the journal still covers
+        # it, otherwise start from a snapshot. Behind a shared socket a client
+        # may reconnect to another worker, whose revisions are unrelated.
+        revision = data.get("revision")
+        if isinstance(revision, int) and not isinstance(revision, bool) and data.get("journal") == deltas.journal.id:
+            self.revision = revision
+            if await self.send_users_delta():
+                return
+        self.revision = deltas.journal.current()
         await self.get_users()
 
-    async def get_users(self):
-        users = await self.get_all_users()
-        sent_requests = await self.get_sent_requests()
-        pending_requests = await self.get_pending_requests()
-        mutual_connections = await self.get_mutual_connections()
+    async def enable_compression(self):
+        # Frames from here on may be compressed, so the client needs the
+        # dictionary first
+        dictionary_id, zdict = await database_read(compression.compressor.dictionary)()
+        await self.send_json({
+            "type": "compression",
+            "algorithm": compression.ALGORITHM,
+            "dictionary_id": dictionary_id,
+            "dictionary": base64.b64encode(zdict).decode(),
+            "threshold": compression.compressor.threshold,
+        })
+        self.compression = (dictionary_id, zdict)
 
-        logger.info(f"Sending user lists to {self.user}. " +
-                   f"Users: {len(users)}, " +
-                   f"Sent: {len(sent_requests)}, " +
-                   f"Pending: {len(pending_requests)}, " + 
-                   f"Mutual: {len(mutual_connections)}")
+    async def send_users_delta(self):
+        """
+        Send every user-list change since `self.revision` (of this worker's
+        journal) as one `users_delta` frame. Returns False when the journal
+        no longer covers that range and a full snapshot has to be sent
+        instead.
+        """
+        changes = deltas.journal.since(self.user.id, self.revision, deltas.journal.id)
+        if changes is None:
+            return False
+
+        ops, revision = changes
+        if ops and self.user_ids:
+            ids = await self.ids_for(op["username"] for op in ops)
+            ops = [{**op, "username": ids[op["username"]]} for op in ops if op["username"] in ids]
+        if ops:
+            await self.send_json({
+                "type": "users_delta",
+                "from_revision": self.revision,
+                "revision": revision,
+                "journal": deltas.journal.id,
+                "ops": ops,
+            })
+        self.revision = revision
+        return True
+
+    async def refresh_user_lists(self):
+        # Delta clients get only what changed; fall back to a snapshot otherwise
+        if self.revision is None or not await self.send_users_delta():
+            await self.get_users()
+
+    @actions.register(
+        "get_users",
+        cursor=optional(str, max_length=USERNAME),
+        prefix=optional(str, max_length=USERNAME),
+        page_size=optional(int),
+    )
+    async def get_users(self, cursor=None, prefix=None, page_size=None):
+        # Read the revision before the lists so that nothing recorded while
+        # they are fetched can be missed; replaying it later is harmless.
+        revision = deltas.journal.current()
+        # Keyed by revision as well, so nobody joins a fetch that started
+        # before a change they need to see
+        user_lists = await user_list_flights.do(
+            (self.user.id, cursor, prefix, page_size, self.user_ids, revision),
+            self.get_user_lists, cursor, prefix, page_size,
+        )
+
+        if metrics.log_actions():
+            logger.info(f"Sending user lists to {self.user}. " +
+                       f"Users: {len(user_lists['users'])}, " +
+                       f"Sent: {len(user_lists['sent_requests'])}, " +
+                       f"Pending: {len(user_lists['pending_requests'])}, " + 
+                       f"Mutual: {len(user_lists['mutual_connections'])}")
+
+        if self.revision is not None:
+            self.revision = revision
 
         await self.send_json({
             "type": "update_users",
-            "users": users,
-            "sent_requests": sent_requests,
-            "pending_requests": pending_requests,
-            "mutual_connections": mutual_connections,
+            "revision": revision,
+            "journal": deltas.journal.id,
+            **user_lists,
+        })
+
+    @database_read
+    def get_user_lists(self, cursor=None, prefix=None, page_size=None):
+        # Directory page and relationship lists in one thread-pool hop
+        user_lists = services.get_user_lists(self.user, cursor=cursor, prefix=prefix, page_size=page_size)
+        if self.user_ids:
+            user_lists = services.replace_usernames(user_lists, USER_LISTS)
+        return user_lists
+
+    @actions.register(
+        "get_directory",
+        cursor=optional(str, max_length=USERNAME),
+        prefix=optional(str, max_length=USERNAME),
+        page_size=optional(int),
+    )
+    async def send_directory_page(self, cursor=None, prefix=None, page_size=None):
+        # Stream further directory pages without resending the request lists
+        page = await self.get_all_users(cursor, prefix, page_size)
+        await self.send_json({
+            "type": "directory_page",
+            "cursor": cursor,
+            "prefix": prefix,
+            "users": page["users"],
+            "next_cursor": page["next_cursor"],
         })
 
-    @database_sync_to_async
-    def get_all_users(self):
-        # Get all users except the current user
-        return list(User.objects.exclude(username=self.user.username).values_list("username", flat=True))
-
-    @database_sync_to_async
-    def get_sent_requests(self):
-        # Get all pending requests sent by the current user
-        return list(UserConnection.objects.filter(
-            sender=self.user, 
-            status="pending"
-        ).values_list("receiver__username", flat=True))
-
-    @database_sync_to_async
-    def get_pending_requests(self):
-        # Get all pending requests received by the current user
-        return list(UserConnection.objects.filter(
-            receiver=self.user, 
-            status="pending"
-        ).values_list("sender__username", flat=True))
-
-    @database_sync_to_async
-    def get_mutual_connections(self):
-        # Get all approved connections
-        return list(UserConnection.objects.filter(
-            status="approved"
-        ).filter(
-            sender=self.user
-        ).values_list("receiver__username", flat=True)) + list(UserConnection.objects.filter(
-            status="approved"
-        ).filter(
-            receiver=self.user
-        ).values_list("sender__username", flat=True))
+    @database_read
+    def get_all_users(self, cursor=None, prefix=None, page_size=None):
+        # Get one page of users, excluding the current user
+        page = services.get_directory_page(self.user, cursor=cursor, prefix=prefix, page_size=page_size)
+        if self.user_ids:
+            page = services.replace_usernames(page, (deltas.USERS,))
+        return page
+
+    @actions.register(
+        "search_users",
+        query=required(str, max_length=USERNAME),
+        limit=optional(int),
+        fuzzy=optional(bool),
+    )
+    async def search_users(self, query, limit=None, fuzzy=True):
+        if not query:
+            raise Exception("query must not be empty")
+        users = await self._search_users(query, limit, fuzzy)
+        await self.send_json({"type": "search_results", "query": query, "users": users})
 
+    @database_read
+    def _search_users(self, query, limit, fuzzy):
+        # In memory, but the first search in a process builds the index
+        users = search.search_index.search(
+            query, search.get_limit(limit), fuzzy=fuzzy, exclude=self.user.username
+        )
+        if self.user_ids:
+            users = services.replace_usernames({"users": users}, ("users",))["users"]
+        return users
+
+    @actions.register("get_suggestions", limit=optional(int))
+    async def send_suggestions(self, limit=None):
+        suggestions = await self._get_suggestions(limit)
+        await self.send_json({"type": "suggestions", "users": suggestions})
+
+    @database_read
+    def _get_suggestions(self, limit):
+        suggestions = search.get_suggestions(self.user, search.get_limit(limit))
+        if self.user_ids:
+            ids = user_map.ids_for(suggestion["username"] for suggestion in suggestions)
+            suggestions = [
+                {**suggestion, "username": ids[suggestion["username"]]}
+                for suggestion in suggestions if suggestion["username"] in ids
+            ]
+        return suggestions
+
+    @actions.register("send_request", receiver=required(USER, max_length=USERNAME, argument="receiver_username"))
     async def send_connection_request(self, receiver_username):
         try:
-            success, receiver_id = await self._create_connection_request(receiver_username)
-            if success:
+            receiver_id = await self._create_connection_request(receiver_username)
+            if receiver_id:
                 # Update the sender's user lists
-                await self.get_users()
+                await self.refresh_user_lists()
                 
                 # Notify the receiver of the new request
-                if receiver_id:
-                    await self.channel_layer.group_send(
-                        f"user_{receiver_id}",
-                        {
-                            "type": "connection_notification",
-                            "message": f"New connection request from {self.user.username}"
-                        }
-                    )
+                await notifications.coalescer.publish(
+                    self.channel_layer,
+                    f"user_{receiver_id}",
+                    {"message": f"New connection request from {self.user.username}"}
+                )
             
         except Exception as e:
             logger.error(f"Error in send_connection_request: {e}")
             await self.send_json({"type": "error", "message": str(e)})
 
-    @database_sync_to_async
+    @database_write
     def _create_connection_request(self, receiver_username):
         try:
-            receiver = User.objects.get(username=receiver_username)
-            # Check if a connection request already exists
-            existing = UserConnection.objects.filter(
-                sender=self.user, 
-                receiver=receiver
-            ).exists()
-            
-            if existing:
+            # One INSERT that is a no-op if the request already exists
+            receiver_id = services.send_connection_request(self.user, receiver_username)
+            if receiver_id is None:
                 logger.warning(f"Request already exists from {self.user} to {receiver_username}")
-                return False, None
-
-            # Create a new connection request
-            UserConnection.objects.create(
-                sender=self.user,
-                receiver=receiver,
-                status="pending"
-            )
+                return None
             logger.info(f"Connection request created: {self.user} -> {receiver_username}")
-            return True, receiver.id
+            return receiver_id
             
         except User.DoesNotExist:
             logger.error(f"User not found: {receiver_username}")
@@ -169,99 +436,344 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error creating connection request: {e}")
             raise
 
+    @actions.register("approve_request", sender=required(USER, max_length=USERNAME, argument="sender_username"))
     async def approve_connection_request(self, sender_username):
         try:
-            success, sender_id = await self._approve_connection(sender_username)
-            if success:
-                # Update the receiver's user lists
-                await self.get_users()
-                
-                # Notify the original sender that their request was approved
-                if sender_id:
-                    await self.channel_layer.group_send(
-                        f"user_{sender_id}",
-                        {
-                            "type": "connection_notification",
-                            "message": f"{self.user.username} accepted your connection request"
-                        }
-                    )
+            sender_id = await self._approve_connection(sender_username)
+            # Update the receiver's user lists
+            await self.refresh_user_lists()
+            
+            # Notify the original sender that their request was approved
+            await notifications.coalescer.publish(
+                self.channel_layer,
+                f"user_{sender_id}",
+                {"message": f"{self.user.username} accepted your connection request"}
+            )
         except Exception as e:
             logger.error(f"Error in approve_connection_request: {e}")
             await self.send_json({"type": "error", "message": str(e)})
     
-    @database_sync_to_async
+    @database_write
     def _approve_connection(self, sender_username):
         try:
-            sender = User.objects.get(username=sender_username)
-            connection = UserConnection.objects.get(
-                sender=sender,
-                receiver=self.user,
-                status="pending"
-            )
-            connection.status = "approved"
-            connection.save()
-            logger.info(f"Connection request approved: {sender_username} -> {self.user}")
-            return True, sender.id
+            # One UPDATE conditional on the request still being pending
+            sender_id = services.approve_connection_request(self.user, sender_username)
         except User.DoesNotExist:
             logger.error(f"User not found: {sender_username}")
             raise Exception(f"User {sender_username} not found")
-        except UserConnection.DoesNotExist:
-            logger.error(f"Connection request not found from {sender_username} to {self.user}")
-            raise Exception("Connection request not found")
         except Exception as e:
             logger.error(f"Error approving connection: {e}")
             raise
+        if sender_id is None:
+            logger.error(f"Connection request not found from {sender_username} to {self.user}")
+            raise Exception("Connection request not found")
+        logger.info(f"Connection request approved: {sender_username} -> {self.user}")
+        return sender_id
 
+    @actions.register("reject_request", sender=required(USER, max_length=USERNAME, argument="sender_username"))
     async def reject_connection_request(self, sender_username):
         try:
-            success, sender_id = await self._reject_connection(sender_username)
-            if success:
-                # Update the receiver's user lists
-                await self.get_users()
-                
-                # Optionally notify the sender that their request was rejected
-                if sender_id:
-                    await self.channel_layer.group_send(
-                        f"user_{sender_id}",
-                        {
-                            "type": "connection_notification",
-                            "message": f"{self.user.username} rejected your connection request"
-                        }
-                    )
+            sender_id = await self._reject_connection(sender_username)
+            # Update the receiver's user lists
+            await self.refresh_user_lists()
+            
+            # Optionally notify the sender that their request was rejected
+            await notifications.coalescer.publish(
+                self.channel_layer,
+                f"user_{sender_id}",
+                {"message": f"{self.user.username} rejected your connection request"}
+            )
         except Exception as e:
             logger.error(f"Error in reject_connection_request: {e}")
             await self.send_json({"type": "error", "message": str(e)})
     
-    @database_sync_to_async
+    @database_write
     def _reject_connection(self, sender_username):
         try:
-            sender = User.objects.get(username=sender_username)
-            connection = UserConnection.objects.get(
-                sender=sender,
-                receiver=self.user,
-                status="pending"
-            )
-            connection.delete()
-            logger.info(f"Connection request rejected: {sender_username} -> {self.user}")
-            return True, sender.id
+            # One DELETE conditional on the request still being pending
+            sender_id = services.reject_connection_request(self.user, sender_username)
         except User.DoesNotExist:
             logger.error(f"User not found: {sender_username}")
             raise Exception(f"User {sender_username} not found")
-        except UserConnection.DoesNotExist:
-            logger.error(f"Connection request not found from {sender_username} to {self.user}")
-            raise Exception("Connection request not found")
         except Exception as e:
             logger.error(f"Error rejecting connection: {e}")
             raise
+        if sender_id is None:
+            logger.error(f"Connection request not found from {sender_username} to {self.user}")
+            raise Exception("Connection request not found")
+        logger.info(f"Connection request rejected: {sender_username} -> {self.user}")
+        return sender_id
 
-    # Handler for receiving connection notifications
-    async def connection_notification(self, event):
-        # Send the notification message to the WebSocket
+    @actions.register(
+        "send_requests",
+        receivers=required(list, items=USER, max_length=BULK, argument="receiver_usernames"),
+    )
+    async def send_connection_requests(self, receiver_usernames):
+        try:
+            receivers, skipped = await self._create_connection_requests(receiver_usernames)
+            await self.finish_bulk(
+                "send_requests", receivers, skipped,
+                f"New connection request from {self.user.username}",
+            )
+        except Exception as e:
+            logger.error(f"Error in send_connection_requests: {e}")
+            await self.send_json({"type": "error", "message": str(e)})
+
+    @database_write
+    def _create_connection_requests(self, receiver_usernames):
+        # One SELECT and one multi-row INSERT in a transaction
+        receivers, skipped = services.send_connection_requests(self.user, receiver_usernames)
+        logger.info(f"Connection requests created: {self.user} -> {len(receivers)} users")
+        return receivers, skipped
+
+    @actions.register(
+        "approve_requests",
+        senders=optional(list, items=USER, max_length=BULK, argument="sender_usernames"),
+        all=optional(bool, argument="all_pending"),
+    )
+    async def approve_connection_requests(self, sender_usernames=None, all_pending=False):
+        try:
+            if sender_usernames is None and not all_pending:
+                raise Exception("senders or all is required")
+            senders, skipped = await self._approve_connections(None if all_pending else sender_usernames)
+            await self.finish_bulk(
+                "approve_requests", senders, skipped,
+                f"{self.user.username} accepted your connection request",
+            )
+        except Exception as e:
+            logger.error(f"Error in approve_connection_requests: {e}")
+            await self.send_json({"type": "error", "message": str(e)})
+
+    @database_write
+    def _approve_connections(self, sender_usernames):
+        # One SELECT and one UPDATE in a transaction
+        senders, skipped = services.approve_connection_requests(self.user, sender_usernames)
+        logger.info(f"Connection requests approved: {len(senders)} users -> {self.user}")
+        return senders, skipped
+
+    @actions.register(
+        "reject_requests",
+        senders=optional(list, items=USER, max_length=BULK, argument="sender_usernames"),
+        all=optional(bool, argument="all_pending"),
+    )
+    async def reject_connection_requests(self, sender_usernames=None, all_pending=False):
+        try:
+            if sender_usernames is None and not all_pending:
+                raise Exception("senders or all is required")
+            senders, skipped = await self._reject_connections(None if all_pending else sender_usernames)
+            await self.finish_bulk(
+                "reject_requests", senders, skipped,
+                f"{self.user.username} rejected your connection request",
+            )
+        except Exception as e:
+            logger.error(f"Error in reject_connection_requests: {e}")
+            await self.send_json({"type": "error", "message": str(e)})
+
+    @database_write
+    def _reject_connections(self, sender_usernames):
+        # One SELECT and one DELETE in a transaction
+        senders, skipped = services.reject_connection_requests(self.user, sender_usernames)
+        logger.info(f"Connection requests rejected: {len(senders)} users -> {self.user}")
+        return senders, skipped
+
+    async def finish_bulk(self, action, peers, skipped, message):
+        # One refreshed state and one batch of notifications for the whole
+        # batch, instead of one of each per user
+        if peers:
+            await self.refresh_user_lists()
         await self.send_json({
-            "type": "notification",
-            "message": event["message"],
-            "action": "refresh_users"
+            "type": "bulk_result",
+            "action": action,
+            "count": len(peers),
+            "skipped": skipped,
+        })
+        if peers:
+            await notifications.coalescer.publish_many(
+                self.channel_layer,
+                [f"user_{peer.id}" for peer in peers],
+                {"message": message},
+            )
+
+    @actions.register(
+        "send_message",
+        receiver=required(USER, max_length=USERNAME, argument="receiver_username"),
+        body=required(str),
+        client_id=optional((str, int), max_length=64),
+    )
+    async def send_chat_message(self, receiver_username, body, client_id=None):
+        try:
+            message, receiver = await self._build_message(receiver_username, body)
+            # Persisted in batches by the write-behind queue; delivery and the
+            # ack do not wait for the database
+            await write_queue.submit(message, functools.partial(self.report_unsaved_message, client_id))
+
+            usernames = {self.user.id: self.user.username, receiver.id: receiver.username}
+            serialized = services.serialize_message(message, usernames)
+            # Encoded once here rather than by every socket that receives it
+            event = {"type": "chat_message", **codec.encode_broadcast({"type": "message", **serialized})}
+            # Deliver to the receiver and to the sender's other open tabs
+            await metrics.group_send(self.channel_layer, f"user_{receiver.id}", event)
+            await metrics.group_send(self.channel_layer, self.user_group_name, event)
+            if client_id is not None:
+                await self.send_json({
+                    "type": "message_ack",
+                    "client_id": client_id,
+                    "created_at": serialized["created_at"],
+                })
+        except Exception as e:
+            logger.error(f"Error in send_chat_message: {e}")
+            await self.send_json({"type": "error", "message": str(e)})
+
+    async def report_unsaved_message(self, client_id, error):
+        # Called from the write-behind worker once the database refused the
+        # message. Routed through the channel layer so the frame goes out from
+        # this socket's own task, and is dropped if the socket has closed.
+        await self.channel_layer.send(self.channel_name, {"type": "message_failed", "client_id": client_id})
+
+    @database_read
+    def _build_message(self, receiver_username, body):
+        max_length = getattr(settings, "CHAT_MESSAGE_MAX_LENGTH", 4000)
+        if not body or len(body) > max_length:
+            raise Exception(f"Message must be between 1 and {max_length} characters")
+
+        try:
+            receiver = services.resolve_user(receiver_username)
+        except User.DoesNotExist:
+            receiver = None
+
+        # Only mutual connections may message each other
+        mutual = services.get_relationship_snapshot(self.user)["mutual_connections"]
+        if receiver is None or receiver.username not in mutual:
+            raise Exception(f"{receiver_username} is not one of your connections")
+
+        message = Message(
+            conversation=Message.conversation_key(self.user.id, receiver.id),
+            sender=self.user,
+            recipient=receiver,
+            body=body,
+        )
+        return message, receiver
+
+    @actions.register(
+        "get_history",
+        **{"with": required(USER, max_length=USERNAME, argument="peer_username")},
+        before=optional(str, max_length=64),
+    )
+    async def send_history(self, peer_username, before=None):
+        try:
+            # Make messages accepted so far visible to the history query
+            await write_queue.sync()
+            history = await self._get_history(peer_username, before)
+            await self.send_json({
+                "type": "history",
+                "with": peer_username,
+                "before": before,
+                **history,
+            })
+        except Exception as e:
+            logger.error(f"Error in send_history: {e}")
+            await self.send_json({"type": "error", "message": str(e)})
+
+    @database_read
+    def _get_history(self, peer_username, before=None):
+        try:
+            peer = services.resolve_user(peer_username)
+        except User.DoesNotExist:
+            logger.error(f"User not found: {peer_username}")
+            raise Exception(f"User {peer_username} not found")
+        return services.get_message_history(self.user, peer, before, user_ids=self.user_ids)
+
+    async def ids_for(self, usernames):
+        """
+        {username: id} for id-mode frames. Usernames are nearly always in the
+        user map already; only a miss costs a database hop.
+        """
+        usernames = set(usernames)
+        ids = user_map.ids_for(usernames, query=False)
+        if len(ids) < len(usernames):
+            ids = await database_read(user_map.ids_for)(usernames)
+        return ids
+
+    # Handler for delivering chat messages to this socket
+    async def chat_message(self, event):
+        await self.send_broadcast(event, "message")
+
+    # Handler for messages the write-behind queue could not store
+    async def message_failed(self, event):
+        await self.send_json({
+            "type": "error",
+            "code": "message_not_saved",
+            "client_id": event["client_id"],
+            "message": "Message could not be saved",
         })
 
+    # Handler for online/offline changes of this user's mutual connections
+    async def presence_update(self, event):
+        await self.send_broadcast(event, "presence_update")
+
+    # Handler for receiving connection notifications. A burst of
+    # notifications arrives as one event with a list of `events`.
+    async def connection_notification(self, event):
+        messages = [e["message"] for e in event.get("events", [event])]
+        notification = {
+            "type": "notification",
+            "message": messages[-1],
+            "messages": messages,
+        }
+
+        if self.revision is None:
+            # Send the notification message to the WebSocket
+            await self.send_json({**notification, "action": "refresh_users"})
+            return
+
+        # Delta clients are told what changed instead of being asked to
+        # refetch. The refresh goes through the inbox so it never runs
+        # alongside an action that is also sending user lists.
+        await self.send_json(notification)
+        self.enqueue("refresh_user_lists", self.refresh_user_lists, {}, time.perf_counter(), internal=True)
+
     async def send_json(self, content):
-        await self.send(text_data=json.dumps(content))
+        if content["type"] == "error":
+            metrics.action_errors.inc(metrics.current_action.get())
+        metrics.frames_sent.inc(content["type"])
+        if self.binary:
+            await self.send_bytes(codec.packb(content))
+        else:
+            await self.send_text(codec.dumps(content))
+
+    async def send_broadcast(self, event, frame_type):
+        """Forward a frame the sender encoded once for all receiving sockets."""
+        if self.user_ids:
+            # Encoded with usernames; this socket needs its own copy
+            content = codec.loads(event["frame"])
+            fields = BROADCAST_USER_FIELDS[frame_type]
+            ids = await self.ids_for(content[field] for field in fields)
+            await self.send_json({**content, **{field: ids.get(content[field]) for field in fields}})
+            return
+        metrics.frames_sent.inc(frame_type)
+        if not self.binary:
+            await self.send_text(event["frame"])
+        elif "packed" in event:
+            await self.send_bytes(event["packed"])
+        else:
+            # Sent by a worker without MessagePack installed
+            await self.send_bytes(codec.packb(codec.loads(event["frame"])))
+
+    async def send_text(self, frame):
+        if self.compression is not None and len(frame) >= compression.compressor.threshold:
+            await self.send_compressed(frame)
+            return
+        metrics.frame_bytes.observe(len(frame), "json")
+        await self.send(text_data=frame)
+
+    async def send_bytes(self, frame):
+        if self.compression is not None and len(frame) >= compression.compressor.threshold:
+            await self.send_compressed(frame)
+            return
+        metrics.frame_bytes.observe(len(frame), codec.MSGPACK)
+        await self.send(bytes_data=frame)
+
+    async def send_compressed(self, frame):
+        compressed = compression.compressor.compress(frame, self.compression)
+        metrics.frame_bytes.observe(len(compressed), compression.ALGORITHM)
+        await self.send(bytes_data=compressed)
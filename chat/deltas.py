@@ -0,0 +1,244 @@
+import itertools
+import secrets
+import threading
+from collections import OrderedDict, deque
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import UserConnection
+from .usernames import user_map
+
+# Names of the lists a client keeps, as they appear in an `update_users` frame
+USERS = "users"
+SENT_REQUESTS = "sent_requests"
+PENDING_REQUESTS = "pending_requests"
+MUTUAL_CONNECTIONS = "mutual_connections"
+
+
+class UserListJournal:
+    """
+    Revisioned log of changes to each user's connection lists.
+
+    Every change gets a revision from a single, monotonically increasing
+    counter. Revisions only mean something to the journal that handed them
+    out, which is one per worker process, so clients hold on to the
+    journal's `id` along with a revision and a resume is only accepted with
+    a matching one. Per-user changes are kept in a bounded log per user, changes to
+    the shared user directory in one bounded log for everybody. A client that
+    knows its last revision can ask for everything after it; if the journal
+    no longer holds that range the caller falls back to a full snapshot.
+
+    Ops are idempotent (add/remove/move of a username) so replaying a change
+    that was already part of a snapshot is harmless.
+    """
+
+    def __init__(self, max_entries_per_user=256, max_directory_entries=1024, max_users=10000):
+        # Another worker, or this one before a restart, numbers its own
+        # revisions; they must not be read as this journal's
+        self.id = secrets.token_hex(8)
+        self._floor = 0
+        self._counter = itertools.count(self._floor + 1)
+        self._current = self._floor
+        self._lock = threading.Lock()
+
+        self._max_entries_per_user = max_entries_per_user
+        self._max_users = max_users
+        self._user_entries = OrderedDict()  # user_id -> deque of (revision, op)
+        self._user_floors = {}  # user_id -> newest revision dropped from its log
+        self._evicted_floor = self._floor  # newest revision of any evicted user log
+
+        self._directory_entries = deque(maxlen=max_directory_entries)
+        self._directory_floor = self._floor
+
+        self._listeners = []
+
+    def subscribe(self, listener, remote=True):
+        """
+        Call `listener(changes)` for every per-user event recorded. With
+        `remote=False` events relayed from other worker processes are skipped.
+        """
+        self._listeners.append((listener, remote))
+
+    def current(self):
+        with self._lock:
+            return self._current
+
+    def record(self, changes, remote=False):
+        """
+        Record one event touching one or more users. `changes` maps a user id
+        to the list of ops for that user. All ops share one revision.
+        `remote` marks events that happened in another worker process.
+        """
+        with self._lock:
+            revision = next(self._counter)
+            self._current = revision
+            for user_id, ops in changes.items():
+                entries = self._user_entries.get(user_id)
+                if entries is None:
+                    entries = self._user_entries[user_id] = deque()
+                    self._evict_users()
+                else:
+                    self._user_entries.move_to_end(user_id)
+                for op in ops:
+                    if len(entries) >= self._max_entries_per_user:
+                        dropped_revision, _ = entries.popleft()
+                        self._user_floors[user_id] = dropped_revision
+                    entries.append((revision, op))
+        for listener, include_remote in self._listeners:
+            if include_remote or not remote:
+                listener(changes)
+        return revision
+
+    def record_directory(self, user_id, op):
+        """
+        Record a change to the user directory that every client except
+        `user_id` (the user the change is about) should see.
+        """
+        with self._lock:
+            revision = next(self._counter)
+            self._current = revision
+            if len(self._directory_entries) == self._directory_entries.maxlen:
+                self._directory_floor = self._directory_entries[0][0]
+            self._directory_entries.append((revision, user_id, op))
+            return revision
+
+    def since(self, user_id, revision, journal_id):
+        """
+        Return `(ops, current_revision)` with every op for `user_id` newer
+        than `revision` of journal `journal_id`, or None when that is another
+        journal or the range is no longer (or was never) held by this one and
+        a full snapshot is required.
+        """
+        if journal_id != self.id:
+            return None
+        with self._lock:
+            user_floor = self._user_floors.get(user_id, self._floor)
+            if user_id not in self._user_entries:
+                user_floor = max(user_floor, self._evicted_floor)
+            floor = max(user_floor, self._directory_floor)
+            if revision < floor or revision > self._current:
+                return None
+
+            ops = [
+                (rev, op) for rev, op in self._user_entries.get(user_id, ())
+                if rev > revision
+            ]
+            ops.extend(
+                (rev, op) for rev, subject_id, op in self._directory_entries
+                if rev > revision and subject_id != user_id
+            )
+            ops.sort(key=lambda entry: entry[0])
+            return [op for _, op in ops], self._current
+
+    def _evict_users(self):
+        while len(self._user_entries) > self._max_users:
+            evicted_id, entries = self._user_entries.popitem(last=False)
+            self._user_floors.pop(evicted_id, None)
+            if entries:
+                self._evicted_floor = max(self._evicted_floor, entries[-1][0])
+
+
+journal = UserListJournal()
+
+
+def _op(op, list_name, username):
+    return {"op": op, "list": list_name, "username": username}
+
+
+def _move(from_list, to_list, username):
+    return {"op": "move", "from": from_list, "list": to_list, "username": username}
+
+
+def record_request_sent(sender, receiver):
+    return record_requests_sent(sender, [receiver])
+
+
+def record_request_approved(sender, receiver):
+    return record_requests_approved([sender], receiver)
+
+
+def record_request_rejected(sender, receiver):
+    return record_requests_rejected([sender], receiver)
+
+
+# Batches are recorded as one event, so clients get them in a single delta
+
+
+def record_requests_sent(sender, receivers):
+    changes = {receiver.id: [_op("add", PENDING_REQUESTS, sender.username)] for receiver in receivers}
+    changes[sender.id] = [_op("add", SENT_REQUESTS, receiver.username) for receiver in receivers]
+    return journal.record(changes)
+
+
+def record_requests_approved(senders, receiver):
+    changes = {sender.id: [_move(SENT_REQUESTS, MUTUAL_CONNECTIONS, receiver.username)] for sender in senders}
+    changes[receiver.id] = [_move(PENDING_REQUESTS, MUTUAL_CONNECTIONS, sender.username) for sender in senders]
+    return journal.record(changes)
+
+
+def record_requests_rejected(senders, receiver):
+    changes = {sender.id: [_op("remove", SENT_REQUESTS, receiver.username)] for sender in senders}
+    changes[receiver.id] = [_op("remove", PENDING_REQUESTS, sender.username) for sender in senders]
+    return journal.record(changes)
+
+
+def record_user_registered(user):
+    return journal.record_directory(user.id, _op("add", USERS, user.username))
+
+
+# Changes made through the services are recorded there, with the ops for
+# exactly what changed. Saves and deletes anywhere else (the admin, the
+# shell, a data fix) are recorded by the receivers below, which only know
+# the row's new state and so reset the pair's entries in every list.
+# The services write with QuerySet.update(), bulk_create() and raw SQL,
+# which send no signals; code using them outside the services has to record
+# its changes itself.
+
+
+def connection_changes(sender_id, receiver_id, status):
+    """
+    Ops putting each user of a connection in the other's lists as `status`
+    (None once the row is gone) says, whatever was there before.
+    """
+    usernames = user_map.usernames_for([sender_id, receiver_id])
+    if sender_id not in usernames or receiver_id not in usernames:
+        return {}  # a user deleted along with the row
+    if status == UserConnection.Status.PENDING:
+        sender_list, receiver_list = SENT_REQUESTS, PENDING_REQUESTS
+    elif status == UserConnection.Status.APPROVED:
+        sender_list = receiver_list = MUTUAL_CONNECTIONS
+    else:
+        sender_list = receiver_list = None
+
+    def reset(lists, target, username):
+        return [_op("add" if name == target else "remove", name, username) for name in lists]
+
+    return {
+        sender_id: reset((SENT_REQUESTS, MUTUAL_CONNECTIONS), sender_list, usernames[receiver_id]),
+        receiver_id: reset((PENDING_REQUESTS, MUTUAL_CONNECTIONS), receiver_list, usernames[sender_id]),
+    }
+
+
+def _record_connection(instance, status, using):
+    sender_id, receiver_id = instance.sender_id, instance.receiver_id
+
+    def record():
+        changes = connection_changes(sender_id, receiver_id, status)
+        if changes:
+            journal.record(changes)
+
+    transaction.on_commit(record, using=using)
+
+
+def _connection_saved(sender, instance, raw=False, using=None, **kwargs):
+    if not raw:
+        _record_connection(instance, instance.status, using)
+
+
+def _connection_deleted(sender, instance, using=None, **kwargs):
+    _record_connection(instance, None, using)
+
+
+post_save.connect(_connection_saved, sender=UserConnection, dispatch_uid="chat_journal_connection_save")
+post_delete.connect(_connection_deleted, sender=UserConnection, dispatch_uid="chat_journal_connection_delete")
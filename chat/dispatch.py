@@ -0,0 +1,98 @@
+class ValidationError(Exception):
+    pass
+
+
+class Field:
+    """
+    One payload field of a WebSocket action: the accepted types, whether it
+    must be present, for strings and lists an upper bound on their length,
+    and for lists the accepted types of their items.
+    """
+
+    def __init__(self, types, required=False, nullable=False, max_length=None, items=None, argument=None):
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.required = required
+        self.nullable = nullable
+        self.max_length = max_length
+        self.items = items if isinstance(items, tuple) or items is None else (items,)
+        # Keyword the handler takes the value as, when it differs from the field name
+        self.argument = argument
+
+    def validate(self, name, value):
+        if value is None:
+            if self.nullable or not self.required:
+                return
+            raise ValidationError(f"{name} is required")
+        if not _is_instance(value, self.types):
+            expected = " or ".join(t.__name__ for t in self.types)
+            raise ValidationError(f"{name} must be of type {expected}")
+        if self.max_length is not None and isinstance(value, str) and len(value) > self.max_length:
+            raise ValidationError(f"{name} must be at most {self.max_length} characters")
+        if isinstance(value, list):
+            if self.max_length is not None and len(value) > self.max_length:
+                raise ValidationError(f"{name} must have at most {self.max_length} items")
+            if self.items is not None and not all(_is_instance(item, self.items) for item in value):
+                expected = " or ".join(t.__name__ for t in self.items)
+                raise ValidationError(f"{name} items must be of type {expected}")
+
+
+def _is_instance(value, types):
+    # bool is an int subclass, but never a valid count or revision
+    return isinstance(value, types) and (not isinstance(value, bool) or bool in types)
+
+
+def required(types, **kwargs):
+    return Field(types, required=True, **kwargs)
+
+
+def optional(types, **kwargs):
+    return Field(types, **kwargs)
+
+
+class ActionRegistry:
+    """
+    Maps WebSocket action names to consumer methods and their payload
+    fields. Handlers receive the declared fields the client sent as keyword
+    arguments; undeclared fields are dropped and absent optional ones are
+    left to the handler's defaults.
+
+        actions = ActionRegistry()
+
+        @actions.register("send_request", receiver=required(str))
+        async def send_connection_request(self, receiver): ...
+    """
+
+    def __init__(self):
+        self._handlers = {}  # action -> (method name, {field name: Field})
+
+    def register(self, name, **fields):
+        def decorator(method):
+            self._handlers[name] = (method.__name__, fields)
+            return method
+        return decorator
+
+    def __contains__(self, name):
+        return name in self._handlers
+
+    def names(self):
+        return frozenset(self._handlers)
+
+    def resolve(self, consumer, name, data):
+        """
+        Return the bound handler for `name` and its validated arguments, or
+        None for an unknown action. Raises ValidationError for a bad payload.
+        """
+        entry = self._handlers.get(name)
+        if entry is None:
+            return None
+        method_name, fields = entry
+
+        arguments = {}
+        for field_name, field in fields.items():
+            if field_name not in data:
+                if field.required:
+                    raise ValidationError(f"{field_name} is required")
+                continue
+            field.validate(field_name, data[field_name])
+            arguments[field.argument or field_name] = data[field_name]
+        return getattr(consumer, method_name), arguments
@@ -0,0 +1,56 @@
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+from .metrics import database_sync_to_async
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor reporting its queue depth and how long work waits to start."""
+
+    def __init__(self, name, max_workers):
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"chat-db-{name}")
+        self.name = name
+        metrics.executor_queue_depth.inc(name, amount=0)
+
+    def submit(self, fn, /, *args, **kwargs):
+        submitted = time.perf_counter()
+        metrics.executor_queue_depth.inc(self.name)
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            metrics.executor_queue_depth.dec(self.name)
+            metrics.executor_wait_seconds.observe(time.perf_counter() - submitted, self.name)
+            return fn(*args, **kwargs)
+
+        return super().submit(run, *args, **kwargs)
+
+
+_options = getattr(settings, "CHAT_DB_EXECUTORS", {})
+_write_workers = _options.get("WRITE_WORKERS", 1)
+if connections["default"].vendor == "sqlite":
+    # SQLite takes one writer at a time; more threads would only wait on its
+    # lock while holding a connection, so all writes go through one thread
+    _write_workers = 1
+
+if _options.get("ENABLED", True):
+    # Reads run in parallel; writes get their own pool, by default a single
+    # thread, so a burst of them cannot starve reads or contend with itself.
+    # Each thread keeps its own database connection (see CONN_MAX_AGE).
+    read_executor = InstrumentedExecutor("read", _options.get("READ_WORKERS", 8))
+    write_executor = InstrumentedExecutor("write", _write_workers)
+
+    def database_read(func):
+        """database_sync_to_async on the read pool; `func` must not write."""
+        return database_sync_to_async(func, thread_sensitive=False, executor=read_executor)
+
+    def database_write(func):
+        """database_sync_to_async on the write pool."""
+        return database_sync_to_async(func, thread_sensitive=False, executor=write_executor)
+else:
+    # Everything on asgiref's single shared sync thread
+    database_read = database_write = database_sync_to_async
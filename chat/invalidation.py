@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from . import deltas
+
+logger = logging.getLogger(__name__)
+
+GROUP_NAME = "chat_relationship_changes"
+# Identifies this worker process so it can ignore its own broadcasts
+WORKER_ID = uuid.uuid4().hex
+# How often the listener re-joins its group, well inside any group expiry
+GROUP_REFRESH_SECONDS = 3600
+
+_listener_task = None
+# The event loop the listener runs on, which also sends this worker's changes
+_loop = None
+
+
+def is_enabled():
+    return getattr(settings, "CHAT_RELATIONSHIP_CACHE", {}).get("BROADCAST_CHANGES", False)
+
+
+def publish_changes(changes):
+    """
+    Relay connection-list changes made in this worker to every other worker
+    over the channel layer, so their journals and local caches stay current.
+
+    Called from sync code (views and the consumers' database helpers), often
+    on the single write thread. The send is only scheduled, once the write
+    has committed, on the worker's event loop: the write thread never waits
+    for the channel layer and a channel layer error cannot fail a write that
+    already happened.
+    """
+    message = {
+        "type": "relationship.changes",
+        "origin": WORKER_ID,
+        # Channel layers may serialise with msgpack, which wants string map keys
+        "changes": [[user_id, ops] for user_id, ops in changes.items()],
+    }
+    transaction.on_commit(lambda: _schedule(message))
+
+
+def _schedule(message):
+    loop = _loop
+    if loop is not None and not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(_send(message), loop)
+        return
+    # No socket has started this worker's loop yet (e.g. a view in a
+    # process that only serves HTTP so far); send from here instead
+    async_to_sync(_send)(message)
+
+
+async def _send(message):
+    try:
+        await get_channel_layer().group_send(GROUP_NAME, message)
+    except Exception as e:
+        logger.error(f"Error relaying relationship changes to other workers: {e}")
+
+
+async def ensure_listener(channel_layer):
+    """Start this worker's listener for other workers' changes, once per process."""
+    global _listener_task, _loop
+    if not is_enabled() or (_listener_task is not None and not _listener_task.done()):
+        return
+    _loop = asyncio.get_running_loop()
+    _listener_task = asyncio.ensure_future(_listen(channel_layer))
+
+
+async def _listen(channel_layer):
+    channel_name = await channel_layer.new_channel("relationship-changes.")
+    await channel_layer.group_add(GROUP_NAME, channel_name)
+    while True:
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(channel_name), GROUP_REFRESH_SECONDS)
+        except asyncio.TimeoutError:
+            await channel_layer.group_add(GROUP_NAME, channel_name)
+            continue
+
+        if message.get("origin") == WORKER_ID:
+            continue
+        try:
+            changes = {user_id: ops for user_id, ops in message["changes"]}
+            deltas.journal.record(changes, remote=True)
+        except Exception as e:
+            logger.error(f"Error applying relationship changes from {message.get('origin')}: {e}")
+
+
+if is_enabled():
+    deltas.journal.subscribe(publish_changes, remote=False)
@@ -0,0 +1,87 @@
+import asyncio
+import bisect
+import hashlib
+
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisPubSubLoopLayer
+from channels_redis.utils import _wrap_close, decode_hosts
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def node_name(host):
+    """Ring identity of one channels_redis host entry: its address."""
+    if "address" in host:
+        return str(host["address"])
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}"
+
+
+class HashRing:
+    """
+    Consistent hash ring over a list of nodes. Each node is placed at
+    `virtual_nodes` points by hashing its name, so where a key lands does not
+    depend on the order the nodes are listed in, and adding or removing one
+    node only moves the keys on its share of the ring (about 1/N of them).
+    """
+
+    def __init__(self, nodes, virtual_nodes=160):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f"{node}#{replica}"), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(virtual_nodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+
+    def index_for(self, key):
+        """Index in `nodes` of the node owning `key`."""
+        position = bisect.bisect(self._points, _hash(key))
+        return self._owners[position % len(self._points)]
+
+    def node_for(self, key):
+        return self.nodes[self.index_for(key)]
+
+
+class ShardedPubSubLoopLayer(RedisPubSubLoopLayer):
+    def __init__(self, *args, ring=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = ring
+
+    def _get_shard(self, channel_or_group_name):
+        return self._shards[self.ring.index_for(channel_or_group_name)]
+
+
+class ShardedPubSubChannelLayer(RedisPubSubChannelLayer):
+    """
+    channels_redis' pub/sub layer with its groups and channels spread over
+    the Redis servers in `hosts` by a consistent hash ring (see HashRing)
+    instead of channels_redis' fixed split of the hash range, which reshuffles
+    most groups whenever a server is added. A `user_{id}` group lives on one
+    server: a group_send is one PUBLISH there, reaching every worker process
+    with a socket in the group.
+    """
+
+    def __init__(self, *args, virtual_nodes=160, **kwargs):
+        super().__init__(*args, **kwargs)
+        hosts = kwargs.get("hosts", args[0] if args else None)
+        self.ring = HashRing([node_name(host) for host in decode_hosts(hosts)], virtual_nodes)
+
+    def group_channel_name(self, group):
+        """The pub/sub channel behind `group`, as the loop layers name it."""
+        return f"{self._kwargs.get('prefix', 'asgi')}__group__{group}"
+
+    def shard_for_group(self, group):
+        """Address of the server carrying `group`."""
+        return self.ring.node_for(self.group_channel_name(group))
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = ShardedPubSubLoopLayer(*self._args, **self._kwargs, ring=self.ring, channel_layer=self)
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+        return layer
@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import sys
+
+from django.conf import settings
+
+from .notifications import coalescer
+from .writebehind import write_queue
+
+logger = logging.getLogger(__name__)
+
+
+async def shutdown():
+    """
+    Send and write out what this worker still holds before it exits:
+    notifications waiting out their coalescing window, then queued rows.
+    Whatever is left after CHAT_SHUTDOWN_TIMEOUT seconds is written by the
+    write-behind queue's exit handler instead.
+    """
+    timeout = getattr(settings, "CHAT_SHUTDOWN_TIMEOUT", 10.0)
+    try:
+        await coalescer.flush_all()
+    except Exception as e:
+        logger.error(f"Error flushing notifications: {e}")
+    try:
+        await asyncio.wait_for(write_queue.aclose(), timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Write-behind queue not drained after {timeout}s, {write_queue.qsize()} rows left for exit")
+    except Exception as e:
+        logger.error(f"Error closing the write-behind queue: {e}")
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan handler, for servers such as uvicorn that send lifespan events."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def install_daphne_hook():
+    """
+    Run `shutdown` when daphne stops. daphne does not send lifespan events,
+    but it stops through its Twisted reactor, which waits for "before
+    shutdown" triggers that return a Deferred.
+    """
+    if "twisted.internet.reactor" not in sys.modules:
+        return
+    from twisted.internet import defer, reactor
+
+    reactor.addSystemEventTrigger(
+        "before", "shutdown", lambda: defer.Deferred.fromFuture(asyncio.ensure_future(shutdown()))
+    )
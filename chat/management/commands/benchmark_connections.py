@@ -0,0 +1,117 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.models import UserConnection
+
+ALIAS = "benchmark"
+
+
+class Command(BaseCommand):
+    help = (
+        "Load a scratch SQLite database with a large UserConnection table and "
+        "print the query plans and timings of the relationship queries."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000, help="Number of UserConnection rows")
+        parser.add_argument("--users", type=int, default=5000, help="Number of users the rows are spread over")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed runs per query")
+        parser.add_argument("--path", help="SQLite file to use (default: a temporary file)")
+        parser.add_argument("--keep", action="store_true", help="Keep the database file afterwards")
+
+    def handle(self, *args, **options):
+        rows, users = options["rows"], options["users"]
+        if rows > users * (users - 1):
+            self.stderr.write("Not enough users for that many distinct (sender, receiver) pairs")
+            return
+
+        path = options["path"] or os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3")
+        connections.databases[ALIAS] = {
+            **connections.databases["default"],
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": path,
+            "OPTIONS": {},
+        }
+        try:
+            self.stdout.write(f"Creating schema in {path}")
+            call_command("migrate", database=ALIAS, verbosity=0)
+            self.seed(rows, users)
+            self.report(users, options["repeat"])
+        finally:
+            connections[ALIAS].close()
+            if not options["keep"] and not options["path"]:
+                os.remove(path)
+
+    def seed(self, rows, users):
+        start = time.perf_counter()
+        User.objects.using(ALIAS).bulk_create(
+            [User(username=f"user{i:07d}", password="!") for i in range(users)],
+            batch_size=1000,
+        )
+        user_ids = list(User.objects.using(ALIAS).order_by("id").values_list("id", flat=True))
+
+        # Every sender gets rows // users receivers at increasing offsets, which
+        # keeps (sender, receiver) unique. Statuses are drawn at random,
+        # ~30% pending, ~60% approved and ~10% rejected, so every user
+        # gets the mix.
+        statuses = [UserConnection.Status.PENDING] * 3 + [UserConnection.Status.APPROVED] * 6 + [UserConnection.Status.REJECTED]
+        rng = random.Random(0)
+        # Stored the way the ORM stores it
+        now = connections[ALIAS].ops.adapt_datetimefield_value(timezone.now())
+        table = UserConnection._meta.db_table
+        sql = (
+            f'INSERT INTO "{table}" (sender_id, receiver_id, status, created_at, updated_at) '
+            "VALUES (%s, %s, %s, %s, %s)"
+        )
+        with transaction.atomic(using=ALIAS), connections[ALIAS].cursor() as cursor:
+            batch = []
+            for i in range(rows):
+                sender = i % users
+                receiver = (sender + 1 + i // users) % users
+                batch.append((user_ids[sender], user_ids[receiver], rng.choice(statuses), now, now))
+                if len(batch) == 10000:
+                    cursor.executemany(sql, batch)
+                    batch = []
+            if batch:
+                cursor.executemany(sql, batch)
+        with connections[ALIAS].cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+        self.stdout.write(f"Seeded {users} users and {rows} connections in {time.perf_counter() - start:.1f}s")
+
+    def report(self, users, repeat):
+        user_id = User.objects.using(ALIAS).order_by("id").values_list("id", flat=True)[users // 2]
+        connections_qs = UserConnection.objects.using(ALIAS)
+        queries = {
+            "sent": connections_qs.filter(
+                sender_id=user_id, status=UserConnection.Status.PENDING
+            ).values_list("receiver__username", flat=True),
+            "pending": connections_qs.filter(
+                receiver_id=user_id, status=UserConnection.Status.PENDING
+            ).values_list("sender__username", flat=True),
+            "mutual": connections_qs.filter(
+                Q(sender_id=user_id) | Q(receiver_id=user_id), status=UserConnection.Status.APPROVED
+            ).values_list("sender__username", "receiver__username"),
+            "snapshot": connections_qs.filter(
+                Q(sender_id=user_id) | Q(receiver_id=user_id)
+            ).values_list("sender_id", "receiver_id", "status"),
+        }
+
+        for name, queryset in queries.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                count = len(list(queryset.all()))
+                timings.append((time.perf_counter() - start) * 1000)
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n{name}: {count} rows, median {statistics.median(timings):.3f} ms"))
+            self.stdout.write(queryset.explain())
@@ -0,0 +1,201 @@
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.db.models import Q
+from django.utils import timezone
+
+from chat import services
+from chat.models import UserConnection
+from chat.sqlite import DEFAULT_PRAGMAS
+
+SEED = "benchmark_seed"
+
+# Name -> (extra OPTIONS, pragmas). "default" is SQLite as it comes: rollback
+# journal, synchronous=FULL and Python's 5 second lock timeout.
+CONFIGURATIONS = {
+    "default": ({}, {}),
+    "tuned": ({"transaction_mode": "IMMEDIATE"}, getattr(settings, "CHAT_SQLITE_PRAGMAS", DEFAULT_PRAGMAS)),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare read and write throughput of a scratch SQLite database with "
+        "SQLite's default settings and with CHAT_SQLITE_PRAGMAS, under the "
+        "consumers' mix of concurrent readers and a serialized writer."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100_000, help="Number of UserConnection rows to start with")
+        parser.add_argument("--users", type=int, default=2000, help="Number of users the rows are spread over")
+        parser.add_argument("--readers", type=int, default=8, help="Reader threads (cf. CHAT_DB_EXECUTORS READ_WORKERS)")
+        parser.add_argument("--writers", type=int, default=1, help="Writer threads; the consumers use one on SQLite")
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run each configuration")
+        parser.add_argument(
+            "--config", action="append", choices=sorted(CONFIGURATIONS),
+            help="Configuration to run (repeatable; default: all)",
+        )
+
+    def handle(self, *args, **options):
+        rows, users = options["rows"], options["users"]
+        if rows > users * (users - 1) // 2:
+            self.stderr.write("Not enough users for that many distinct (sender, receiver) pairs")
+            return
+
+        directory = tempfile.mkdtemp()
+        try:
+            # Seed once and copy the file for each configuration, so every
+            # run starts from the same data
+            seed_path = os.path.join(directory, "seed.sqlite3")
+            self.add_database(SEED, seed_path, {}, {})
+            self.stdout.write(f"Seeding {seed_path}")
+            call_command("migrate", database=SEED, verbosity=0)
+            self.seed(rows, users)
+            connections[SEED].close()
+
+            results = {}
+            for name in options["config"] or CONFIGURATIONS:
+                alias = f"benchmark_{name}"
+                path = os.path.join(directory, f"{name}.sqlite3")
+                shutil.copyfile(seed_path, path)
+                self.add_database(alias, path, *CONFIGURATIONS[name])
+                results[name] = self.run(alias, users, rows // users + 1, options)
+                connections[alias].close()
+                self.report(name, results[name])
+
+            if "default" in results and "tuned" in results:
+                for kind in ("reads", "writes"):
+                    before, after = results["default"][kind], results["tuned"][kind]
+                    if before:
+                        self.stdout.write(f"{kind}: {after / before:.2f}x the default configuration's throughput")
+        finally:
+            shutil.rmtree(directory)
+
+    def add_database(self, alias, path, extra_options, pragmas):
+        connections.databases[alias] = {
+            **connections.databases["default"],
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": path,
+            "CONN_MAX_AGE": None,
+            "OPTIONS": extra_options,
+            "PRAGMAS": pragmas,
+        }
+
+    def seed(self, rows, users):
+        start = time.perf_counter()
+        User.objects.using(SEED).bulk_create(
+            [User(username=f"user{i:07d}", password="!") for i in range(users)],
+            batch_size=1000,
+        )
+        user_ids = list(User.objects.using(SEED).order_by("id").values_list("id", flat=True))
+
+        # Sender i is connected to the next rows // users users, half of the
+        # connections approved; the writers carry on from there
+        now = timezone.now()
+        UserConnection.objects.using(SEED).bulk_create(
+            [
+                UserConnection(
+                    sender_id=user_ids[i % users],
+                    receiver_id=user_ids[(i % users + 1 + i // users) % users],
+                    status=UserConnection.Status.APPROVED if i % 2 else UserConnection.Status.PENDING,
+                    created_at=now,
+                    updated_at=now,
+                )
+                for i in range(rows)
+            ],
+            batch_size=5000,
+        )
+        self.stdout.write(f"Seeded {users} users and {rows} connections in {time.perf_counter() - start:.1f}s")
+
+    def run(self, alias, users, first_offset, options):
+        user_ids = list(User.objects.using(alias).order_by("id").values_list("id", flat=True))
+        connections[alias].close()
+        stop = threading.Event()
+        results = {"read_times": [], "write_times": [], "errors": 0}
+        lock = threading.Lock()
+
+        def read(worker):
+            rng = random.Random(worker)
+            times = []
+            while not stop.is_set():
+                user_id = rng.choice(user_ids)
+                start = time.perf_counter()
+                try:
+                    # The relationship snapshot behind every user list
+                    list(
+                        UserConnection.objects.using(alias)
+                        .filter(Q(sender_id=user_id) | Q(receiver_id=user_id))
+                        .values_list("sender_id", "receiver_id", "status")
+                    )
+                except OperationalError:
+                    with lock:
+                        results["errors"] += 1
+                    continue
+                times.append(time.perf_counter() - start)
+            connections[alias].close()
+            with lock:
+                results["read_times"].extend(times)
+
+        def write(worker):
+            times = []
+            n = worker
+            while not stop.is_set():
+                # Fresh (sender, receiver) pairs past the seeded ones, split
+                # between the writers
+                sender = user_ids[n % users]
+                receiver = user_ids[(n % users + first_offset + n // users) % users]
+                n += options["writers"]
+                if sender == receiver:
+                    continue
+                start = time.perf_counter()
+                try:
+                    # The statements the consumers' send and approve run
+                    services.insert_pending(sender, receiver, using=alias)
+                    services.approve_pending(sender, receiver, using=alias)
+                except OperationalError:
+                    with lock:
+                        results["errors"] += 1
+                    continue
+                times.append(time.perf_counter() - start)
+            connections[alias].close()
+            with lock:
+                results["write_times"].extend(times)
+
+        threads = [threading.Thread(target=read, args=(i,)) for i in range(options["readers"])]
+        threads += [threading.Thread(target=write, args=(i,)) for i in range(options["writers"])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(options["duration"])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results["reads"] = len(results["read_times"]) / elapsed
+        results["writes"] = len(results["write_times"]) / elapsed
+        return results
+
+    def report(self, name, results):
+        self.stdout.write(self.style.MIGRATE_HEADING(f"\n{name}"))
+        for kind in ("read", "write"):
+            times = sorted(results[f"{kind}_times"])
+            if not times:
+                self.stdout.write(f"  {kind}s: none completed")
+                continue
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            self.stdout.write(
+                f"  {kind}s: {results[kind + 's']:.0f}/s, median {statistics.median(times) * 1000:.2f} ms, "
+                f"p95 {p95 * 1000:.2f} ms"
+            )
+        self.stdout.write(f"  lock errors: {results['errors']}")
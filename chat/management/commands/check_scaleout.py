@@ -0,0 +1,125 @@
+import asyncio
+import random
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import codec
+from chat.testing import ClusterError, LocalCluster
+
+from .loadtest import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure fan-out across the multi-process deployment: start stand-in "
+        "Redis servers (fakeredis) as channel layer shards, several workers with "
+        "runworkers against them and a scratch SQLite database, open sockets "
+        "spread over all workers and report how fast events published to their "
+        "groups arrive. Cross-worker delivery itself is checked by "
+        "chat.tests.test_scaleout."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=3)
+        parser.add_argument("--shards", type=int, default=2, help="Stand-in Redis servers to start")
+        parser.add_argument(
+            "--redis", action="append",
+            help="Use this Redis server as a shard instead of the stand-ins (repeatable)",
+        )
+        parser.add_argument("--users", type=int, default=300, help="Sockets to open, one per user")
+        parser.add_argument("--events", type=int, default=3000, help="Events to publish")
+        parser.add_argument("--concurrency", type=int, default=50, help="Events in flight at once")
+        parser.add_argument("--port", type=int, default=8400, help="Worker i listens on PORT + i")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Seconds to wait for the last event")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.cluster = LocalCluster(
+            workers=options["workers"], shards=options["shards"], redis=options["redis"],
+            users=options["users"], port=options["port"], timeout=options["timeout"],
+        )
+        try:
+            self.cluster.start()
+        except ClusterError as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f"Started {self.cluster.workers} workers on ports {self.cluster.ports[0]}-{self.cluster.ports[-1]} "
+            f"over {len(self.cluster.hosts)} Redis servers"
+        )
+        try:
+            asyncio.run(self.run())
+        except CommandError:
+            self.stderr.write(f"Worker log:\n{self.cluster.log_tail()}")
+            raise
+        finally:
+            self.cluster.stop()
+        self.stdout.write(self.style.SUCCESS("Every event was delivered"))
+
+    async def run(self):
+        try:
+            await self.measure_fanout()
+        finally:
+            await self.cluster.layer.flush()
+
+    async def measure_fanout(self):
+        workers, count = self.cluster.workers, self.options["events"]
+        users = self.cluster.users
+        semaphore = asyncio.Semaphore(self.options["concurrency"])
+
+        async def open_one(index, user):
+            async with semaphore:
+                return user, await self.cluster.open(user, index % workers)
+
+        clients = await asyncio.gather(*(open_one(index, user) for index, user in enumerate(users)))
+        shards = Counter(self.cluster.layer.shard_for_group(f"user_{user.id}") for user in users)
+        self.stdout.write(f"  {len(clients)} sockets over {workers} workers; groups per shard: "
+                          + ", ".join(f"{host} {n}" for host, n in sorted(shards.items())))
+
+        latencies = []
+        received = asyncio.Event()
+        stop = asyncio.Event()
+
+        async def receive(client):
+            while not stop.is_set():
+                try:
+                    _, frame = await client.receive(0.5)
+                except asyncio.TimeoutError:
+                    continue
+                if frame.get("type") == "message" and "probe" in frame:
+                    latencies.append((time.time() - frame["sent"]) * 1000)
+                    if len(latencies) >= count:
+                        received.set()
+
+        receivers = [asyncio.ensure_future(receive(client)) for _, client in clients]
+
+        async def publish(probe):
+            user = rng.choice(users)
+            async with semaphore:
+                frame = {"type": "message", "probe": probe, "sent": time.time()}
+                await self.cluster.layer.group_send(f"user_{user.id}", {"type": "chat_message", **codec.encode_broadcast(frame)})
+
+        rng = random.Random(0)
+        started = time.perf_counter()
+        await asyncio.gather(*(publish(probe) for probe in range(count)))
+        published = time.perf_counter() - started
+        try:
+            await asyncio.wait_for(received.wait(), self.options["timeout"])
+        except asyncio.TimeoutError:
+            pass
+        delivered = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*receivers)
+        await asyncio.gather(*(client.close() for _, client in clients), return_exceptions=True)
+
+        self.stdout.write(f"  published {count} events in {published:.2f}s ({count / published:.0f}/s)")
+        self.stdout.write(f"  delivered {len(latencies)} in {delivered:.2f}s ({len(latencies) / delivered:.0f}/s)")
+        if latencies:
+            self.stdout.write(
+                "  latency p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(
+                    *(percentile(latencies, pct) for pct in (50, 95, 99))
+                )
+            )
+        if len(latencies) < count:
+            raise CommandError(f"Only {len(latencies)} of {count} events were delivered")
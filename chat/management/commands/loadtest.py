@@ -0,0 +1,434 @@
+import asyncio
+import base64
+import json
+import random
+import resource
+import statistics
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import compression
+from chat.models import UserConnection
+
+USERNAME_PREFIX = "loadtest_"
+
+# Reply frame types that complete each action (in legacy snapshot mode).
+# Any action can also be answered by an error, e.g. when it is throttled.
+EXPECTED_REPLIES = {
+    "init_connection": {"update_users", "error"},
+    "get_users": {"update_users", "error"},
+    "send_request": {"update_users", "error"},
+    "approve_request": {"update_users", "error"},
+    "ping": {"pong", "error"},
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(timings):
+    return {
+        "count": len(timings),
+        "mean_ms": statistics.fmean(timings) if timings else None,
+        "p50_ms": percentile(timings, 50),
+        "p95_ms": percentile(timings, 95),
+        "p99_ms": percentile(timings, 99),
+        "max_ms": max(timings) if timings else None,
+    }
+
+
+def encode(data, binary):
+    if binary:
+        import msgpack
+
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data)
+
+
+def decode(frame):
+    if isinstance(frame, bytes):
+        import msgpack
+
+        return msgpack.unpackb(frame, raw=False)
+    return json.loads(frame)
+
+
+def rss_kb(pid="self"):
+    """Resident set size of a process in KiB, from /proc where available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class ClientSocket:
+    binary = False
+    zdict = None
+
+    def decode(self, frame):
+        if isinstance(frame, bytes) and frame[:1] == compression.MAGIC:
+            frame = compression.decompress(frame, self.zdict)
+            if not self.binary:
+                frame = frame.decode()
+        data = decode(frame)
+        if data.get("type") == "compression":
+            self.zdict = base64.b64decode(data["dictionary"])
+        return data
+
+
+class InProcessSocket(ClientSocket):
+    """WebSocket client talking to the ASGI application inside this process."""
+
+    def __init__(self, token, binary=False):
+        from channels.testing import WebsocketCommunicator
+        from backend.asgi import application
+
+        self.binary = binary
+        self.communicator = WebsocketCommunicator(
+            application,
+            f"/ws/chat/?{urlencode({'token': token})}",
+            headers=[(b"origin", b"http://localhost")],
+            subprotocols=["msgpack"] if binary else None,
+        )
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise ConnectionError("WebSocket handshake rejected")
+
+    async def send(self, data):
+        frame = encode(data, self.binary)
+        if self.binary:
+            await self.communicator.send_to(bytes_data=frame)
+        else:
+            await self.communicator.send_to(text_data=frame)
+
+    async def receive(self, timeout):
+        frame = await self.communicator.receive_from(timeout=timeout)
+        return len(frame), self.decode(frame)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class NetworkSocket(ClientSocket):
+    """WebSocket client talking to a running server, e.g. ws://127.0.0.1:8000."""
+
+    def __init__(self, token, url, binary=False):
+        self.url = f"{url.rstrip('/')}/ws/chat/?{urlencode({'token': token})}"
+        # The server's AllowedHostsOriginValidator refuses sockets without one
+        parts = urlsplit(url)
+        self.origin = f"{'https' if parts.scheme == 'wss' else 'http'}://{parts.netloc}"
+        self.binary = binary
+        self.websocket = None
+
+    async def connect(self):
+        try:
+            import websockets
+        except ImportError:
+            raise CommandError("Install the 'websockets' package to load test a running server")
+        self.websocket = await websockets.connect(
+            self.url, origin=self.origin, max_size=None, open_timeout=30,
+            subprotocols=["msgpack"] if self.binary else None,
+        )
+
+    async def send(self, data):
+        await self.websocket.send(encode(data, self.binary))
+
+    async def receive(self, timeout):
+        frame = await asyncio.wait_for(self.websocket.recv(), timeout)
+        return len(frame), self.decode(frame)
+
+    async def close(self):
+        await self.websocket.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed users and connections, open many authenticated ws/chat/ sockets and "
+        "drive a mix of actions against them, then report latency percentiles, "
+        "throughput and memory as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000, help="Users to seed")
+        parser.add_argument("--connections", type=int, default=5000, help="UserConnection rows to seed")
+        parser.add_argument("--sockets", type=int, default=1000, help="Concurrent WebSockets to open")
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds to drive traffic for")
+        parser.add_argument(
+            "--mix", default="get_users=3,send_request=1,approve_request=1,ping=5",
+            help="Relative weights of the actions each socket sends",
+        )
+        parser.add_argument("--think-ms", type=float, default=100.0, help="Pause between a reply and the next action")
+        parser.add_argument("--ramp-concurrency", type=int, default=200, help="Sockets opened at the same time")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Seconds to wait for any single reply")
+        parser.add_argument(
+            "--url",
+            help="Test a running server at this ws:// URL instead of the application in-process. "
+                 "Needs --seed-database.",
+        )
+        parser.add_argument(
+            "--seed-database",
+            help="With --url, the database alias the server reads. Users named loadtest_* are seeded "
+                 "into it and deleted afterwards, so never name a database holding real data.",
+        )
+        parser.add_argument("--server-pid", type=int, help="PID of the server, to report its memory with --url")
+        parser.add_argument("--msgpack", action="store_true", help="Use the binary MessagePack subprotocol")
+        parser.add_argument("--compress", action="store_true", help="Ask for compressed frames at init")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+        parser.add_argument("--compare", help="Earlier results file to compare p95 latencies against")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.random = random.Random(options["seed"])
+        try:
+            self.mix = {
+                name: float(weight)
+                for name, weight in (item.split("=") for item in options["mix"].split(","))
+            }
+        except ValueError:
+            raise CommandError("--mix must look like get_users=3,ping=5")
+        unknown = set(self.mix) - set(EXPECTED_REPLIES)
+        if unknown:
+            raise CommandError(f"Unknown actions in --mix: {', '.join(sorted(unknown))}")
+
+        in_process = not options["url"]
+        if in_process:
+            if options["seed_database"]:
+                raise CommandError("--seed-database only applies with --url")
+            # Never load test the real database in-process
+            self.database = DEFAULT_DB_ALIAS
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        else:
+            # A running server reads a real database; writing to it has to be
+            # asked for by name
+            self.database = options["seed_database"]
+            if not self.database:
+                raise CommandError(
+                    "--url seeds users into the server's database and deletes them afterwards; "
+                    "pass --seed-database with its alias to allow that"
+                )
+            if self.database not in connections.databases:
+                raise CommandError(f"Unknown database alias {self.database!r}")
+            if User.objects.using(self.database).filter(username__startswith=USERNAME_PREFIX).exists():
+                raise CommandError(
+                    f"Database {self.database!r} already has {USERNAME_PREFIX}* users, which this run "
+                    "would delete; remove them first"
+                )
+        try:
+            self.seed()
+            results = asyncio.run(self.run())
+        finally:
+            if in_process:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            else:
+                User.objects.using(self.database).filter(username__startswith=USERNAME_PREFIX).delete()
+
+        self.report(results)
+
+    def seed(self):
+        users, rows = self.options["users"], self.options["connections"]
+        if rows > users * (users - 1):
+            raise CommandError("Not enough users for that many distinct connections")
+
+        start = time.perf_counter()
+        User.objects.using(self.database).bulk_create(
+            [User(username=f"{USERNAME_PREFIX}{i:07d}", password="!") for i in range(users)],
+            batch_size=1000,
+        )
+        self.users = list(
+            User.objects.using(self.database).filter(username__startswith=USERNAME_PREFIX).order_by("id")
+        )
+
+        pairs = set()
+        while len(pairs) < rows:
+            sender, receiver = self.random.sample(range(users), 2)
+            if (receiver, sender) not in pairs:
+                pairs.add((sender, receiver))
+        statuses = [UserConnection.Status.PENDING, UserConnection.Status.APPROVED]
+        UserConnection.objects.using(self.database).bulk_create(
+            [
+                UserConnection(
+                    sender=self.users[sender],
+                    receiver=self.users[receiver],
+                    status=self.random.choice(statuses),
+                )
+                for sender, receiver in pairs
+            ],
+            batch_size=1000,
+        )
+        self.stdout.write(f"Seeded {users} users and {rows} connections in {time.perf_counter() - start:.1f}s")
+        self.tokens = [str(AccessToken.for_user(user)) for user in self.users]
+
+    def new_socket(self, index):
+        token = self.tokens[index % len(self.tokens)]
+        if self.options["url"]:
+            return NetworkSocket(token, self.options["url"], self.options["msgpack"])
+        return InProcessSocket(token, self.options["msgpack"])
+
+    async def run(self):
+        self.timings = {action: [] for action in EXPECTED_REPLIES}
+        self.errors = {action: 0 for action in EXPECTED_REPLIES}
+        self.timeouts = {action: 0 for action in EXPECTED_REPLIES}
+        self.throttled = {action: 0 for action in EXPECTED_REPLIES}
+        self.connect_timings = []
+        self.bytes_received = 0
+        self.failed_connects = 0
+
+        sockets = await self.open_sockets()
+        self.stdout.write(f"Opened {len(sockets)} sockets, driving traffic for {self.options['duration']}s")
+
+        started = time.perf_counter()
+        deadline = started + self.options["duration"]
+        await asyncio.gather(*(self.drive(index, socket, deadline) for index, socket in sockets))
+        elapsed = time.perf_counter() - started
+
+        peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        await asyncio.gather(*(socket.close() for _, socket in sockets), return_exceptions=True)
+        return elapsed, len(sockets), peak_rss_kb
+
+    async def open_sockets(self):
+        semaphore = asyncio.Semaphore(self.options["ramp_concurrency"])
+
+        async def open_one(index):
+            async with semaphore:
+                socket = self.new_socket(index)
+                start = time.perf_counter()
+                try:
+                    await socket.connect()
+                except Exception:
+                    self.failed_connects += 1
+                    return None
+                self.connect_timings.append((time.perf_counter() - start) * 1000)
+                return index, socket
+
+        opened = await asyncio.gather(*(open_one(index) for index in range(self.options["sockets"])))
+        return [item for item in opened if item is not None]
+
+    async def drive(self, index, socket, deadline):
+        user = self.users[index % len(self.users)]
+        # What this socket last saw of its lists; requests to users it is
+        # already related to are ignored by the server without a reply
+        related, pending = {user.username}, []
+        actions, weights = list(self.mix), list(self.mix.values())
+
+        if self.options["compress"]:
+            try:
+                await self.request(socket, "init_connection", {"action": "init_connection", "compression": "deflate"})
+            except Exception:
+                self.errors["init_connection"] += 1
+                return
+
+        while time.perf_counter() < deadline:
+            action = self.random.choices(actions, weights)[0]
+            data = {"action": action}
+            if action == "send_request":
+                data["receiver"] = self.random.choice(self.users).username
+                if data["receiver"] in related:
+                    continue
+                related.add(data["receiver"])
+            elif action == "approve_request":
+                if not pending:
+                    # Nothing to approve yet; learn the lists first
+                    action, data = "get_users", {"action": "get_users"}
+                else:
+                    data["sender"] = pending.pop()
+
+            try:
+                reply = await self.request(socket, action, data)
+            except asyncio.TimeoutError:
+                self.timeouts[action] += 1
+                continue
+            except Exception:
+                self.errors[action] += 1
+                return
+            if reply["type"] == "error" and reply.get("code") == "throttled":
+                self.throttled[action] += 1
+            elif reply["type"] == "error":
+                self.errors[action] += 1
+            elif reply["type"] == "update_users":
+                pending = list(reply["pending_requests"])
+                related = {user.username, *reply["sent_requests"], *pending, *reply["mutual_connections"]}
+            await asyncio.sleep(self.options["think_ms"] / 1000)
+
+    async def request(self, socket, action, data):
+        start = time.perf_counter()
+        await socket.send(data)
+        while True:
+            # Notifications and presence frames can arrive in between
+            size, reply = await socket.receive(self.options["timeout"])
+            self.bytes_received += size
+            if reply.get("type") in EXPECTED_REPLIES[action]:
+                self.timings[action].append((time.perf_counter() - start) * 1000)
+                return reply
+
+    def report(self, run_result):
+        elapsed, sockets, peak_rss_kb = run_result
+        completed = sum(len(timings) for timings in self.timings.values())
+        results = {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "config": {key: self.options[key] for key in (
+                "users", "connections", "sockets", "duration", "mix", "think_ms", "url", "msgpack", "compress", "seed",
+            )},
+            "sockets_opened": sockets,
+            "failed_connects": self.failed_connects,
+            "connect": summarize(self.connect_timings),
+            "actions": {
+                action: {
+                    **summarize(timings),
+                    "errors": self.errors[action],
+                    "throttled": self.throttled[action],
+                    "timeouts": self.timeouts[action],
+                }
+                for action, timings in self.timings.items() if timings or self.errors[action]
+            },
+            "elapsed_s": elapsed,
+            "throughput_rps": completed / elapsed if elapsed else 0.0,
+            "bytes_received": self.bytes_received,
+            "memory": {
+                "peak_rss_kb": peak_rss_kb,
+                "server_rss_kb": rss_kb(self.options["server_pid"]) if self.options["server_pid"] else (
+                    None if self.options["url"] else rss_kb()
+                ),
+            },
+        }
+
+        self.stdout.write(json.dumps(results, indent=2))
+        if self.options["output"]:
+            with open(self.options["output"], "w") as output:
+                json.dump(results, output, indent=2)
+        if self.options["compare"]:
+            self.compare(results)
+
+    def compare(self, results):
+        with open(self.options["compare"]) as previous_file:
+            previous = json.load(previous_file)
+
+        self.stdout.write(self.style.MIGRATE_HEADING("p95 latency against previous run:"))
+        for action, stats in results["actions"].items():
+            before = previous.get("actions", {}).get(action, {}).get("p95_ms")
+            if not before or stats["p95_ms"] is None:
+                continue
+            change = (stats["p95_ms"] - before) / before * 100
+            line = f"  {action}: {before:.2f} ms -> {stats['p95_ms']:.2f} ms ({change:+.1f}%)"
+            self.stdout.write(self.style.ERROR(line) if change > 10 else line)
+
+        before = previous.get("throughput_rps")
+        if before:
+            self.stdout.write(f"  throughput: {before:.1f} -> {results['throughput_rps']:.1f} req/s")
@@ -0,0 +1,151 @@
+import math
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Seconds before a worker that exited on its own is started again
+RESTART_DELAY = 1.0
+
+
+def worker_count(connections, per_worker, max_workers):
+    """Workers for `connections` expected sockets: one per `per_worker`, 1 to `max_workers`."""
+    return max(1, min(math.ceil(connections / per_worker), max_workers))
+
+
+def raise_file_limit(needed):
+    """
+    Raise this process's soft limit on open files to `needed` (children
+    inherit it), as far as the hard limit allows. Returns the new soft limit.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        needed = min(needed, hard)
+    if needed > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+        return needed
+    return soft
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the ASGI application in several daphne worker processes, as many as "
+        "the expected number of WebSocket connections calls for (see CHAT_WORKERS). "
+        "The workers share one listening socket, or with --separate-ports listen on "
+        "consecutive ports for a load balancer. More than one worker needs "
+        "CHAT_CHANNEL_SHARDS."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=None, help="Expected peak of concurrent WebSocket connections")
+        parser.add_argument("--workers", type=int, default=None, help="Number of workers, overriding --connections")
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8000)
+        parser.add_argument(
+            "--separate-ports", action="store_true",
+            help="Give worker i port PORT + i instead of sharing PORT, for a least-connections load balancer",
+        )
+
+    def handle(self, *args, **options):
+        config = getattr(settings, "CHAT_WORKERS", {})
+        per_worker = config.get("CONNECTIONS_PER_WORKER", 5000)
+        max_workers = config.get("MAX_WORKERS") or os.cpu_count() or 1
+
+        if options["workers"] is not None:
+            workers = max(1, options["workers"])
+        elif options["connections"] is not None:
+            workers = worker_count(options["connections"], per_worker, max_workers)
+            if options["connections"] > per_worker * max_workers:
+                self.stderr.write(
+                    f"{options['connections']} connections are more than {max_workers} workers of "
+                    f"{per_worker} each; every worker will carry more"
+                )
+        else:
+            workers = max_workers
+
+        backend = settings.CHANNEL_LAYERS.get("default", {}).get("BACKEND", "")
+        if workers > 1 and backend.endswith("InMemoryChannelLayer"):
+            raise CommandError(
+                "The in-memory channel layer only reaches sockets in its own process; "
+                "set CHAT_CHANNEL_SHARDS to run more than one worker"
+            )
+
+        # Each worker's sockets plus its database connections, log files etc.
+        expected = options["connections"] if options["connections"] is not None else per_worker * workers
+        needed = math.ceil(expected / workers) + config.get("FD_HEADROOM", 256)
+        limit = raise_file_limit(needed)
+        if limit < needed:
+            self.stderr.write(f"Open file limit is {limit}, below the {needed} each worker may need")
+
+        self.listener = None
+        if not options["separate_ports"]:
+            # Bound here and inherited, so the kernel hands each new
+            # connection to whichever worker accepts first
+            self.listener = socket.create_server((options["host"], options["port"]), backlog=1024)
+            self.listener.set_inheritable(True)
+
+        self.options = options
+        self.workers = [None] * workers
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(workers):
+            self.start_worker(index)
+        if self.listener is not None:
+            where = f"{options['host']}:{options['port']}"
+        else:
+            where = f"{options['host']}:{options['port']}-{options['port'] + workers - 1}"
+        self.stdout.write(f"Started {workers} workers on {where}, open file limit {limit}")
+
+        try:
+            self.supervise()
+        finally:
+            self.stop_workers()
+
+    def worker_command(self, index):
+        module, name = settings.ASGI_APPLICATION.rsplit(".", 1)
+        command = [sys.executable, "-m", "daphne"]
+        if self.listener is not None:
+            command += ["--fd", str(self.listener.fileno())]
+        else:
+            command += ["-b", self.options["host"], "-p", str(self.options["port"] + index)]
+        return command + [f"{module}:{name}"]
+
+    def start_worker(self, index):
+        pass_fds = (self.listener.fileno(),) if self.listener is not None else ()
+        self.workers[index] = subprocess.Popen(self.worker_command(index), pass_fds=pass_fds)
+
+    def supervise(self):
+        while not self.stopping:
+            time.sleep(RESTART_DELAY)
+            for index, worker in enumerate(self.workers):
+                if self.stopping or worker.poll() is None:
+                    continue
+                self.stderr.write(f"Worker {index} (pid {worker.pid}) exited with {worker.returncode}, restarting")
+                self.start_worker(index)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def stop_workers(self):
+        for worker in self.workers:
+            if worker is not None and worker.poll() is None:
+                worker.terminate()
+        # Each worker writes out its queued messages before exiting
+        timeout = getattr(settings, "CHAT_SHUTDOWN_TIMEOUT", 10.0) + 5
+        for worker in self.workers:
+            if worker is None:
+                continue
+            try:
+                worker.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        if self.listener is not None:
+            self.listener.close()
@@ -0,0 +1,271 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+# Upper bounds in seconds, from sub-millisecond cache hits to slow queries
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# WebSocket action being handled, so database time and thread hops can be
+# attributed to it. asgiref copies the context into its worker threads.
+current_action = contextvars.ContextVar("chat_current_action", default="other")
+_hop_started = contextvars.ContextVar("chat_hop_started", default=None)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield self.name + _format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            all_series = {labels: list(series) for labels, series in self._series.items()}
+        for label_values, series in sorted(all_series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield self.name + "_bucket" + _format_labels(self.labels, label_values, f'le="{bound}"'), cumulative
+            yield self.name + "_bucket" + _format_labels(self.labels, label_values, 'le="+Inf"'), series[-1]
+            yield self.name + "_sum" + _format_labels(self.labels, label_values), series[-2]
+            yield self.name + "_count" + _format_labels(self.labels, label_values), series[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Register a callable returning (name, kind, help, value) tuples that is
+        called on every scrape, for numbers other components already keep.
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{sample} {value}" for sample, value in metric.samples())
+        for collector in self._collectors:
+            for name, kind, help, value in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+action_seconds = registry.register(Histogram(
+    "chat_ws_action_seconds", "Time to handle one WebSocket action.", labels=("action",),
+))
+action_errors = registry.register(Counter(
+    "chat_ws_action_errors_total", "Error frames sent back per WebSocket action.", labels=("action",),
+))
+throttled = registry.register(Counter(
+    "chat_ws_throttled_total", "Actions refused by rate limits or a full inbox.", labels=("action", "scope"),
+))
+merged = registry.register(Counter(
+    "chat_ws_merged_total", "Actions dropped because an identical one was already queued.", labels=("action",),
+))
+coalesced = registry.register(Counter(
+    "chat_coalesced_requests_total", "Requests answered by another request's in-flight or recent result.",
+    labels=("name",),
+))
+executor_queue_depth = registry.register(Gauge(
+    "chat_db_executor_queue_depth", "Database calls waiting for a thread, by pool.", labels=("pool",),
+))
+executor_wait_seconds = registry.register(Histogram(
+    "chat_db_executor_wait_seconds", "Wait between submitting a database call and it starting, by pool.",
+    labels=("pool",),
+))
+frames_sent = registry.register(Counter(
+    "chat_ws_frames_sent_total", "Frames sent to WebSocket clients by type.", labels=("type",),
+))
+frame_bytes = registry.register(Histogram(
+    "chat_ws_frame_bytes", "Size of frames sent to WebSocket clients by wire format.", labels=("protocol",),
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576),
+))
+compression_ratio = registry.register(Histogram(
+    "chat_ws_compression_ratio", "Compressed size over original size of compressed frames.",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0),
+))
+compression_seconds = registry.register(Histogram(
+    "chat_ws_compression_seconds", "CPU time spent compressing one frame.",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+))
+active_sockets = registry.register(Gauge(
+    "chat_ws_active_sockets", "Open WebSocket connections in this process.",
+))
+active_sockets.inc(amount=0)
+db_queries = registry.register(Counter(
+    "chat_db_queries_total", "Database queries by the WebSocket action that ran them.", labels=("action",),
+))
+db_query_seconds = registry.register(Histogram(
+    "chat_db_query_seconds", "Database query duration.", labels=("action",),
+))
+thread_hop_seconds = registry.register(Histogram(
+    "chat_thread_hop_seconds",
+    "Wait between calling a database_sync_to_async function and it starting in the thread pool.",
+    labels=("action",),
+))
+auth_seconds = registry.register(Histogram(
+    "chat_ws_auth_seconds", "Time to authenticate a WebSocket handshake's token, by whether it was cached.",
+    labels=("result",),
+))
+group_send_seconds = registry.register(Histogram(
+    "chat_channel_group_send_seconds", "Channel layer group_send latency by event type.", labels=("type",),
+))
+
+
+class InstrumentedDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """database_sync_to_async that records how long each call queued for its thread."""
+
+    def __init__(self, func, *args, **kwargs):
+        super().__init__(func, *args, **kwargs)
+        wrapped = self.func
+
+        # Runs on the worker thread inside the caller's copied context
+        @functools.wraps(wrapped)
+        def timed(*args, **kwargs):
+            started = _hop_started.get()
+            if started is not None:
+                thread_hop_seconds.observe(time.perf_counter() - started, current_action.get())
+            return wrapped(*args, **kwargs)
+
+        self.func = timed
+
+    async def __call__(self, *args, **kwargs):
+        token = _hop_started.set(time.perf_counter())
+        try:
+            return await super().__call__(*args, **kwargs)
+        finally:
+            _hop_started.reset(token)
+
+
+database_sync_to_async = InstrumentedDatabaseSyncToAsync
+
+
+async def group_send(channel_layer, group_name, message):
+    """channel_layer.group_send, timed by event type."""
+    started = time.perf_counter()
+    try:
+        await channel_layer.group_send(group_name, message)
+    finally:
+        group_send_seconds.observe(time.perf_counter() - started, message.get("type", ""))
+
+
+def _time_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        action = current_action.get()
+        db_queries.inc(action)
+        db_query_seconds.observe(time.perf_counter() - started, action)
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created receiver that times every query on the connection."""
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+# Relationship cache stats that only ever grow
+_RELATIONSHIP_CACHE_COUNTERS = {"hits", "misses", "evictions"}
+
+
+def _component_metrics():
+    from .cache import relationship_cache
+    from .middleware import token_cache
+    from .usernames import user_map
+    from .writebehind import write_queue
+
+    for key, value in relationship_cache.stats().items():
+        description = f"Relationship cache {key.replace('_', ' ')}."
+        if key in _RELATIONSHIP_CACHE_COUNTERS:
+            yield f"chat_relationship_cache_{key}_total", "counter", description, value
+        else:
+            yield f"chat_relationship_cache_{key}", "gauge", description, value
+    yield "chat_token_cache_hits_total", "counter", "Token cache hits.", token_cache.hits
+    yield "chat_token_cache_misses_total", "counter", "Token cache misses.", token_cache.misses
+    yield "chat_user_map_size", "gauge", "Users in the id/username map.", len(user_map)
+    yield "chat_user_map_hits_total", "counter", "Id/username lookups served by the map.", user_map.hits
+    yield "chat_user_map_misses_total", "counter", "Id/username lookups that went to the database.", user_map.misses
+    yield "chat_write_queue_depth", "gauge", "Rows waiting in the write-behind queue.", write_queue.qsize()
+    yield "chat_write_queue_written_total", "counter", "Rows written by the write-behind queue.", write_queue.written
+    yield (
+        "chat_write_queue_failed_total", "counter",
+        "Rows the database refused, reported to their senders.", write_queue.failed,
+    )
+
+
+registry.add_collector(_component_metrics)
+
+
+def log_actions():
+    """Whether per-message info logging on the WebSocket hot paths is on."""
+    return getattr(settings, "CHAT_LOG_ACTIONS", True)
@@ -1,16 +1,70 @@
+import hashlib
+import time
+from collections import OrderedDict
 from urllib.parse import parse_qs
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from channels.db import database_sync_to_async
 from rest_framework_simplejwt.tokens import AccessToken, TokenError
 from django.contrib.auth import get_user_model
 import logging
+from . import metrics
+from .executors import database_read
 
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
-@database_sync_to_async
-def get_user(token_key):
+class TokenCache:
+    """
+    Bounded LRU of verified access tokens, keyed by the token's SHA-256 so raw
+    tokens are never kept in memory. Each entry remembers the token's expiry
+    and the user row it resolved to, so a repeat handshake with the same token
+    skips both signature verification and the user lookup. User rows are
+    refreshed after `user_ttl` seconds so deactivations are picked up.
+    """
+
+    def __init__(self, max_entries=10000, user_ttl=60):
+        self.max_entries = max_entries
+        self.user_ttl = user_ttl
+        self._entries = OrderedDict()  # token hash -> (token expiry, user, user fetched at)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token_key):
+        return hashlib.sha256(token_key.encode()).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is None or entry[0] <= now or entry[2] + self.user_ttl <= now:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, expires_at, user):
+        self._entries[key] = (expires_at, user, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_token_cache_options = getattr(settings, "CHAT_TOKEN_CACHE", {})
+token_cache = TokenCache(
+    max_entries=_token_cache_options.get("MAX_ENTRIES", 10000),
+    user_ttl=_token_cache_options.get("USER_TTL", 60),
+)
+
+@database_read
+def verify_token(token_key):
+    """
+    Validate the token and load its user. Returns (user, token expiry), with
+    an expiry of None when the result must not be cached.
+    """
     from django.contrib.auth import get_user_model
     User = get_user_model()
     
@@ -20,14 +74,29 @@ def get_user(token_key):
         user_id = token.payload.get('user_id')
         
         if user_id:
-            return User.objects.get(id=user_id)
-        return AnonymousUser()
+            return User.objects.get(id=user_id), token.payload.get('exp')
+        return AnonymousUser(), None
     except (TokenError, User.DoesNotExist) as e:
         logger.error(f"Invalid token or user does not exist: {e}")
-        return AnonymousUser()
+        return AnonymousUser(), None
     except Exception as e:
         logger.error(f"Token authentication error: {e}")
-        return AnonymousUser()
+        return AnonymousUser(), None
+
+async def get_user(token_key):
+    """
+    Resolve a token to a user, from the token cache when possible. Returns
+    (user, whether it came from the cache).
+    """
+    key = TokenCache.key(token_key)
+    user = token_cache.get(key)
+    if user is not None:
+        return user, True
+
+    user, expires_at = await verify_token(token_key)
+    if expires_at:
+        token_cache.set(key, expires_at, user)
+    return user, False
 
 class TokenAuthMiddleware:
     def __init__(self, app):
@@ -35,22 +104,25 @@ class TokenAuthMiddleware:
 
     async def __call__(self, scope, receive, send):
         # Extract query params from URL
-        query_string = scope.get("query_string", b"").decode()
-        params = {}
-        
-        # Parse query string
-        for param in query_string.split('&'):
-            if param:
-                key_value = param.split('=')
-                if len(key_value) == 2:
-                    params[key_value[0]] = key_value[1]
+        params = parse_qs(scope.get("query_string", b"").decode())
         
         # Check for token
-        token = params.get("token", None)
+        token = params.get("token", [None])[0]
         
         if token:
-            scope["user"] = await get_user(token)
-            logger.info(f"WebSocket authenticated user: {scope['user']}")
+            started = time.perf_counter()
+            action = metrics.current_action.set("authenticate")
+            try:
+                scope["user"], cached = await get_user(token)
+            finally:
+                metrics.current_action.reset(action)
+            elapsed = time.perf_counter() - started
+            result = "cached" if cached else "verified"
+            metrics.auth_seconds.observe(elapsed, result)
+            if metrics.log_actions():
+                logger.info(
+                    f"WebSocket authenticated user: {scope['user']} in {elapsed * 1000:.2f} ms ({result})"
+                )
         else:
             scope["user"] = AnonymousUser()
             logger.warning("Anonymous WebSocket connection")
@@ -0,0 +1,70 @@
+# Generated by Django 5.1.7 on 2026-10-16 22:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+STATUS_CODES = {
+    'pending': 1,
+    'approved': 2,
+    'rejected': 3,
+}
+
+
+def status_to_code(apps, schema_editor):
+    UserConnection = apps.get_model('chat', 'UserConnection')
+    db_alias = schema_editor.connection.alias
+    for status, code in STATUS_CODES.items():
+        UserConnection.objects.using(db_alias).filter(status=status).update(status_code=code)
+
+
+def code_to_status(apps, schema_editor):
+    UserConnection = apps.get_model('chat', 'UserConnection')
+    db_alias = schema_editor.connection.alias
+    for status, code in STATUS_CODES.items():
+        UserConnection.objects.using(db_alias).filter(status_code=code).update(status=status)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userconnection',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (2, 'Approved'), (3, 'Rejected')], default=1),
+        ),
+        migrations.RunPython(status_to_code, code_to_status),
+        migrations.RemoveField(
+            model_name='userconnection',
+            name='status',
+        ),
+        migrations.RenameField(
+            model_name='userconnection',
+            old_name='status_code',
+            new_name='status',
+        ),
+        migrations.AlterField(
+            model_name='userconnection',
+            name='receiver',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='received_connections', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='userconnection',
+            name='sender',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_connections', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='userconnection',
+            index=models.Index(fields=['receiver', 'status'], name='chat_conn_receiver_status'),
+        ),
+        migrations.AddIndex(
+            model_name='userconnection',
+            index=models.Index(fields=['sender', 'status'], name='chat_conn_sender_status'),
+        ),
+    ]
@@ -1,21 +1,50 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class UserConnection(models.Model):
-    STATUS_CHOICES = (
-        ('pending', 'Pending'),
-        ('approved', 'Approved'),
-        ('rejected', 'Rejected'),
-    )
+    class Status(models.IntegerChoices):
+        PENDING = 1, 'Pending'
+        APPROVED = 2, 'Approved'
+        REJECTED = 3, 'Rejected'
+
+    STATUS_CHOICES = Status.choices
     
-    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_connections')
-    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_connections')
-    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # The (sender, receiver) unique index and the (receiver, status) index
+    # below cover lookups by either foreign key, so no single-column indexes.
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_connections', db_index=False)
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_connections', db_index=False)
+    status = models.PositiveSmallIntegerField(choices=Status.choices, default=Status.PENDING)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         unique_together = ('sender', 'receiver')
+        indexes = [
+            models.Index(fields=['receiver', 'status'], name='chat_conn_receiver_status'),
+            models.Index(fields=['sender', 'status'], name='chat_conn_sender_status'),
+        ]
         
     def __str__(self):
-        return f"{self.sender.username} -> {self.receiver.username} ({self.status})"
+        return f"{self.sender.username} -> {self.receiver.username} ({self.get_status_display()})"
+
+class Message(models.Model):
+    # "<lower user id>:<higher user id>", identical for both directions
+    conversation = models.CharField(max_length=41)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
+    body = models.TextField()
+    # Set when the message is accepted, not when a batch reaches the database
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'created_at'], name='chat_msg_conversation_created'),
+        ]
+
+    @staticmethod
+    def conversation_key(user_id, other_user_id):
+        return f"{min(user_id, other_user_id)}:{max(user_id, other_user_id)}"
+
+    def __str__(self):
+        return f"{self.sender.username} -> {self.recipient.username}: {self.body[:50]}"
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def notification_event(events):
+    """Channel-layer event delivering a batch of notifications to a user group."""
+    return {"type": "connection_notification", "events": events}
+
+
+class NotificationCoalescer:
+    """
+    Buffers notifications per target group for a short window and delivers
+    each burst as a single `connection_notification` event carrying the list
+    of events, so the receiving sockets refresh once per burst rather than
+    once per event. A zero window sends every event straight away.
+    """
+
+    def __init__(self, window=0.05, max_events=100):
+        self.window = window
+        self.max_events = max_events
+        self._pending = {}  # group name -> list of events
+        self._flushes = {}  # group name -> scheduled flush task
+        self._channel_layers = {}  # group name -> channel layer to send through
+
+    async def publish(self, channel_layer, group_name, event):
+        if self.window <= 0:
+            await metrics.group_send(channel_layer, group_name, notification_event([event]))
+            return
+
+        events = self._pending.setdefault(group_name, [])
+        events.append(event)
+        self._channel_layers[group_name] = channel_layer
+        if len(events) >= self.max_events:
+            await self.flush(group_name)
+        elif group_name not in self._flushes:
+            self._flushes[group_name] = asyncio.ensure_future(self._flush_later(group_name))
+
+    async def publish_many(self, channel_layer, group_names, event):
+        """
+        Publish the same event to several groups, such as everyone a bulk
+        action touched. Unbuffered sends go out concurrently.
+        """
+        if self.window <= 0:
+            await send_many(channel_layer, group_names, notification_event([event]))
+            return
+        for group_name in group_names:
+            await self.publish(channel_layer, group_name, event)
+
+    async def flush(self, group_name):
+        task = self._flushes.pop(group_name, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        events = self._pending.pop(group_name, None)
+        channel_layer = self._channel_layers.pop(group_name, None)
+        if events:
+            await metrics.group_send(channel_layer, group_name, notification_event(events))
+
+    async def flush_all(self):
+        for group_name in list(self._pending):
+            await self.flush(group_name)
+
+    async def _flush_later(self, group_name):
+        await asyncio.sleep(self.window)
+        try:
+            await self.flush(group_name)
+        except Exception as e:
+            logger.error(f"Error flushing notifications for {group_name}: {e}")
+
+
+coalescer = NotificationCoalescer(
+    window=getattr(settings, "CHAT_NOTIFICATION_COALESCE_WINDOW", 0.05),
+    max_events=getattr(settings, "CHAT_NOTIFICATION_MAX_BATCH", 100),
+)
+
+
+async def send_many(channel_layer, group_names, event):
+    await asyncio.gather(*(metrics.group_send(channel_layer, group_name, event) for group_name in group_names))
+
+
+def notify(user_id, message):
+    """
+    Send one notification from sync code such as the REST views. There is no
+    event loop here to buffer on, so it goes out at once in the same batched
+    format the coalescer uses.
+    """
+    channel_layer = get_channel_layer()
+    async_to_sync(metrics.group_send)(
+        channel_layer,
+        f"user_{user_id}",
+        notification_event([{"message": message}]),
+    )
+
+
+def notify_many(user_ids, message):
+    """`notify` for several users, with one hop into the event loop for all of them."""
+    async_to_sync(send_many)(
+        get_channel_layer(),
+        [f"user_{user_id}" for user_id in user_ids],
+        notification_event([{"message": message}]),
+    )
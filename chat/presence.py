@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import codec, metrics, services
+from .executors import database_read
+from .usernames import user_map
+
+logger = logging.getLogger(__name__)
+
+
+class LocalPresenceStore:
+    """
+    Live sockets per user for a single worker process: user id -> channel
+    name -> time of the socket's last heartbeat.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._sockets = {}
+
+    def add(self, user_id, channel_name):
+        self._sockets.setdefault(user_id, {})[channel_name] = time.time()
+        return self.count(user_id)
+
+    def touch(self, user_id, channel_name):
+        sockets = self._sockets.get(user_id)
+        if sockets is not None and channel_name in sockets:
+            sockets[channel_name] = time.time()
+
+    def remove(self, user_id, channel_name):
+        sockets = self._sockets.get(user_id, {})
+        sockets.pop(channel_name, None)
+        if not sockets:
+            self._sockets.pop(user_id, None)
+        return self.count(user_id)
+
+    def count(self, user_id):
+        cutoff = time.time() - self.ttl
+        return sum(1 for seen in self._sockets.get(user_id, {}).values() if seen > cutoff)
+
+    def online(self, user_ids):
+        return {user_id for user_id in user_ids if self.count(user_id)}
+
+
+class RedisPresenceStore:
+    """
+    Live sockets per user shared by all workers: one sorted set per user of
+    channel names scored by last heartbeat. Sockets of a worker that died stop
+    counting once their heartbeat is older than `ttl`.
+    """
+
+    def __init__(self, ttl, client=None, location="redis://localhost:6379/0", prefix="chat:presence"):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(location)
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, user_id):
+        return f"{self.prefix}:{user_id}"
+
+    def _count(self, pipe, user_id):
+        key = self._key(user_id)
+        pipe.zremrangebyscore(key, "-inf", time.time() - self.ttl)
+        pipe.zcard(key)
+        pipe.expire(key, 2 * self.ttl)
+
+    def add(self, user_id, channel_name):
+        pipe = self.client.pipeline()
+        pipe.zadd(self._key(user_id), {channel_name: time.time()})
+        self._count(pipe, user_id)
+        return pipe.execute()[-2]
+
+    def touch(self, user_id, channel_name):
+        self.client.zadd(self._key(user_id), {channel_name: time.time()})
+
+    def remove(self, user_id, channel_name):
+        pipe = self.client.pipeline()
+        pipe.zrem(self._key(user_id), channel_name)
+        self._count(pipe, user_id)
+        return pipe.execute()[-2]
+
+    def count(self, user_id):
+        pipe = self.client.pipeline()
+        self._count(pipe, user_id)
+        return pipe.execute()[-2]
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self._key(user_id), time.time() - self.ttl, "+inf")
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+
+class PresenceTracker:
+    """
+    Tracks which users have at least one live socket and tells their mutual
+    connections, and only them, when that changes.
+
+    A socket is live from `connect` until `disconnect`, as long as it keeps
+    sending `ping` heartbeats within the store's ttl. Going offline is
+    debounced: it is only published if the user is still offline `debounce`
+    seconds later, so reconnects and tab reloads cause no fan-out at all.
+    """
+
+    def __init__(self, store, debounce=5.0, sweep_interval=30.0):
+        self.store = store
+        self.debounce = debounce
+        self.sweep_interval = sweep_interval
+        self._pending_offline = {}  # user id -> debounce task
+        self._local = {}  # channel name -> user, for sockets in this process
+        self._timed_out = set()  # user ids published offline for missing heartbeats
+        self._sweeper = None
+
+    async def _call_store(self, method, *args):
+        # The in-process store is a dict; only a networked store needs a thread
+        if isinstance(self.store, LocalPresenceStore):
+            return method(*args)
+        return await sync_to_async(method, thread_sensitive=False)(*args)
+
+    async def connect(self, user, channel_name, channel_layer):
+        self._local[channel_name] = user
+        self._ensure_sweeper(channel_layer)
+        count = await self._call_store(self.store.add, user.id, channel_name)
+
+        pending = self._pending_offline.pop(user.id, None)
+        if pending is not None:
+            # Back before the debounce ran out; peers never saw them leave
+            pending.cancel()
+        elif count == 1:
+            await self._publish(user, True, channel_layer)
+
+    async def heartbeat(self, user, channel_name, channel_layer):
+        await self._call_store(self.store.touch, user.id, channel_name)
+        if user.id in self._timed_out:
+            self._timed_out.discard(user.id)
+            await self._publish(user, True, channel_layer)
+
+    async def disconnect(self, user, channel_name, channel_layer):
+        self._local.pop(channel_name, None)
+        remaining = await self._call_store(self.store.remove, user.id, channel_name)
+        if not remaining and user.id not in self._pending_offline and user.id not in self._timed_out:
+            self._pending_offline[user.id] = asyncio.ensure_future(
+                self._publish_offline_later(user, channel_layer)
+            )
+        if not any(local.id == user.id for local in self._local.values()):
+            self._timed_out.discard(user.id)
+
+    async def online_connections(self, user):
+        """Usernames of the user's mutual connections that are online."""
+        peers = dict(await self._mutual_connection_ids(user))
+        online = await self._call_store(self.store.online, list(peers))
+        return sorted(peers[user_id] for user_id in online)
+
+    @database_read
+    def _mutual_connection_ids(self, user):
+        mutual = services.get_relationship_snapshot(user)["mutual_connections"]
+        return [(user_id, username) for username, user_id in user_map.ids_for(mutual).items()]
+
+    async def _publish_offline_later(self, user, channel_layer):
+        try:
+            await asyncio.sleep(self.debounce)
+            if not await self._call_store(self.store.count, user.id):
+                await self._publish(user, False, channel_layer)
+        finally:
+            if self._pending_offline.get(user.id) is asyncio.current_task():
+                del self._pending_offline[user.id]
+
+    async def _publish(self, user, online, channel_layer):
+        # Encoded once for all peers; their sockets forward it as is
+        frame = {"type": "presence_update", "username": user.username, "online": online}
+        event = {"type": "presence_update", **codec.encode_broadcast(frame)}
+        for peer_id, _ in await self._mutual_connection_ids(user):
+            await metrics.group_send(channel_layer, f"user_{peer_id}", event)
+
+    def _ensure_sweeper(self, channel_layer):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep(channel_layer))
+
+    async def _sweep(self, channel_layer):
+        # Users whose sockets in this process all stopped sending heartbeats
+        # are published offline until one of them pings again
+        while self._local:
+            await asyncio.sleep(self.sweep_interval)
+            users = {user.id: user for user in self._local.values()}
+            for user_id, user in users.items():
+                if user_id in self._timed_out or user_id in self._pending_offline:
+                    continue
+                try:
+                    if not await self._call_store(self.store.count, user_id):
+                        self._timed_out.add(user_id)
+                        await self._publish(user, False, channel_layer)
+                except Exception as e:
+                    logger.error(f"Error sweeping presence for {user}: {e}")
+
+
+def _build_tracker():
+    options = getattr(settings, "CHAT_PRESENCE", {})
+    ttl = options.get("TTL", 90)
+    # A shared store is needed once there is more than one worker process
+    if options.get("LOCATION"):
+        store = RedisPresenceStore(ttl, location=options["LOCATION"])
+    else:
+        store = LocalPresenceStore(ttl)
+    return PresenceTracker(
+        store,
+        debounce=options.get("DEBOUNCE", 5.0),
+        sweep_interval=options.get("SWEEP_INTERVAL", ttl / 3),
+    )
+
+
+presence = _build_tracker()
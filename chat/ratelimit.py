@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+SOCKET = "SOCKET"
+USER = "USER"
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self):
+        """Seconds until a token is available; 0 when one is available now."""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token-bucket limits per action, checked per socket and per user. Limits
+    come from a mapping of action name (or "DEFAULT") to {"SOCKET": (rate,
+    burst), "USER": (rate, burst)}, where None leaves that scope unlimited.
+
+    Socket buckets live on the consumer (see `socket_buckets`); user buckets
+    are shared by all of a user's sockets in this process and kept for the
+    `max_users` most recently active (user, action) pairs.
+    """
+
+    def __init__(self, limits, max_users=100000):
+        self.limits = limits
+        self.max_users = max_users
+        self._user_buckets = OrderedDict()  # (user id, action) -> TokenBucket
+
+    def socket_buckets(self):
+        """Bucket store for one socket, to pass back to `check`."""
+        return {}
+
+    def _limit(self, action, scope):
+        return self.limits.get(action, self.limits.get("DEFAULT", {})).get(scope)
+
+    def _bucket(self, store, key, limit, now):
+        bucket = store.get(key)
+        if bucket is None:
+            # Full as of `now`, which refill is then called with
+            bucket = store[key] = TokenBucket(*limit, now)
+        return bucket
+
+    def check(self, user_id, socket_buckets, action):
+        """
+        Take a token for `action` from both the socket's and the user's
+        bucket. Returns None if allowed, otherwise (scope, seconds to wait),
+        in which case no token is taken from either.
+        """
+        now = time.monotonic()
+        buckets = []
+
+        limit = self._limit(action, SOCKET)
+        if limit:
+            buckets.append((SOCKET, self._bucket(socket_buckets, action, limit, now)))
+        limit = self._limit(action, USER)
+        if limit and user_id is not None:
+            key = (user_id, action)
+            buckets.append((USER, self._bucket(self._user_buckets, key, limit, now)))
+            self._user_buckets.move_to_end(key)
+            while len(self._user_buckets) > self.max_users:
+                self._user_buckets.popitem(last=False)
+
+        for scope, bucket in buckets:
+            bucket.refill(now)
+            wait = bucket.retry_after()
+            if wait:
+                return scope, wait
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+
+rate_limiter = RateLimiter(getattr(settings, "CHAT_RATE_LIMITS", {}))
@@ -0,0 +1,245 @@
+import bisect
+import heapq
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+
+from . import deltas, services
+from .models import UserConnection
+from .singleflight import SharedResults
+from .usernames import user_map
+
+
+def trigrams(text):
+    """Trigrams of `text`, lowercased and padded the way pg_trgm does."""
+    padded = f"  {text.lower()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """
+    In-memory username search. Prefix matches come from a sorted list of
+    (lowercased username, username) searched with bisect; with `fuzzy`,
+    usernames sharing enough trigrams with the query (Jaccard similarity of
+    at least `threshold`) fill up what prefix matching leaves.
+
+    Built from the user table on first use, then kept current by user saves
+    and deletes in this process. Users registered through another process
+    show up at the latest `refresh_interval` seconds later, when the index
+    is rebuilt.
+    """
+
+    def __init__(self, fuzzy=True, threshold=0.3, max_candidates=2000, refresh_interval=300):
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.max_candidates = max_candidates
+        self.refresh_interval = refresh_interval
+        self._keys = []  # sorted (lowercased username, username)
+        self._grams = {}  # trigram -> set of usernames
+        self._built_at = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def _ensure_built(self):
+        built_at = self._built_at
+        if built_at is not None and time.monotonic() - built_at < self.refresh_interval:
+            return
+        # Only the first build makes searches wait; during a refresh they
+        # keep using the current index
+        if not self._build_lock.acquire(blocking=built_at is None):
+            return
+        try:
+            if self._built_at != built_at:
+                return  # another thread just built it
+            usernames = User.objects.values_list("username", flat=True).iterator(chunk_size=10000)
+            keys = sorted((username.lower(), username) for username in usernames)
+            grams = {}
+            if self.fuzzy:
+                for _, username in keys:
+                    for gram in trigrams(username):
+                        grams.setdefault(gram, set()).add(username)
+            with self._lock:
+                self._keys, self._grams = keys, grams
+                self._built_at = time.monotonic()
+        finally:
+            self._build_lock.release()
+
+    def add(self, username):
+        with self._lock:
+            if self._built_at is None:
+                return  # picked up by the first build
+            entry = (username.lower(), username)
+            position = bisect.bisect_left(self._keys, entry)
+            if position < len(self._keys) and self._keys[position] == entry:
+                return
+            self._keys.insert(position, entry)
+            if self.fuzzy:
+                for gram in trigrams(username):
+                    self._grams.setdefault(gram, set()).add(username)
+
+    def remove(self, username):
+        with self._lock:
+            entry = (username.lower(), username)
+            position = bisect.bisect_left(self._keys, entry)
+            if position < len(self._keys) and self._keys[position] == entry:
+                del self._keys[position]
+            for gram in trigrams(username) if self.fuzzy else ():
+                postings = self._grams.get(gram)
+                if postings is not None:
+                    postings.discard(username)
+
+    def search(self, query, limit=20, fuzzy=True, exclude=None):
+        """Up to `limit` usernames for `query`: prefix matches first, then fuzzy ones."""
+        self._ensure_built()
+        prefix = query.lower()
+        with self._lock:
+            results = []
+            position = bisect.bisect_left(self._keys, (prefix,))
+            while len(results) < limit and position < len(self._keys):
+                key, username = self._keys[position]
+                if not key.startswith(prefix):
+                    break
+                if username != exclude:
+                    results.append(username)
+                position += 1
+
+            if fuzzy and self.fuzzy and len(results) < limit:
+                seen = set(results)
+                seen.add(exclude)
+                results.extend(
+                    username for username in self._similar(query, limit - len(results) + len(seen))
+                    if username not in seen
+                )
+        return results[:limit]
+
+    def _similar(self, query, limit):
+        # Candidates come from the query's rarest trigrams first, so a common
+        # trigram cannot make one search scan a large share of all users
+        grams = trigrams(query)
+        candidates = set()
+        for gram in sorted(grams, key=lambda gram: len(self._grams.get(gram, ()))):
+            for username in self._grams.get(gram, ()):
+                candidates.add(username)
+                if len(candidates) >= self.max_candidates:
+                    break
+            if len(candidates) >= self.max_candidates:
+                break
+
+        scored = []
+        for username in candidates:
+            other = trigrams(username)
+            score = len(grams & other) / len(grams | other)
+            if score >= self.threshold:
+                scored.append((-score, username))
+        return [username for _, username in heapq.nsmallest(limit, scored)]
+
+
+def _build_index():
+    options = getattr(settings, "CHAT_SEARCH", {})
+    return SearchIndex(
+        fuzzy=options.get("FUZZY", True),
+        threshold=options.get("THRESHOLD", 0.3),
+        max_candidates=options.get("MAX_CANDIDATES", 2000),
+        refresh_interval=options.get("REFRESH_INTERVAL", 300),
+    )
+
+
+search_index = _build_index()
+
+
+def max_results():
+    return getattr(settings, "CHAT_SEARCH", {}).get("MAX_RESULTS", 50)
+
+
+def get_limit(requested=None):
+    """Clamp a client-supplied result count to CHAT_SEARCH["MAX_RESULTS"]."""
+    try:
+        limit = int(requested) if requested is not None else 20
+    except (TypeError, ValueError):
+        limit = 20
+    return max(1, min(limit, max_results()))
+
+
+def _user_saved(sender, instance, created, **kwargs):
+    if created:
+        search_index.add(instance.username)
+
+
+def _user_deleted(sender, instance, **kwargs):
+    search_index.remove(instance.username)
+
+
+post_save.connect(_user_saved, sender=User, dispatch_uid="chat_search_index_save")
+post_delete.connect(_user_deleted, sender=User, dispatch_uid="chat_search_index_delete")
+
+
+_suggestion_options = getattr(settings, "CHAT_SUGGESTIONS", {})
+# Per user, for the largest limit; suggestions drift slowly as friends make
+# connections, so a stale list for a while is fine, but one predating the
+# user's own connections is not (see _relationships_changed)
+suggestion_results = SharedResults(
+    "suggestions",
+    ttl=_suggestion_options.get("TTL", 60),
+    max_entries=_suggestion_options.get("MAX_ENTRIES", 10000),
+)
+
+
+def get_suggestions(user, limit=20):
+    """`suggest_users`, cached per user for CHAT_SUGGESTIONS["TTL"] seconds."""
+    suggestions = suggestion_results.get(
+        user.id,
+        lambda: suggest_users(user, services.get_relationship_snapshot(user), max_results()),
+    )
+    return suggestions[:limit]
+
+
+def _relationships_changed(changes):
+    suggestion_results.discard(*changes)
+
+
+deltas.journal.subscribe(_relationships_changed)
+
+
+def suggest_users(user, snapshot, limit=20):
+    """
+    Friends of friends of `user` not yet connected to them, as [{"username",
+    "mutual"}] with the most mutual connections first. `snapshot` is the
+    user's relationship snapshot.
+
+    Cost is bounded: at most MAX_FRIENDS of the user's connections are
+    expanded and at most MAX_EDGES of their connections read, in one query.
+    """
+    max_friends = _suggestion_options.get("MAX_FRIENDS", 100)
+    max_edges = _suggestion_options.get("MAX_EDGES", 10000)
+
+    friends = list(user_map.ids_for(snapshot["mutual_connections"][:max_friends]).values())
+    if not friends:
+        return []
+    known = set(friends)
+    known.add(user.id)
+    known.update(user_map.ids_for(snapshot["sent_requests"] + snapshot["pending_requests"]).values())
+
+    edges = UserConnection.objects.filter(
+        Q(sender_id__in=friends) | Q(receiver_id__in=friends),
+        status=UserConnection.Status.APPROVED,
+    ).values_list("sender_id", "receiver_id")[:max_edges]
+    friend_set = set(friends)
+    counts = Counter()
+    for sender_id, receiver_id in edges:
+        # An edge between two friends counts for neither
+        if sender_id in friend_set and receiver_id not in known:
+            counts[receiver_id] += 1
+        if receiver_id in friend_set and sender_id not in known:
+            counts[sender_id] += 1
+
+    top = heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+    usernames = user_map.usernames_for([user_id for user_id, _ in top])
+    return [
+        {"username": usernames[user_id], "mutual": count}
+        for user_id, count in top if user_id in usernames
+    ]
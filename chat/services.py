@@ -0,0 +1,417 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import deltas
+from .cache import relationship_cache
+from .models import Message, UserConnection
+from .singleflight import SharedResults
+from .usernames import user_map
+
+# Sorts after every other character, so `prefix + PREFIX_UPPER_BOUND` is an
+# exclusive upper bound for all usernames starting with `prefix`
+PREFIX_UPPER_BOUND = "\U0010ffff"
+
+# Directory pages are the same for everyone but the requester, so one query
+# serves every request for the same page within the window
+directory_pages = SharedResults(
+    "directory_page",
+    ttl=getattr(settings, "CHAT_DIRECTORY_SHARE_WINDOW", 1.0),
+)
+
+
+def get_page_size(requested=None):
+    """Clamp a client-supplied page size to the configured limits."""
+    default = getattr(settings, "CHAT_DIRECTORY_PAGE_SIZE", 100)
+    maximum = getattr(settings, "CHAT_DIRECTORY_MAX_PAGE_SIZE", 500)
+    try:
+        page_size = int(requested) if requested is not None else default
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, maximum))
+
+
+def get_directory_page(user, cursor=None, prefix=None, page_size=None):
+    """
+    Return one page of the user directory, ordered by username.
+
+    Pagination is keyset based: `cursor` is the last username of the previous
+    page, so every page is a range scan on the unique username index no matter
+    how deep the client pages. `prefix` narrows the range the same way.
+
+    The page is cut from a shared page of everyone (see `directory_pages`)
+    with the requesting user taken out.
+    """
+    page_size = get_page_size(page_size)
+    usernames = [
+        username for username in directory_pages.get(
+            (cursor, prefix, page_size),
+            lambda: _fetch_directory_page(cursor, prefix, page_size),
+        )
+        if username != user.username
+    ]
+
+    next_cursor = None
+    if len(usernames) > page_size:
+        usernames = usernames[:page_size]
+        next_cursor = usernames[-1]
+
+    return {"users": usernames, "next_cursor": next_cursor}
+
+
+def _fetch_directory_page(cursor, prefix, page_size):
+    users = User.objects.all()
+    if prefix:
+        users = users.filter(username__gte=prefix, username__lt=prefix + PREFIX_UPPER_BOUND)
+    if cursor:
+        users = users.filter(username__gt=cursor)
+
+    # One extra row to learn whether another page exists, and one more in
+    # case the requester is on the page and gets removed from it
+    rows = list(users.order_by("username").values_list("id", "username")[:page_size + 2])
+    # Id-mode sockets need the ids of everyone on the page
+    user_map.update(rows)
+    return tuple(username for _, username in rows)
+
+
+def get_relationship_snapshot(user):
+    """
+    Return the user's sent requests, pending requests and mutual connections.
+
+    Served from the relationship cache when possible. Otherwise all of the
+    user's connections are fetched in a single query and partitioned here,
+    instead of one query per list. The query selects bare ids; usernames
+    come from the user map.
+    """
+    snapshot = relationship_cache.get(user.id)
+    if snapshot is not None:
+        return snapshot
+
+    token = relationship_cache.begin_load(user.id)
+    sent_requests = []
+    pending_requests = []
+    mutual_connections = []
+
+    connections = list(UserConnection.objects.filter(
+        Q(sender=user) | Q(receiver=user)
+    ).values_list("sender_id", "receiver_id", "status"))
+    usernames = user_map.usernames_for({
+        receiver_id if sender_id == user.id else sender_id
+        for sender_id, receiver_id, _ in connections
+    })
+
+    for sender_id, receiver_id, status in connections:
+        outgoing = sender_id == user.id
+        peer = usernames.get(receiver_id if outgoing else sender_id)
+        if peer is None:
+            # Deleted since the query ran
+            continue
+        if status == UserConnection.Status.APPROVED:
+            mutual_connections.append(peer)
+        elif status == UserConnection.Status.PENDING:
+            (sent_requests if outgoing else pending_requests).append(peer)
+
+    snapshot = {
+        "sent_requests": sent_requests,
+        "pending_requests": pending_requests,
+        "mutual_connections": mutual_connections,
+    }
+    relationship_cache.set(user.id, snapshot, token)
+    return snapshot
+
+
+def get_user_lists(user, cursor=None, prefix=None, page_size=None):
+    """
+    Everything an `update_users` snapshot needs: one directory page and the
+    relationship lists. Meant to be called from a single sync-to-async hop.
+    """
+    page = get_directory_page(user, cursor=cursor, prefix=prefix, page_size=page_size)
+    return {
+        "users": page["users"],
+        "users_next_cursor": page["next_cursor"],
+        **get_relationship_snapshot(user),
+    }
+
+
+def resolve_user(reference):
+    """
+    Unsaved User carrying just the id and username of the user `reference`
+    names, by username or (from id-mode clients) by id. Raises
+    User.DoesNotExist if there is no such user.
+    """
+    if isinstance(reference, int):
+        user_id, username = reference, user_map.username_for(reference)
+    else:
+        user_id, username = user_map.id_for(reference), reference
+    if user_id is None or username is None:
+        raise User.DoesNotExist(f"User {reference} not found")
+    return User(id=user_id, username=username)
+
+
+def replace_usernames(data, fields):
+    """
+    Copy of `data` with the lists of usernames under `fields` replaced by
+    user ids, for id-mode clients. Users deleted in the meantime drop out.
+    """
+    ids = user_map.ids_for({username for field in fields for username in data[field]})
+    return {
+        **data,
+        **{field: [ids[username] for username in data[field] if username in ids] for field in fields},
+    }
+
+
+def send_connection_request(user, receiver_username):
+    """
+    Create a pending request from `user` to `receiver_username` in a single
+    INSERT that does nothing if a request between them in that direction
+    already exists. Returns the receiver's id if one was created, None if
+    not; raises User.DoesNotExist for unknown usernames. Like the other
+    transitions, it also takes a user id in place of the username.
+    """
+    receiver = resolve_user(receiver_username)
+    if not insert_pending(user.id, receiver.id):
+        return None
+    deltas.record_request_sent(user, receiver)
+    return receiver.id
+
+
+def insert_pending(sender_id, receiver_id, using=DEFAULT_DB_ALIAS):
+    """
+    The INSERT behind send_connection_request, without the journal. Returns
+    whether a row was created.
+    """
+    database = connections[using]
+    # Raw SQL skips the field's conversion; store the value as the ORM would
+    now = database.ops.adapt_datetimefield_value(timezone.now())
+    table = UserConnection._meta.db_table
+    with database.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO "{table}" (sender_id, receiver_id, status, created_at, updated_at) '
+            "VALUES (%s, %s, %s, %s, %s) ON CONFLICT (sender_id, receiver_id) DO NOTHING",
+            [sender_id, receiver_id, UserConnection.Status.PENDING, now, now],
+        )
+        return cursor.rowcount == 1
+
+
+def approve_connection_request(user, sender_username):
+    """
+    Approve the pending request from `sender_username` to `user` with one
+    conditional UPDATE. Returns the sender's id, or None if there was no
+    pending request; raises User.DoesNotExist for unknown usernames.
+    """
+    sender = resolve_user(sender_username)
+    if not approve_pending(sender.id, user.id):
+        return None
+    deltas.record_request_approved(sender, user)
+    return sender.id
+
+
+def approve_pending(sender_id, receiver_id, using=DEFAULT_DB_ALIAS):
+    """
+    The UPDATE behind approve_connection_request, without the journal.
+    Returns whether a pending request was approved.
+    """
+    return bool(UserConnection.objects.using(using).filter(
+        sender_id=sender_id, receiver_id=receiver_id, status=UserConnection.Status.PENDING
+    ).update(status=UserConnection.Status.APPROVED, updated_at=timezone.now()))
+
+
+def reject_connection_request(user, sender_username):
+    """
+    Delete the pending request from `sender_username` to `user` with one
+    conditional DELETE. Returns the sender's id, or None if there was no
+    pending request; raises User.DoesNotExist for unknown usernames.
+    """
+    sender = resolve_user(sender_username)
+    deleted = _delete_pending(user, [sender.id])
+    if not deleted:
+        return None
+    deltas.record_request_rejected(sender, user)
+    return sender.id
+
+
+def _delete_pending(user, sender_ids):
+    """
+    Delete the pending requests to `user` from `sender_ids` with one DELETE
+    that keeps the status condition, so a request approved meanwhile stays.
+    Returns the number of rows deleted.
+    """
+    pending = UserConnection.objects.filter(
+        sender_id__in=sender_ids, receiver_id=user.id, status=UserConnection.Status.PENDING
+    )
+    # QuerySet.delete() would SELECT the rows and delete them by id, as the
+    # journal's post_delete receiver rules out its fast path. Nothing
+    # cascades from a connection, and the callers record the change.
+    return pending._raw_delete(pending.db)
+
+
+def get_bulk_max_size():
+    return getattr(settings, "CHAT_BULK_MAX_SIZE", 500)
+
+
+def resolve_users(references):
+    """
+    {reference: unsaved User} for those of `references` (usernames or ids)
+    that name an existing user, with one map lookup for each kind.
+    """
+    names = [reference for reference in references if not isinstance(reference, int)]
+    ids = [reference for reference in references if isinstance(reference, int)]
+    users = {}
+    for username, user_id in user_map.ids_for(names).items():
+        users[username] = User(id=user_id, username=username)
+    for user_id, username in user_map.usernames_for(ids).items():
+        users[user_id] = User(id=user_id, username=username)
+    return users
+
+
+def _skipped(references, resolved, applied):
+    # References that did not resolve or whose user was not acted on
+    applied_ids = {user.id for user in applied}
+    return [
+        reference for reference in references
+        if reference not in resolved or resolved[reference].id not in applied_ids
+    ]
+
+
+def send_connection_requests(user, receivers):
+    """
+    Send requests from `user` to every one of `receivers` (usernames or
+    ids) without one yet, in one transaction: one SELECT for those that
+    exist and one multi-row INSERT. Returns (receivers sent to as unsaved
+    Users, references that were unknown or already requested).
+    """
+    resolved = resolve_users(receivers)
+    targets = {peer.id: peer for peer in resolved.values()}
+    with transaction.atomic():
+        existing = set(UserConnection.objects.filter(
+            sender_id=user.id, receiver_id__in=list(targets)
+        ).values_list("receiver_id", flat=True))
+        created = [peer for peer_id, peer in targets.items() if peer_id not in existing]
+        now = timezone.now()
+        UserConnection.objects.bulk_create(
+            [
+                UserConnection(
+                    sender_id=user.id,
+                    receiver_id=peer.id,
+                    status=UserConnection.Status.PENDING,
+                    created_at=now,
+                    updated_at=now,
+                )
+                for peer in created
+            ],
+            ignore_conflicts=True,
+        )
+    if created:
+        deltas.record_requests_sent(user, created)
+    return created, _skipped(receivers, resolved, created)
+
+
+def _pending_senders(user, senders):
+    # Locks the rows where the database supports it; on SQLite the
+    # transaction already holds the write lock
+    pending = UserConnection.objects.filter(receiver_id=user.id, status=UserConnection.Status.PENDING)
+    if senders is not None:
+        pending = pending.filter(sender_id__in=[peer.id for peer in senders.values()])
+    sender_ids = list(
+        pending.select_for_update().order_by("created_at").values_list("sender_id", flat=True)[:get_bulk_max_size()]
+    )
+    usernames = user_map.usernames_for(sender_ids)
+    return [User(id=sender_id, username=usernames[sender_id]) for sender_id in sender_ids if sender_id in usernames]
+
+
+def approve_connection_requests(user, senders=None):
+    """
+    Approve the pending requests to `user` from `senders` (usernames or
+    ids), or the oldest CHAT_BULK_MAX_SIZE pending ones when None, with one
+    SELECT and one UPDATE in a transaction. Returns (approved senders as
+    unsaved Users, references that were unknown or not pending).
+    """
+    resolved = resolve_users(senders) if senders is not None else None
+    with transaction.atomic():
+        approved = _pending_senders(user, resolved)
+        UserConnection.objects.filter(
+            receiver_id=user.id,
+            sender_id__in=[sender.id for sender in approved],
+            status=UserConnection.Status.PENDING,
+        ).update(status=UserConnection.Status.APPROVED, updated_at=timezone.now())
+    if approved:
+        deltas.record_requests_approved(approved, user)
+    return approved, [] if senders is None else _skipped(senders, resolved, approved)
+
+
+def reject_connection_requests(user, senders=None):
+    """Like `approve_connection_requests`, deleting the requests with one DELETE."""
+    resolved = resolve_users(senders) if senders is not None else None
+    with transaction.atomic():
+        rejected = _pending_senders(user, resolved)
+        _delete_pending(user, [sender.id for sender in rejected])
+    if rejected:
+        deltas.record_requests_rejected(rejected, user)
+    return rejected, [] if senders is None else _skipped(senders, resolved, rejected)
+
+
+def serialize_message(message, usernames):
+    """
+    Wire format of a message; `usernames` maps the participants' ids to names.
+    Messages still waiting in the write-behind queue have no id yet.
+    """
+    data = {
+        "sender": usernames[message.sender_id],
+        "recipient": usernames[message.recipient_id],
+        "body": message.body,
+        "created_at": message.created_at.isoformat(),
+    }
+    if message.id is not None:
+        data["id"] = message.id
+    return data
+
+
+def encode_history_cursor(message):
+    return f"{message.created_at.isoformat()}|{message.id}"
+
+
+def decode_history_cursor(cursor):
+    created_at, _, message_id = cursor.rpartition("|")
+    try:
+        return datetime.fromisoformat(created_at), int(message_id)
+    except ValueError:
+        raise ValueError("Invalid history cursor")
+
+
+def get_message_history(user, peer, before=None, user_ids=False):
+    """
+    Return one page of the conversation between `user` and `peer`, newest
+    first, older than the `before` cursor. Pages are a keyset range scan on
+    (conversation, created_at), so only one page is ever loaded regardless of
+    how long the conversation is. With `user_ids` the participants are given
+    by id rather than username.
+    """
+    page_size = getattr(settings, "CHAT_HISTORY_PAGE_SIZE", 50)
+    messages = Message.objects.filter(conversation=Message.conversation_key(user.id, peer.id))
+    if before:
+        created_at, message_id = decode_history_cursor(before)
+        messages = messages.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+        )
+
+    # The participants are known, so no join is needed for the usernames
+    page = list(messages.order_by("-created_at", "-id").only(
+        "id", "sender_id", "recipient_id", "body", "created_at"
+    )[:page_size + 1])
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = encode_history_cursor(page[-1])
+
+    if user_ids:
+        usernames = {user.id: user.id, peer.id: peer.id}
+    else:
+        usernames = {user.id: user.username, peer.id: peer.username}
+    return {
+        "messages": [serialize_message(message, usernames) for message in page],
+        "next_cursor": next_cursor,
+    }
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from . import metrics
+
+
+class SingleFlight:
+    """
+    Concurrent awaiters of the same key share one execution of the coroutine
+    function: the first caller starts it, later ones wait for its result (or
+    exception). Nothing is kept once it finishes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}  # key -> future
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self._flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._flights[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            metrics.coalesced.inc(self.name)
+        # A cancelled waiter must not cancel the shared work for the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error", "discarded")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        # Set when the key is discarded mid-flight: the value may predate
+        # the change, so it is returned but not kept
+        self.discarded = False
+
+
+class SharedResults:
+    """
+    Thread-safe counterpart of SingleFlight for sync code, which also keeps
+    each result for `ttl` seconds so that requests arriving shortly after
+    share it too. Callers must treat results as read-only.
+    """
+
+    def __init__(self, name, ttl, max_entries=1000):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._results = OrderedDict()  # key -> (expires at, value)
+        self._flights = {}  # key -> _Flight
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                metrics.coalesced.inc(self.name)
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            metrics.coalesced.inc(self.name)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None and not flight.discarded and self.ttl > 0:
+                    self._results[key] = (time.monotonic() + self.ttl, flight.value)
+                    self._results.move_to_end(key)
+                    while len(self._results) > self.max_entries:
+                        self._results.popitem(last=False)
+            flight.done.set()
+        return flight.value
+
+    def discard(self, *keys):
+        """Drop the results kept for `keys`, including any being computed."""
+        with self._lock:
+            for key in keys:
+                self._results.pop(key, None)
+                flight = self._flights.get(key)
+                if flight is not None:
+                    flight.discarded = True
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
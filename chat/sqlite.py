@@ -0,0 +1,47 @@
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Applied in order to every new SQLite connection. busy_timeout goes first
+# so that switching the journal mode waits for a lock rather than failing.
+DEFAULT_PRAGMAS = {
+    "busy_timeout": 20000,  # milliseconds to wait for a lock
+    # Readers see the last committed state and are never blocked by the
+    # writer (nor block it); persists in the database file once set
+    "journal_mode": "WAL",
+    # In WAL mode only a power loss can drop the latest commits, never
+    # corrupt the file; saves an fsync per commit
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,  # bytes of the file read through mmap
+    "cache_size": -16384,  # negative: KiB of page cache per connection
+    "temp_store": "MEMORY",
+}
+
+
+def pragmas_for(connection):
+    """
+    Pragmas for a connection: its DATABASES entry's "PRAGMAS" if given,
+    otherwise CHAT_SQLITE_PRAGMAS.
+    """
+    if "PRAGMAS" in connection.settings_dict:
+        return connection.settings_dict["PRAGMAS"]
+    return getattr(settings, "CHAT_SQLITE_PRAGMAS", DEFAULT_PRAGMAS)
+
+
+def configure_connection(sender, connection, **kwargs):
+    """connection_created receiver that tunes every new SQLite connection."""
+    if connection.vendor != "sqlite":
+        return
+    # Straight on the DB-API connection, so this is neither logged nor
+    # counted as a query of whatever action opened the connection
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in pragmas_for(connection).items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        if logger.isEnabledFor(logging.DEBUG):
+            cursor.execute("PRAGMA journal_mode")
+            logger.debug(f"SQLite connection to {connection.alias} configured, journal mode {cursor.fetchone()[0]}")
+    finally:
+        cursor.close()
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connections
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .layers import ShardedPubSubChannelLayer
+from .models import UserConnection
+
+ALIAS = "scaleout"
+USERNAME_PREFIX = "scaleout"
+# The prefix CHANNEL_LAYERS gives the sharded layer in backend/settings.py
+LAYER_PREFIX = "chat"
+
+
+class ClusterError(Exception):
+    pass
+
+
+class LocalCluster:
+    """
+    The multi-process deployment on one machine, for checking it end to end:
+    stand-in Redis servers (fakeredis) as channel layer shards, or real ones
+    from `redis`, `workers` daphne processes started by runworkers on
+    consecutive ports from `port`, and a scratch SQLite database seeded with
+    `users` users. Users 2k and 2k + 1 are mutual connections.
+
+    Use `start()` and `stop()`; `layer` then reaches the same shards as the
+    workers, and `open(user, worker)` connects a user's socket to a worker.
+    Needs the fakeredis package without `redis` and websockets for sockets.
+    """
+
+    def __init__(self, workers=3, shards=2, redis=None, users=6, port=8400, timeout=10.0):
+        self.workers = workers
+        self.shards = shards
+        self.redis = redis
+        self.user_count = users
+        self.port = port
+        self.timeout = timeout
+
+        self.brokers = []
+        self.process = None
+        self.directory = None
+        self.layer = None
+
+    @property
+    def ports(self):
+        return [self.port + index for index in range(self.workers)]
+
+    @property
+    def log_path(self):
+        return os.path.join(self.directory, "workers.log")
+
+    def start(self):
+        self.directory = tempfile.mkdtemp()
+        try:
+            self.hosts = self.redis or self._start_brokers()
+            path = os.path.join(self.directory, "scaleout.sqlite3")
+            self._seed(path)
+            self._start_workers(path)
+            self.layer = ShardedPubSubChannelLayer(hosts=self.hosts, prefix=LAYER_PREFIX)
+        except BaseException:
+            self.stop()
+            raise
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        for broker in self.brokers:
+            broker.shutdown()
+            broker.server_close()
+        self.brokers = []
+        if ALIAS in connections.databases:
+            connections[ALIAS].close()
+            del connections[ALIAS]
+            del connections.databases[ALIAS]
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def log_tail(self, lines=30):
+        with open(self.log_path) as log:
+            return "".join(log.readlines()[-lines:])
+
+    def _start_brokers(self):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise ClusterError("Install the 'fakeredis' package for stand-in Redis servers, or pass Redis URLs")
+        hosts = []
+        for _ in range(self.shards):
+            broker = TcpFakeServer(("127.0.0.1", 0))
+            threading.Thread(target=broker.serve_forever, daemon=True).start()
+            self.brokers.append(broker)
+            hosts.append(f"redis://127.0.0.1:{broker.server_address[1]}")
+        return hosts
+
+    def _seed(self, path):
+        connections.databases[ALIAS] = {
+            **connections.databases["default"],
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": path,
+            "CONN_MAX_AGE": 0,
+            "OPTIONS": {"transaction_mode": "IMMEDIATE"},
+        }
+        call_command("migrate", database=ALIAS, verbosity=0)
+        User.objects.using(ALIAS).bulk_create(
+            [User(username=f"{USERNAME_PREFIX}{i:05d}", password="!") for i in range(self.user_count)],
+            batch_size=1000,
+        )
+        self.users = list(User.objects.using(ALIAS).order_by("id"))
+        UserConnection.objects.using(ALIAS).bulk_create(
+            [
+                UserConnection(sender=self.users[i], receiver=self.users[i + 1], status=UserConnection.Status.APPROVED)
+                for i in range(0, self.user_count - 1, 2)
+            ],
+            batch_size=1000,
+        )
+        self.tokens = {user.id: str(AccessToken.for_user(user)) for user in self.users}
+
+    def _start_workers(self, path):
+        env = {**os.environ, "CHAT_CHANNEL_SHARDS": ",".join(self.hosts), "CHAT_SQLITE_PATH": path}
+        env.pop("CHAT_DB_PROFILE", None)
+        command = [
+            sys.executable, os.path.join(settings.BASE_DIR, "manage.py"), "runworkers",
+            "--workers", str(self.workers), "--port", str(self.port), "--separate-ports",
+        ]
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + 60
+        for port in self.ports:
+            while True:
+                if self.process.poll() is not None:
+                    raise ClusterError(f"runworkers exited with {self.process.returncode}, see its log:\n{self.log_tail()}")
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise ClusterError(f"Worker on port {port} did not start, see the log:\n{self.log_tail()}")
+                    time.sleep(0.2)
+
+    async def open(self, user, worker):
+        """An open socket for `user` on worker number `worker`."""
+        from .management.commands.loadtest import NetworkSocket
+
+        client = NetworkSocket(self.tokens[user.id], f"ws://127.0.0.1:{self.ports[worker]}")
+        await client.connect()
+        return client
+
+    async def expect(self, client, predicate, timeout=None):
+        """The first frame on `client` matching `predicate` within `timeout` seconds, or None."""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                _, frame = await client.receive(remaining)
+            except asyncio.TimeoutError:
+                return None
+            if predicate(frame):
+                return frame
+        return None
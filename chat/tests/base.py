@@ -0,0 +1,44 @@
+from urllib.parse import urlencode
+
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.cache import relationship_cache
+from chat.services import directory_pages
+from chat.usernames import user_map
+
+
+class ChatTestCase(TransactionTestCase):
+    """
+    Base for tests that drive the consumers. The database calls run on the
+    executor threads, so the data has to be committed for them to see it;
+    the per-process caches are emptied between tests, as the tables are.
+    """
+
+    def setUp(self):
+        relationship_cache.clear()
+        user_map.clear()
+        directory_pages.clear()
+
+
+async def connect(user, token=None):
+    """An open /ws/chat/ socket authenticated as `user` (with `token` if given)."""
+    from backend.asgi import application
+
+    communicator = WebsocketCommunicator(
+        application,
+        f"/ws/chat/?{urlencode({'token': token or str(AccessToken.for_user(user))})}",
+        headers=[(b"origin", b"http://testserver")],
+    )
+    connected, _ = await communicator.connect(timeout=10)
+    assert connected, "WebSocket handshake rejected"
+    return communicator
+
+
+async def receive_type(communicator, frame_type, timeout=5):
+    """The next frame of `frame_type`, skipping any others in between."""
+    while True:
+        frame = await communicator.receive_json_from(timeout=timeout)
+        if frame["type"] == frame_type:
+            return frame
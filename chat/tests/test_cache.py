@@ -0,0 +1,165 @@
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from chat import invalidation
+from chat.cache import RedisRelationshipCache, RelationshipCache
+from chat.checks import check_broadcast_changes
+from chat.deltas import MUTUAL_CONNECTIONS, PENDING_REQUESTS, SENT_REQUESTS
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def snapshot(sent=(), pending=(), mutual=()):
+    return {SENT_REQUESTS: list(sent), PENDING_REQUESTS: list(pending), MUTUAL_CONNECTIONS: list(mutual)}
+
+
+class RelationshipCacheTests(SimpleTestCase):
+    cache_class = RelationshipCache
+
+    def make_cache(self, **options):
+        return self.cache_class(**options)
+
+    def setUp(self):
+        self.cache = self.make_cache()
+
+    def store(self, user_id, lists):
+        self.cache.set(user_id, lists, self.cache.begin_load(user_id))
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(self.cache.get(1))
+        self.store(1, snapshot(sent=["bob", "alice"]))
+        self.assertEqual(self.cache.get(1), snapshot(sent=["alice", "bob"]))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_write_during_load_is_not_cached(self):
+        token = self.cache.begin_load(1)
+        self.cache.apply_changes({1: [{"op": "add", "list": SENT_REQUESTS, "username": "bob"}]})
+        # Read before the write; caching it would hide the write
+        self.cache.set(1, snapshot(), token)
+        self.assertIsNone(self.cache.get(1))
+
+        # A write for somebody else does not matter
+        token = self.cache.begin_load(2)
+        self.cache.apply_changes({1: [{"op": "add", "list": SENT_REQUESTS, "username": "carol"}]})
+        self.cache.set(2, snapshot(mutual=["dave"]), token)
+        self.assertEqual(self.cache.get(2), snapshot(mutual=["dave"]))
+
+    def test_invalidate(self):
+        self.store(1, snapshot(sent=["bob"]))
+        token = self.cache.begin_load(1)
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, snapshot(sent=["bob"]), token)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_apply_changes(self):
+        self.store(1, snapshot(sent=["bob"], pending=["carol"]))
+        self.cache.apply_changes({1: [
+            {"op": "move", "from": SENT_REQUESTS, "list": MUTUAL_CONNECTIONS, "username": "bob"},
+            {"op": "remove", "list": PENDING_REQUESTS, "username": "carol"},
+            {"op": "add", "list": SENT_REQUESTS, "username": "dave"},
+            # Replayed ops change nothing
+            {"op": "add", "list": SENT_REQUESTS, "username": "dave"},
+            {"op": "remove", "list": PENDING_REQUESTS, "username": "carol"},
+        ]})
+        self.assertEqual(self.cache.get(1), snapshot(sent=["dave"], mutual=["bob"]))
+
+
+class LocalRelationshipCacheTests(RelationshipCacheTests):
+    def test_least_recently_used_user_is_evicted(self):
+        self.cache = self.make_cache(max_entries=2)
+        self.store(1, snapshot())
+        self.store(2, snapshot())
+        self.cache.get(1)
+        self.store(3, snapshot())
+        self.assertIsNone(self.cache.get(2))
+        self.assertIsNotNone(self.cache.get(1))
+        self.assertIsNotNone(self.cache.get(3))
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_member_cap_evicts(self):
+        self.cache = self.make_cache(max_members=3)
+        self.store(1, snapshot(sent=["a", "b"]))
+        self.store(2, snapshot(mutual=["c", "d"]))
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["members"], 2)
+        # Growing past the cap through writes evicts as well
+        self.cache.apply_changes({2: [{"op": "add", "list": SENT_REQUESTS, "username": "e"},
+                                      {"op": "add", "list": SENT_REQUESTS, "username": "f"}]})
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.stats()["members"], 0)
+
+    def test_expired_entry_is_a_miss(self):
+        self.cache = self.make_cache(ttl=-1)
+        self.store(1, snapshot())
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_clear_drops_entries_and_pending_loads(self):
+        self.store(1, snapshot())
+        token = self.cache.begin_load(2)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(2, snapshot(), token)
+        self.assertIsNone(self.cache.get(2))
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisRelationshipCacheTests(RelationshipCacheTests):
+    cache_class = RedisRelationshipCache
+
+    def make_cache(self, **options):
+        return RedisRelationshipCache(client=fakeredis.FakeRedis(), **options)
+
+    def test_workers_share_entries(self):
+        other = RedisRelationshipCache(client=self.cache.client)
+        self.store(1, snapshot(pending=["bob"]))
+        self.assertEqual(other.get(1), snapshot(pending=["bob"]))
+        other.apply_changes({1: [{"op": "remove", "list": PENDING_REQUESTS, "username": "bob"}]})
+        self.assertEqual(self.cache.get(1), snapshot())
+
+    def test_clear(self):
+        self.store(1, snapshot(sent=["bob"]))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(1))
+
+
+class BroadcastChangesTests(TestCase):
+    changes = {1: [{"op": "add", "list": SENT_REQUESTS, "username": "bob"}]}
+
+    def test_published_after_commit(self):
+        with mock.patch.object(invalidation, "_schedule") as schedule:
+            with self.captureOnCommitCallbacks() as callbacks:
+                invalidation.publish_changes(self.changes)
+            schedule.assert_not_called()
+            for callback in callbacks:
+                callback()
+        message = schedule.call_args.args[0]
+        self.assertEqual(message["origin"], invalidation.WORKER_ID)
+        self.assertEqual(message["changes"], [[1, self.changes[1]]])
+
+    def test_channel_layer_errors_are_logged_not_raised(self):
+        layer = mock.Mock()
+        layer.group_send = mock.AsyncMock(side_effect=ConnectionError("Redis is down"))
+        with mock.patch.object(invalidation, "get_channel_layer", return_value=layer):
+            with self.assertLogs("chat.invalidation", "ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    invalidation.publish_changes(self.changes)
+        layer.group_send.assert_awaited_once()
+
+
+class BroadcastCheckTests(SimpleTestCase):
+    shared_layer = {"default": {"BACKEND": "chat.layers.ShardedPubSubChannelLayer"}}
+
+    @override_settings(CHANNEL_LAYERS=shared_layer, CHAT_RELATIONSHIP_CACHE={"BROADCAST_CHANGES": False})
+    def test_shared_layer_requires_broadcast(self):
+        self.assertEqual([error.id for error in check_broadcast_changes(None)], ["chat.E001"])
+
+    @override_settings(CHANNEL_LAYERS=shared_layer, CHAT_RELATIONSHIP_CACHE={"BROADCAST_CHANGES": True})
+    def test_shared_layer_with_broadcast(self):
+        self.assertEqual(check_broadcast_changes(None), [])
@@ -0,0 +1,100 @@
+import unittest
+from urllib.parse import urlencode
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import codec
+
+from .base import ChatTestCase, connect, receive_type
+
+
+async def connect_offering(user, subprotocols):
+    """Like `connect`, offering `subprotocols`; returns the communicator and the one accepted."""
+    from backend.asgi import application
+
+    communicator = WebsocketCommunicator(
+        application,
+        f"/ws/chat/?{urlencode({'token': str(AccessToken.for_user(user))})}",
+        headers=[(b"origin", b"http://testserver")],
+        subprotocols=subprotocols,
+    )
+    connected, subprotocol = await communicator.connect(timeout=10)
+    assert connected, "WebSocket handshake rejected"
+    return communicator, subprotocol
+
+
+class CodecTests(SimpleTestCase):
+    frame = {"type": "message", "body": "héllo ✓", "id": 3, "users": ["a", "b"], "next_cursor": None}
+
+    def test_backends_round_trip(self):
+        for name in codec.BACKENDS:
+            try:
+                loads, dumps = codec._load(name)
+            except ImportError:
+                continue
+            with self.subTest(name):
+                text = dumps(self.frame)
+                self.assertIsInstance(text, str)
+                self.assertIn("héllo ✓", text)
+                self.assertEqual(loads(text), self.frame)
+
+    def test_malformed_text_raises_decode_error(self):
+        for frame in ("{", "", "[1,]", b"\xff"):
+            with self.subTest(frame), self.assertRaises(codec.DecodeError):
+                codec.loads(frame)
+
+    def test_unknown_codec(self):
+        with self.assertRaisesMessage(ValueError, "Unknown JSON codec: yaml"):
+            codec._load("yaml")
+
+    @unittest.skipUnless(codec.msgpack_available(), "msgpack is not installed")
+    def test_msgpack_round_trip(self):
+        self.assertEqual(codec.unpackb(codec.packb(self.frame)), self.frame)
+        with self.assertRaises(codec.DecodeError):
+            codec.unpackb(b"\xc1")
+
+    def test_broadcast_is_encoded_once_per_format(self):
+        encoded = codec.encode_broadcast(self.frame)
+        self.assertEqual(codec.loads(encoded["frame"]), self.frame)
+        if codec.msgpack_available():
+            self.assertEqual(codec.unpackb(encoded["packed"]), self.frame)
+
+
+class SubprotocolTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username="alice")
+
+    @unittest.skipUnless(codec.msgpack_available(), "msgpack is not installed")
+    async def test_msgpack_is_negotiated(self):
+        communicator, subprotocol = await connect_offering(self.alice, ["other", codec.MSGPACK])
+        self.assertEqual(subprotocol, codec.MSGPACK)
+        await communicator.send_to(bytes_data=codec.packb({"action": "ping"}))
+        reply = await communicator.receive_output(timeout=5)
+        await communicator.disconnect()
+        self.assertEqual(codec.unpackb(reply["bytes"]), {"type": "pong"})
+
+    @unittest.skipUnless(codec.msgpack_available(), "msgpack is not installed")
+    async def test_malformed_msgpack_gets_error_frame(self):
+        communicator, _ = await connect_offering(self.alice, [codec.MSGPACK])
+        await communicator.send_to(bytes_data=b"\xc1")
+        reply = await communicator.receive_output(timeout=5)
+        await communicator.disconnect()
+        self.assertEqual(codec.unpackb(reply["bytes"]), {"type": "error", "message": "Malformed frame"})
+
+    async def test_json_without_the_subprotocol(self):
+        communicator, subprotocol = await connect_offering(self.alice, ["other"])
+        self.assertIsNone(subprotocol)
+        await communicator.send_json_to({"action": "ping"})
+        self.assertEqual(await communicator.receive_json_from(timeout=5), {"type": "pong"})
+        await communicator.disconnect()
+
+    async def test_binary_frames_need_the_subprotocol(self):
+        communicator = await connect(self.alice)
+        await communicator.send_to(bytes_data=b'{"action":"ping"}')
+        error = await receive_type(communicator, "error")
+        await communicator.disconnect()
+        self.assertEqual(error["message"], "Binary frames are not supported")
@@ -0,0 +1,75 @@
+import base64
+import json
+import unittest
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from chat import compression
+from chat.compression import HEADER, MAGIC, STRUCTURE, FrameCompressor, decompress
+
+from .base import ChatTestCase, connect, receive_type
+
+
+class FrameCompressorTests(TestCase):
+    def setUp(self):
+        User.objects.bulk_create(User(username=f"user{i:03d}") for i in range(50))
+        self.compressor = FrameCompressor(threshold=100)
+
+    def test_dictionary_holds_usernames_then_structure(self):
+        dictionary_id, zdict = self.compressor.dictionary()
+        self.assertTrue(zdict.startswith(b'"user000","user001",'))
+        self.assertTrue(zdict.endswith(STRUCTURE.encode()))
+        # Kept until the TTL runs out
+        self.assertEqual(self.compressor.dictionary(), (dictionary_id, zdict))
+
+    def test_dictionary_size_is_bounded(self):
+        small = FrameCompressor(dictionary_size=len(STRUCTURE) + 25)
+        _, zdict = small.dictionary()
+        self.assertEqual(zdict, b'"user000","user001",' + STRUCTURE.encode())
+
+    def test_round_trip(self):
+        dictionary = self.compressor.dictionary()
+        frame = json.dumps({"type": "update_users", "users": [f"user{i:03d}" for i in range(50)]})
+        compressed = self.compressor.compress(frame, dictionary)
+        self.assertEqual(HEADER.unpack(compressed[:HEADER.size]), (MAGIC, dictionary[0]))
+        self.assertLess(len(compressed), len(frame) // 2)
+        self.assertEqual(decompress(compressed, dictionary[1]).decode(), frame)
+        # Binary (MessagePack) frames the same way
+        self.assertEqual(decompress(self.compressor.compress(b"\x81\xa1a\x01", dictionary), dictionary[1]), b"\x81\xa1a\x01")
+
+
+@unittest.skipIf(compression.compressor is None, "compression is disabled")
+class CompressedSocketTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username="alice")
+        User.objects.bulk_create(User(username=f"user{i:03d}") for i in range(20))
+        patcher = mock.patch.object(compression, "compressor", FrameCompressor(threshold=200))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_frames_over_the_threshold_are_compressed(self):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "init_connection", "compression": "deflate"})
+        offer = await receive_type(communicator, "compression")
+        zdict = base64.b64decode(offer["dictionary"])
+        self.assertEqual((offer["algorithm"], offer["threshold"]), ("deflate", 200))
+
+        # Short frames stay text
+        await receive_type(communicator, "presence")
+        snapshot = await communicator.receive_output(timeout=5)
+        await communicator.disconnect()
+        self.assertEqual(snapshot["bytes"][:HEADER.size], HEADER.pack(MAGIC, offer["dictionary_id"]))
+        users = json.loads(decompress(snapshot["bytes"], zdict))
+        self.assertEqual(users["type"], "update_users")
+        self.assertEqual(len(users["users"]), 20)
+
+    async def test_uncompressed_without_opting_in(self):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "init_connection"})
+        await receive_type(communicator, "presence")
+        users = await communicator.receive_json_from(timeout=5)
+        await communicator.disconnect()
+        self.assertEqual(users["type"], "update_users")
@@ -0,0 +1,248 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from chat import deltas, services
+from chat.deltas import MUTUAL_CONNECTIONS, PENDING_REQUESTS, SENT_REQUESTS, USERS, UserListJournal
+from chat.models import UserConnection
+
+from .base import ChatTestCase, connect, receive_type
+
+
+class UserListJournalTests(SimpleTestCase):
+    def setUp(self):
+        self.journal = UserListJournal(max_entries_per_user=3, max_directory_entries=3, max_users=2)
+        self.start = self.journal.current()
+
+    def since(self, user_id, revision):
+        return self.journal.since(user_id, revision, self.journal.id)
+
+    def test_record_returns_increasing_revisions(self):
+        first = self.journal.record({1: [{"op": "add", "list": SENT_REQUESTS, "username": "bob"}]})
+        second = self.journal.record({1: [{"op": "add", "list": SENT_REQUESTS, "username": "carol"}]})
+        self.assertGreater(first, self.start)
+        self.assertGreater(second, first)
+        self.assertEqual(self.journal.current(), second)
+
+    def test_since_returns_ops_after_revision(self):
+        add_bob = {"op": "add", "list": SENT_REQUESTS, "username": "bob"}
+        add_carol = {"op": "add", "list": SENT_REQUESTS, "username": "carol"}
+        first = self.journal.record({1: [add_bob], 2: [add_bob]})
+        second = self.journal.record({1: [add_carol]})
+
+        self.assertEqual(self.since(1, self.start), ([add_bob, add_carol], second))
+        self.assertEqual(self.since(1, first), ([add_carol], second))
+        self.assertEqual(self.since(1, second), ([], second))
+        # Other users' changes are not theirs to see
+        self.assertEqual(self.since(2, first), ([], second))
+
+    def test_directory_changes_skip_their_subject(self):
+        op = {"op": "add", "list": USERS, "username": "dave"}
+        revision = self.journal.record_directory(4, op)
+        self.assertEqual(self.since(1, self.start), ([op], revision))
+        self.assertEqual(self.since(4, self.start), ([], revision))
+
+    def test_unknown_revision_needs_snapshot(self):
+        self.journal.record({1: [{"op": "add", "list": SENT_REQUESTS, "username": "bob"}]})
+        # Older than anything this journal handed out
+        self.assertIsNone(self.since(1, self.start - 1))
+        # Never handed out yet
+        self.assertIsNone(self.since(1, self.journal.current() + 1))
+
+    def test_revision_of_another_journal_needs_snapshot(self):
+        # Another worker, or this one before a restart, numbering from the same start
+        other = UserListJournal()
+        other._current = self.start
+        other._counter = iter(range(self.start + 1, self.start + 100))
+        other_revision = other.record({1: [{"op": "add", "list": SENT_REQUESTS, "username": "carol"}]})
+
+        add_bob = {"op": "add", "list": SENT_REQUESTS, "username": "bob"}
+        self.journal.record({1: [add_bob]})
+        self.journal.record({1: [{"op": "add", "list": PENDING_REQUESTS, "username": "dave"}]})
+        # The number falls inside this journal's range, but is not its own
+        self.assertIsNotNone(self.since(1, other_revision))
+        self.assertIsNone(self.journal.since(1, other_revision, other.id))
+        self.assertNotEqual(other.id, self.journal.id)
+
+    def test_trimmed_revision_needs_snapshot(self):
+        revisions = [
+            self.journal.record({1: [{"op": "add", "list": SENT_REQUESTS, "username": f"user{i}"}]})
+            for i in range(5)
+        ]
+        # Only the last three ops are held
+        self.assertIsNone(self.since(1, self.start))
+        self.assertIsNone(self.since(1, revisions[0]))
+        ops, _ = self.since(1, revisions[1])
+        self.assertEqual([op["username"] for op in ops], ["user2", "user3", "user4"])
+
+    def test_evicted_user_needs_snapshot(self):
+        op = {"op": "add", "list": SENT_REQUESTS, "username": "bob"}
+        self.journal.record({1: [op]})
+        self.journal.record({2: [op]})
+        self.journal.record({3: [op]})  # evicts user 1's log
+        self.assertIsNone(self.since(1, self.start))
+
+    def test_listeners_skip_remote_changes_when_asked(self):
+        seen, local_only = [], []
+        self.journal.subscribe(seen.append)
+        self.journal.subscribe(local_only.append, remote=False)
+        changes = {1: [{"op": "add", "list": SENT_REQUESTS, "username": "bob"}]}
+        self.journal.record(changes)
+        self.journal.record(changes, remote=True)
+        self.assertEqual(len(seen), 2)
+        self.assertEqual(len(local_only), 1)
+
+
+class OpTests(SimpleTestCase):
+    def setUp(self):
+        self.alice = User(id=1, username="alice")
+        self.bob = User(id=2, username="bob")
+        self.carol = User(id=3, username="carol")
+
+    def ops_since(self, revision):
+        return {
+            user.username: deltas.journal.since(user.id, revision, deltas.journal.id)[0]
+            for user in (self.alice, self.bob, self.carol)
+        }
+
+    def test_requests_sent(self):
+        start = deltas.journal.current()
+        deltas.record_requests_sent(self.alice, [self.bob, self.carol])
+        self.assertEqual(self.ops_since(start), {
+            "alice": [
+                {"op": "add", "list": SENT_REQUESTS, "username": "bob"},
+                {"op": "add", "list": SENT_REQUESTS, "username": "carol"},
+            ],
+            "bob": [{"op": "add", "list": PENDING_REQUESTS, "username": "alice"}],
+            "carol": [{"op": "add", "list": PENDING_REQUESTS, "username": "alice"}],
+        })
+
+    def test_requests_approved(self):
+        start = deltas.journal.current()
+        deltas.record_requests_approved([self.bob, self.carol], self.alice)
+        self.assertEqual(self.ops_since(start), {
+            "alice": [
+                {"op": "move", "from": PENDING_REQUESTS, "list": MUTUAL_CONNECTIONS, "username": "bob"},
+                {"op": "move", "from": PENDING_REQUESTS, "list": MUTUAL_CONNECTIONS, "username": "carol"},
+            ],
+            "bob": [{"op": "move", "from": SENT_REQUESTS, "list": MUTUAL_CONNECTIONS, "username": "alice"}],
+            "carol": [{"op": "move", "from": SENT_REQUESTS, "list": MUTUAL_CONNECTIONS, "username": "alice"}],
+        })
+
+    def test_request_rejected(self):
+        start = deltas.journal.current()
+        deltas.record_request_rejected(self.bob, self.alice)
+        self.assertEqual(self.ops_since(start), {
+            "alice": [{"op": "remove", "list": PENDING_REQUESTS, "username": "bob"}],
+            "bob": [{"op": "remove", "list": SENT_REQUESTS, "username": "alice"}],
+            "carol": [],
+        })
+
+    def test_batch_is_one_revision(self):
+        revision = deltas.record_requests_sent(self.alice, [self.bob, self.carol])
+        self.assertEqual(deltas.journal.current(), revision)
+
+
+class ConnectionSignalTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+
+    def changes(self, write):
+        start = deltas.journal.current()
+        with self.captureOnCommitCallbacks(execute=True):
+            write()
+        return {
+            user.username: deltas.journal.since(user.id, start, deltas.journal.id)[0]
+            for user in (self.alice, self.bob)
+        }
+
+    def test_save_outside_services_is_recorded(self):
+        connection = UserConnection(sender=self.alice, receiver=self.bob)
+        self.assertEqual(self.changes(connection.save), {
+            "alice": [
+                {"op": "add", "list": SENT_REQUESTS, "username": "bob"},
+                {"op": "remove", "list": MUTUAL_CONNECTIONS, "username": "bob"},
+            ],
+            "bob": [
+                {"op": "add", "list": PENDING_REQUESTS, "username": "alice"},
+                {"op": "remove", "list": MUTUAL_CONNECTIONS, "username": "alice"},
+            ],
+        })
+
+        connection.status = UserConnection.Status.APPROVED
+        self.assertEqual(self.changes(connection.save), {
+            "alice": [
+                {"op": "remove", "list": SENT_REQUESTS, "username": "bob"},
+                {"op": "add", "list": MUTUAL_CONNECTIONS, "username": "bob"},
+            ],
+            "bob": [
+                {"op": "remove", "list": PENDING_REQUESTS, "username": "alice"},
+                {"op": "add", "list": MUTUAL_CONNECTIONS, "username": "alice"},
+            ],
+        })
+
+    def test_delete_outside_services_is_recorded(self):
+        connection = UserConnection.objects.create(
+            sender=self.alice, receiver=self.bob, status=UserConnection.Status.APPROVED
+        )
+        changes = self.changes(connection.delete)
+        self.assertEqual(changes["alice"], [
+            {"op": "remove", "list": SENT_REQUESTS, "username": "bob"},
+            {"op": "remove", "list": MUTUAL_CONNECTIONS, "username": "bob"},
+        ])
+
+    def test_services_changes_are_recorded_once(self):
+        services.send_connection_request(self.alice, "bob")
+        changes = self.changes(lambda: services.reject_connection_request(self.bob, "alice"))
+        self.assertEqual(changes, {
+            "alice": [{"op": "remove", "list": SENT_REQUESTS, "username": "bob"}],
+            "bob": [{"op": "remove", "list": PENDING_REQUESTS, "username": "alice"}],
+        })
+
+
+class ResumeTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+
+    async def init(self, revision, journal=None):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "init_connection", "revision": revision, "journal": journal})
+        return communicator
+
+    async def test_resume_from_known_revision_sends_delta(self):
+        communicator = await self.init(None)
+        snapshot = await receive_type(communicator, "update_users")
+        await communicator.disconnect()
+
+        await sync_to_async(deltas.record_request_sent)(self.bob, self.alice)
+        communicator = await self.init(snapshot["revision"], snapshot["journal"])
+        delta = await receive_type(communicator, "users_delta")
+        self.assertEqual(delta["from_revision"], snapshot["revision"])
+        self.assertEqual(delta["journal"], deltas.journal.id)
+        self.assertEqual(delta["ops"], [{"op": "add", "list": PENDING_REQUESTS, "username": "bob"}])
+        self.assertTrue(await communicator.receive_nothing(0.2))
+        await communicator.disconnect()
+
+    async def test_revision_from_another_worker_falls_back_to_snapshot(self):
+        communicator = await self.init(None)
+        snapshot = await receive_type(communicator, "update_users")
+        await communicator.disconnect()
+
+        await sync_to_async(deltas.record_request_sent)(self.bob, self.alice)
+        # A revision this journal covers, but numbered by another worker's
+        communicator = await self.init(snapshot["revision"], "0" * 16)
+        resumed = await receive_type(communicator, "update_users")
+        self.assertEqual(resumed["pending_requests"], ["bob"])
+        self.assertEqual(resumed["journal"], deltas.journal.id)
+        await communicator.disconnect()
+
+    async def test_unknown_revision_falls_back_to_snapshot(self):
+        # Never handed out by this journal
+        communicator = await self.init(deltas.journal.current() + 1000, deltas.journal.id)
+        snapshot = await receive_type(communicator, "update_users")
+        self.assertEqual(snapshot["revision"], deltas.journal.current())
+        self.assertEqual(snapshot["mutual_connections"], [])
+        await communicator.disconnect()
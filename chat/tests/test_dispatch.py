@@ -0,0 +1,101 @@
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+
+from chat.dispatch import ActionRegistry, ValidationError, optional, required
+
+from .base import ChatTestCase, connect, receive_type
+
+actions = ActionRegistry()
+
+
+class Handler:
+    @actions.register(
+        "send",
+        receiver=required((str, int), max_length=5, argument="receiver_name"),
+        limit=optional(int),
+        names=optional(list, max_length=2, items=str),
+        note=optional(str, nullable=True),
+    )
+    async def send(self, receiver_name, limit=None, names=None, note=None):
+        pass
+
+
+class ActionRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.handler = Handler()
+
+    def resolve(self, data, name="send"):
+        return actions.resolve(self.handler, name, data)
+
+    def assertInvalid(self, data, message):
+        with self.assertRaisesMessage(ValidationError, message):
+            self.resolve(data)
+
+    def test_declared_fields_become_arguments(self):
+        method, arguments = self.resolve({"receiver": "bob", "limit": 3, "other": "dropped"})
+        self.assertEqual(method, self.handler.send)
+        self.assertEqual(arguments, {"receiver_name": "bob", "limit": 3})
+        self.assertEqual(self.resolve({"receiver": 7})[1], {"receiver_name": 7})
+
+    def test_unknown_action(self):
+        self.assertNotIn("nothing", actions)
+        self.assertIsNone(self.resolve({}, name="nothing"))
+        self.assertEqual(actions.names(), {"send"})
+
+    def test_missing_required_field(self):
+        self.assertInvalid({}, "receiver is required")
+        self.assertInvalid({"receiver": None}, "receiver is required")
+
+    def test_wrong_types(self):
+        self.assertInvalid({"receiver": ["bob"]}, "receiver must be of type str or int")
+        self.assertInvalid({"receiver": "bob", "limit": "3"}, "limit must be of type int")
+        self.assertInvalid({"receiver": "bob", "limit": 1.5}, "limit must be of type int")
+
+    def test_bool_is_not_an_int(self):
+        self.assertInvalid({"receiver": True}, "receiver must be of type str or int")
+        self.assertInvalid({"receiver": "bob", "limit": False}, "limit must be of type int")
+
+    def test_lengths_are_bounded(self):
+        self.assertInvalid({"receiver": "robert"}, "receiver must be at most 5 characters")
+        self.assertInvalid({"receiver": "bob", "names": ["a", "b", "c"]}, "names must have at most 2 items")
+
+    def test_list_items_are_checked(self):
+        self.assertEqual(self.resolve({"receiver": "bob", "names": ["a"]})[1]["names"], ["a"])
+        self.assertInvalid({"receiver": "bob", "names": ["a", 1]}, "names items must be of type str")
+
+    def test_null_optional_field(self):
+        self.assertEqual(self.resolve({"receiver": "bob", "note": None})[1]["note"], None)
+
+
+class ErrorFrameTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username="alice")
+
+    async def send(self, frame):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to(frame)
+        # Frames are answered in order, so anything sent back comes before the pong
+        await communicator.send_json_to({"action": "ping"})
+        frames = []
+        while (frame := await communicator.receive_json_from(timeout=5))["type"] != "pong":
+            frames.append(frame)
+        await communicator.disconnect()
+        return frames
+
+    async def test_invalid_payload_gets_error_frame(self):
+        frames = await self.send({"action": "send_message", "receiver": "bob"})
+        self.assertEqual(frames, [{"type": "error", "message": "body is required"}])
+        frames = await self.send({"action": "get_suggestions", "limit": True})
+        self.assertEqual(frames, [{"type": "error", "message": "limit must be of type int"}])
+
+    async def test_unknown_action_is_ignored(self):
+        self.assertEqual(await self.send({"action": "disconnect"}), [])
+        self.assertEqual(await self.send({"action": ["ping"]}), [])
+
+    async def test_malformed_frame_gets_error_frame(self):
+        communicator = await connect(self.alice)
+        await communicator.send_to(text_data="[1, 2")
+        error = await receive_type(communicator, "error")
+        await communicator.disconnect()
+        self.assertEqual(error["message"], "Malformed frame")
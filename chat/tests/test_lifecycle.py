@@ -0,0 +1,40 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chat import lifecycle
+from chat.notifications import NotificationCoalescer
+
+
+class ShutdownTests(SimpleTestCase):
+    async def test_held_notifications_are_sent_and_queue_closed(self):
+        channel_layer = mock.Mock()
+        channel_layer.group_send = mock.AsyncMock()
+        coalescer = NotificationCoalescer(window=60)
+        await coalescer.publish(channel_layer, "user_1", {"message": "first"})
+        await coalescer.publish(channel_layer, "user_1", {"message": "second"})
+        channel_layer.group_send.assert_not_awaited()
+
+        with mock.patch.object(lifecycle, "coalescer", coalescer), \
+                mock.patch.object(lifecycle.write_queue, "aclose", mock.AsyncMock()) as aclose:
+            await lifecycle.shutdown()
+
+        group, event = channel_layer.group_send.await_args.args
+        self.assertEqual(group, "user_1")
+        self.assertEqual([e["message"] for e in event["events"]], ["first", "second"])
+        aclose.assert_awaited_once()
+
+    async def test_lifespan_shutdown(self):
+        messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        with mock.patch.object(lifecycle, "shutdown", mock.AsyncMock()) as shutdown:
+            await lifecycle.lifespan({"type": "lifespan"}, receive, send)
+        shutdown.assert_awaited_once()
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
@@ -0,0 +1,22 @@
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+
+class LoadtestDatabaseTests(TestCase):
+    url = "ws://127.0.0.1:1"
+
+    def test_url_needs_seed_database(self):
+        with self.assertRaisesMessage(CommandError, "--seed-database"):
+            call_command("loadtest", url=self.url)
+        self.assertFalse(User.objects.exists())
+
+    def test_existing_loadtest_users_are_not_touched(self):
+        User.objects.create_user("loadtest_0000001", password="x")
+        with self.assertRaisesMessage(CommandError, "already has loadtest_* users"):
+            call_command("loadtest", url=self.url, seed_database="default")
+        self.assertTrue(User.objects.filter(username="loadtest_0000001").exists())
+
+    def test_seed_database_needs_url(self):
+        with self.assertRaisesMessage(CommandError, "only applies with --url"):
+            call_command("loadtest", seed_database="default")
@@ -0,0 +1,118 @@
+import asyncio
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import checks, metrics, middleware
+
+from .base import ChatTestCase, connect
+
+
+def sample(name):
+    """Current value of one sample in the Prometheus output, or None."""
+    for line in metrics.registry.render().splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[-1])
+    return None
+
+
+def kinds():
+    """Metric name -> type, from the TYPE lines of the Prometheus output."""
+    return {
+        line.split()[2]: line.split()[3]
+        for line in metrics.registry.render().splitlines()
+        if line.startswith("# TYPE ")
+    }
+
+
+class MetricsTests(ChatTestCase):
+    async def test_handshake_auth_time_is_recorded(self):
+        user = await User.objects.acreate(username="alice")
+        before = {
+            result: sample(f'chat_ws_auth_seconds_count{{result="{result}"}}') or 0
+            for result in ("verified", "cached")
+        }
+        token = str(AccessToken.for_user(user))
+        for _ in range(2):
+            communicator = await connect(user, token)
+            await communicator.disconnect()
+        # The second handshake with the same token is served from the cache
+        self.assertEqual(sample('chat_ws_auth_seconds_count{result="verified"}'), before["verified"] + 1)
+        self.assertEqual(sample('chat_ws_auth_seconds_count{result="cached"}'), before["cached"] + 1)
+
+    async def test_concurrent_cache_hit_does_not_relabel_a_verification(self):
+        user = await User.objects.acreate(username="alice")
+        warm, fresh = str(AccessToken.for_user(user)), str(AccessToken.for_user(user))
+        communicator = await connect(user, warm)
+        await communicator.disconnect()
+        before = {
+            result: sample(f'chat_ws_auth_seconds_count{{result="{result}"}}') or 0
+            for result in ("verified", "cached")
+        }
+
+        # The fresh token's verification waits until a cached handshake is done
+        release = asyncio.Event()
+        verify = middleware.verify_token
+
+        async def slow_verify(token_key):
+            await release.wait()
+            return await verify(token_key)
+
+        with mock.patch.object(middleware, "verify_token", slow_verify):
+            slow = asyncio.ensure_future(connect(user, fresh))
+            await asyncio.sleep(0.1)
+            cached = await connect(user, warm)
+            release.set()
+            verified = await slow
+        await cached.disconnect()
+        await verified.disconnect()
+        self.assertEqual(sample('chat_ws_auth_seconds_count{result="verified"}'), before["verified"] + 1)
+        self.assertEqual(sample('chat_ws_auth_seconds_count{result="cached"}'), before["cached"] + 1)
+
+    def test_component_totals_are_counters(self):
+        types = kinds()
+        for name in (
+            "chat_token_cache_hits_total", "chat_token_cache_misses_total",
+            "chat_user_map_hits_total", "chat_user_map_misses_total",
+            "chat_write_queue_written_total", "chat_write_queue_failed_total",
+            "chat_relationship_cache_hits_total", "chat_relationship_cache_misses_total",
+            "chat_relationship_cache_evictions_total",
+        ):
+            self.assertEqual(types.get(name), "counter", name)
+        for name in ("chat_user_map_size", "chat_write_queue_depth", "chat_relationship_cache_hit_ratio"):
+            self.assertEqual(types.get(name), "gauge", name)
+        # Counters are the only ones ending in _total
+        self.assertFalse([name for name, kind in types.items() if (kind == "counter") != name.endswith("_total")])
+
+
+@override_settings(DEBUG=False, CHAT_METRICS_TOKEN=None)
+class MetricsEndpointTests(TestCase):
+    url = "/chat/metrics/"
+
+    def test_token_is_required_when_set(self):
+        with self.settings(CHAT_METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get(self.url).status_code, 401)
+            self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+            response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE ", response.content)
+
+    def test_staff_only_without_a_token(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(User.objects.create(username="alice"))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        self.client.force_login(User.objects.create(username="admin", is_staff=True))
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_open_in_debug(self):
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_missing_token_is_warned_about(self):
+        self.assertEqual([warning.id for warning in checks.check_metrics_token(None)], ["chat.W001"])
+        with self.settings(CHAT_METRICS_TOKEN="secret"):
+            self.assertEqual(checks.check_metrics_token(None), [])
+        with self.settings(DEBUG=True):
+            self.assertEqual(checks.check_metrics_token(None), [])
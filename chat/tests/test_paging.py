@@ -0,0 +1,165 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import services
+from chat.models import Message, UserConnection
+from chat.services import directory_pages
+from chat.usernames import user_map
+
+from .base import ChatTestCase, connect, receive_type
+
+
+class DirectoryPageTests(TestCase):
+    usernames = ["al", "alan", "alice", "alz", "alé", "ak", "am", "bob", "carol"]
+
+    def setUp(self):
+        directory_pages.clear()
+        user_map.clear()
+        User.objects.bulk_create(User(username=username) for username in self.usernames)
+        self.requester = User.objects.create(username="zed")
+
+    def page(self, **kwargs):
+        return services.get_directory_page(self.requester, **kwargs)
+
+    def walk(self, **kwargs):
+        pages, cursor = [], None
+        while True:
+            page = self.page(cursor=cursor, **kwargs)
+            pages.append(page["users"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return pages
+
+    def test_pages_cover_everyone_once_in_order(self):
+        pages = self.walk(page_size=4)
+        self.assertEqual([len(page) for page in pages], [4, 4, 1])
+        self.assertEqual(sum(pages, []), sorted(self.usernames))
+
+    def test_last_full_page_has_no_cursor(self):
+        pages = self.walk(page_size=3)
+        self.assertEqual([len(page) for page in pages], [3, 3, 3])
+
+    def test_cursor_is_exclusive(self):
+        self.assertEqual(self.page(cursor="alice", page_size=2)["users"], ["alz", "alé"])
+        # A cursor need not be an existing username
+        self.assertEqual(self.page(cursor="alb", page_size=2)["users"], ["alice", "alz"])
+        self.assertEqual(self.page(cursor="carol")["users"], [])
+
+    def test_requester_is_left_out_without_shortening_the_page(self):
+        requester = User.objects.get(username="alan")
+        page = services.get_directory_page(requester, page_size=3)
+        self.assertEqual(page, {"users": ["ak", "al", "alice"], "next_cursor": "alice"})
+
+    def test_prefix_bounds_the_range(self):
+        pages = self.walk(prefix="al", page_size=2)
+        self.assertEqual(sum(pages, []), ["al", "alan", "alice", "alz", "alé"])
+        self.assertEqual(self.page(prefix="al", cursor="alz")["users"], ["alé"])
+        self.assertEqual(self.page(prefix="b")["users"], ["bob"])
+        self.assertEqual(self.page(prefix="x")["users"], [])
+
+    @override_settings(CHAT_DIRECTORY_PAGE_SIZE=4, CHAT_DIRECTORY_MAX_PAGE_SIZE=6)
+    def test_page_size_is_clamped(self):
+        self.assertEqual(len(self.page()["users"]), 4)
+        self.assertEqual(len(self.page(page_size=100)["users"]), 6)
+        self.assertEqual(len(self.page(page_size=0)["users"]), 1)
+        self.assertEqual(len(self.page(page_size="many")["users"]), 4)
+
+    def test_endpoint_pages(self):
+        response = self.client.get(
+            "/chat/api/users/",
+            {"prefix": "al", "page_size": 2, "cursor": "al"},
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.requester)}",
+        )
+        data = response.json()
+        self.assertEqual((data["users"], data["users_next_cursor"]), (["alan", "alice"], "alice"))
+
+
+@override_settings(CHAT_HISTORY_PAGE_SIZE=3)
+class HistoryPageTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        carol = User.objects.create(username="carol")
+        start = timezone.now() - timedelta(hours=1)
+        conversation = Message.conversation_key(self.alice.id, self.bob.id)
+        # Messages 2 to 4 share a timestamp, as a write-behind batch would
+        times = [start, start + timedelta(seconds=1)] + [start + timedelta(seconds=2)] * 3 + [start + timedelta(seconds=3)]
+        self.messages = [
+            Message.objects.create(
+                conversation=conversation, sender=self.alice, recipient=self.bob, body=str(index), created_at=at
+            )
+            for index, at in enumerate(times)
+        ]
+        Message.objects.create(
+            conversation=Message.conversation_key(self.alice.id, carol.id),
+            sender=self.alice, recipient=carol, body="elsewhere",
+        )
+
+    def walk(self, user, peer):
+        pages, before = [], None
+        while True:
+            page = services.get_message_history(user, peer, before)
+            pages.append([message["body"] for message in page["messages"]])
+            before = page["next_cursor"]
+            if before is None:
+                return pages
+
+    def test_pages_are_newest_first_without_gaps(self):
+        self.assertEqual(self.walk(self.alice, self.bob), [["5", "4", "3"], ["2", "1", "0"]])
+        # The same conversation from the other side
+        self.assertEqual(self.walk(self.bob, self.alice), [["5", "4", "3"], ["2", "1", "0"]])
+
+    def test_cursor_splits_equal_timestamps_by_id(self):
+        cursor = services.encode_history_cursor(self.messages[3])
+        page = services.get_message_history(self.alice, self.bob, cursor)
+        self.assertEqual([message["body"] for message in page["messages"]], ["2", "1", "0"])
+        self.assertIsNone(page["next_cursor"])
+
+    def test_cursor_round_trips(self):
+        message = self.messages[2]
+        self.assertEqual(
+            services.decode_history_cursor(services.encode_history_cursor(message)),
+            (message.created_at, message.id),
+        )
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=6)
+    def test_exactly_one_page(self):
+        self.assertEqual(self.walk(self.alice, self.bob), [["5", "4", "3", "2", "1", "0"]])
+
+
+class HistoryActionTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        UserConnection.objects.create(sender=self.alice, receiver=self.bob, status=UserConnection.Status.APPROVED)
+
+    async def history(self, **fields):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "get_history", "with": "bob", **fields})
+        frame = await communicator.receive_json_from(timeout=5)
+        while frame["type"] not in ("history", "error"):
+            frame = await communicator.receive_json_from(timeout=5)
+        await communicator.disconnect()
+        return frame
+
+    @override_settings(CHAT_HISTORY_PAGE_SIZE=1)
+    async def test_history_frame_pages(self):
+        for body in ("first", "second"):
+            await Message.objects.acreate(
+                conversation=Message.conversation_key(self.alice.id, self.bob.id),
+                sender=self.alice, recipient=self.bob, body=body,
+            )
+        newest = await self.history()
+        self.assertEqual([message["body"] for message in newest["messages"]], ["second"])
+        older = await self.history(before=newest["next_cursor"])
+        self.assertEqual((older["before"], older["next_cursor"]), (newest["next_cursor"], None))
+        self.assertEqual([message["body"] for message in older["messages"]], ["first"])
+
+    async def test_malformed_cursor_gets_error_frame(self):
+        frame = await self.history(before="yesterday")
+        self.assertEqual(frame, {"type": "error", "message": "Invalid history cursor"})
@@ -0,0 +1,177 @@
+import asyncio
+from collections import deque
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, override_settings
+
+from chat import consumers
+from chat.consumers import ChatConsumer
+from chat.ratelimit import SOCKET, USER, RateLimiter
+
+from .base import ChatTestCase, connect, receive_type
+
+
+class Clock:
+    """time.monotonic stand-in, moving on by `tick` after every reading."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.tick = 0.0
+
+    def __call__(self):
+        now = self.now
+        self.now += self.tick
+        return now
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("chat.ratelimit.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def limiter(self, **limits):
+        return RateLimiter({"DEFAULT": {SOCKET: None, USER: None}, **limits})
+
+    def take(self, limiter, store, action, count, user_id=1):
+        return [limiter.check(user_id, store, action) for _ in range(count)]
+
+    def test_socket_bucket_allows_burst_then_refills(self):
+        limiter = self.limiter(ping={SOCKET: (2, 3)})
+        store = limiter.socket_buckets()
+        self.assertEqual(self.take(limiter, store, "ping", 3), [None] * 3)
+        self.assertEqual(limiter.check(1, store, "ping"), (SOCKET, 0.5))
+
+        self.clock.now += 0.5
+        self.assertIsNone(limiter.check(1, store, "ping"))
+        self.assertIsNotNone(limiter.check(1, store, "ping"))
+
+    def test_new_bucket_is_full(self):
+        limiter = self.limiter(ping={SOCKET: (0.5, 1)}, pong={USER: (0.5, 1)})
+        self.clock.tick = 0.001
+        store = limiter.socket_buckets()
+        self.assertIsNone(limiter.check(1, store, "ping"))
+        self.assertIsNone(limiter.check(1, store, "pong"))
+
+    def test_socket_buckets_are_per_socket(self):
+        limiter = self.limiter(ping={SOCKET: (1, 1)})
+        first, second = limiter.socket_buckets(), limiter.socket_buckets()
+        self.assertIsNone(limiter.check(1, first, "ping"))
+        self.assertIsNotNone(limiter.check(1, first, "ping"))
+        self.assertIsNone(limiter.check(1, second, "ping"))
+
+    def test_user_bucket_is_shared_by_sockets(self):
+        limiter = self.limiter(ping={SOCKET: (1, 5), USER: (1, 2)})
+        first, second = limiter.socket_buckets(), limiter.socket_buckets()
+        self.assertIsNone(limiter.check(1, first, "ping"))
+        self.assertIsNone(limiter.check(1, second, "ping"))
+        self.assertEqual(limiter.check(1, second, "ping"), (USER, 1.0))
+        # Other users have their own
+        self.assertIsNone(limiter.check(2, second, "ping"))
+
+    def test_buckets_are_per_action(self):
+        limiter = self.limiter(ping={SOCKET: (1, 1)}, get_users={SOCKET: (1, 1)})
+        store = limiter.socket_buckets()
+        self.assertIsNone(limiter.check(1, store, "ping"))
+        self.assertIsNotNone(limiter.check(1, store, "ping"))
+        self.assertIsNone(limiter.check(1, store, "get_users"))
+
+    def test_unlisted_actions_use_default(self):
+        limiter = RateLimiter({"DEFAULT": {SOCKET: (1, 1)}})
+        store = limiter.socket_buckets()
+        self.assertIsNone(limiter.check(1, store, "anything"))
+        self.assertEqual(limiter.check(1, store, "anything")[0], SOCKET)
+
+    def test_refusal_takes_no_token(self):
+        limiter = self.limiter(ping={SOCKET: (1, 2), USER: (1, 1)})
+        store = limiter.socket_buckets()
+        self.assertIsNone(limiter.check(1, store, "ping"))
+        # Refused by the user bucket: the socket bucket keeps its last token
+        self.assertEqual(limiter.check(1, store, "ping")[0], USER)
+        self.assertIsNone(limiter.check(2, store, "ping"))
+
+    def test_user_buckets_are_bounded(self):
+        limiter = RateLimiter({"DEFAULT": {USER: (1, 1)}}, max_users=2)
+        store = limiter.socket_buckets()
+        for user_id in (1, 2, 3):
+            self.assertIsNone(limiter.check(user_id, store, "ping"))
+        # User 1's bucket was the least recently used and is gone, so full again
+        self.assertIsNone(limiter.check(1, store, "ping"))
+        self.assertIsNotNone(limiter.check(3, store, "ping"))
+
+
+class InboxTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = ChatConsumer()
+        self.consumer.inbox = deque()
+        self.consumer.inbox_ready = asyncio.Event()
+        self.consumer.queued = set()
+
+    def enqueue(self, action, internal=False, **arguments):
+        return self.consumer.enqueue(action, None, arguments, 0.0, internal=internal)
+
+    def queued_actions(self):
+        return [(action, arguments) for action, _, arguments, _, _ in self.consumer.inbox]
+
+    def test_redundant_get_users_are_merged(self):
+        self.assertTrue(self.enqueue("get_users"))
+        self.assertTrue(self.enqueue("get_users"))
+        self.assertTrue(self.enqueue("get_users", prefix="a"))
+        self.assertEqual(self.queued_actions(), [("get_users", {}), ("get_users", {"prefix": "a"})])
+
+    def test_merging_ends_once_taken(self):
+        self.enqueue("get_users")
+        self.consumer.inbox.popleft()
+        self.consumer.queued.clear()
+        self.enqueue("get_users")
+        self.assertEqual(len(self.consumer.inbox), 1)
+
+    def test_other_actions_are_not_merged(self):
+        self.enqueue("ping")
+        self.enqueue("ping")
+        self.assertEqual(len(self.consumer.inbox), 2)
+
+    @override_settings(CHAT_INBOUND_QUEUE_SIZE=2)
+    def test_inbox_is_bounded(self):
+        self.assertTrue(self.enqueue("ping"))
+        self.assertTrue(self.enqueue("ping"))
+        self.assertFalse(self.enqueue("ping"))
+        # A merged duplicate takes no room
+        self.consumer.inbox.clear()
+        self.enqueue("get_users")
+        self.enqueue("ping")
+        self.assertTrue(self.enqueue("get_users"))
+        # Nor is the server's own work refused
+        self.assertTrue(self.enqueue("refresh_user_lists", internal=True))
+        self.assertEqual(len(self.consumer.inbox), 3)
+
+
+class ThrottledFrameTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user("alice", password="x")
+
+    async def test_rate_limited_action_gets_throttled_frame(self):
+        limiter = RateLimiter({"ping": {SOCKET: (0.5, 1)}})
+        with mock.patch.object(consumers, "rate_limiter", limiter):
+            communicator = await connect(self.alice)
+            await communicator.send_json_to({"action": "ping"})
+            await receive_type(communicator, "pong")
+            await communicator.send_json_to({"action": "ping"})
+            error = await receive_type(communicator, "error")
+            await communicator.disconnect()
+        self.assertEqual((error["code"], error["action"]), ("throttled", "ping"))
+        self.assertGreater(error["retry_after"], 0)
+        self.assertLessEqual(error["retry_after"], 2)
+
+    @override_settings(CHAT_INBOUND_QUEUE_SIZE=0)
+    async def test_full_inbox_gets_throttled_frame(self):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "ping"})
+        error = await receive_type(communicator, "error")
+        await communicator.disconnect()
+        self.assertEqual((error["code"], error["action"]), ("throttled", "ping"))
+        self.assertEqual(error["message"], "Too many requests in progress")
+        self.assertNotIn("retry_after", error)
@@ -0,0 +1,119 @@
+import socket
+import unittest
+
+from django.test import SimpleTestCase
+
+from chat import codec
+from chat.testing import LocalCluster
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+
+def free_ports(count):
+    """A run of `count` consecutive ports nothing is listening on, most likely."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        start = probe.getsockname()[1]
+    return start if start + count < 65536 else start - count
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+@unittest.skipIf(websockets is None, "websockets is not installed")
+class CrossWorkerTests(SimpleTestCase):
+    """
+    Delivery between runworkers processes sharing sharded stand-in Redis
+    servers. Each test uses its own users, the cluster is shared.
+    """
+
+    workers = 3
+
+    @classmethod
+    def setUpClass(cls):
+        # Seeded before SimpleTestCase closes off database access
+        cls.cluster = LocalCluster(workers=cls.workers, shards=2, users=10, port=free_ports(cls.workers))
+        cls.cluster.start()
+        try:
+            super().setUpClass()
+        except BaseException:
+            cls.cluster.stop()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.cluster.stop()
+
+    def setUp(self):
+        self.sockets = []
+
+    async def open(self, user_index, worker):
+        client = await self.cluster.open(self.cluster.users[user_index], worker)
+        self.sockets.append(client)
+        return client
+
+    async def close_all(self):
+        # A failed test leaves its sockets to the workers' shutdown
+        for client in self.sockets:
+            await client.close()
+
+    async def test_presence_is_shared(self):
+        a, b = self.cluster.users[0:2]
+        b_socket = await self.open(1, 1)
+        await self.open(0, 0)
+        update = await self.cluster.expect(
+            b_socket, lambda f: f.get("type") == "presence_update" and f.get("username") == a.username
+        )
+        self.assertIsNotNone(update, "presence update did not reach a peer on another worker")
+        # A second socket on another worker is not announced again
+        await self.open(0, 2)
+        self.assertIsNone(await self.cluster.expect(b_socket, lambda f: f.get("type") == "presence_update", 1.0))
+        await self.close_all()
+
+    async def test_message_reaches_other_workers(self):
+        b = self.cluster.users[3]
+        a_first = await self.open(2, 0)
+        a_second = await self.open(2, 2)
+        b_socket = await self.open(3, 1)
+        await a_first.send({"action": "send_message", "receiver": b.username, "body": "hello", "client_id": "1"})
+        is_message = lambda f: f.get("type") == "message" and f.get("body") == "hello"
+        self.assertIsNotNone(await self.cluster.expect(b_socket, is_message), "receiver")
+        self.assertIsNotNone(await self.cluster.expect(a_second, is_message), "sender's other socket")
+        await self.close_all()
+
+    async def test_relationship_change_reaches_other_workers(self):
+        a, c = self.cluster.users[4], self.cluster.users[6]
+        a_socket = await self.open(4, 0)
+        c_socket = await self.open(6, 2)
+        is_users = lambda f: f.get("type") == "update_users"
+        await c_socket.send({"action": "get_users"})
+        before = await self.cluster.expect(c_socket, is_users)
+        self.assertNotIn(a.username, before["pending_requests"])
+
+        await a_socket.send({"action": "send_request", "receiver": c.username})
+        notification = await self.cluster.expect(c_socket, lambda f: f.get("type") == "notification")
+        self.assertIsNotNone(notification, "notification")
+        # c's worker serves its lists from its cache, which the change reached
+        await c_socket.send({"action": "get_users"})
+        after = await self.cluster.expect(c_socket, is_users)
+        self.assertIn(a.username, after["pending_requests"])
+        await self.close_all()
+
+    async def test_group_send_from_outside_reaches_every_socket(self):
+        a = self.cluster.users[8]
+        sockets = [await self.open(8, 0), await self.open(8, 1)]
+        event = {"type": "chat_message", **codec.encode_broadcast({"type": "message", "body": "from outside"})}
+        try:
+            await self.cluster.layer.group_send(f"user_{a.id}", event)
+        finally:
+            await self.cluster.layer.flush()
+        for client in sockets:
+            frame = await self.cluster.expect(client, lambda f: f.get("body") == "from outside")
+            self.assertIsNotNone(frame)
+        await self.close_all()
@@ -0,0 +1,174 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import search, services
+from chat.cache import relationship_cache
+from chat.search import SearchIndex
+from chat.usernames import user_map
+
+from .base import ChatTestCase, connect, receive_type
+
+
+def befriend(first, second):
+    services.send_connection_request(first, second.username)
+    services.approve_connection_request(second, first.username)
+
+
+class SearchIndexTests(TestCase):
+    def setUp(self):
+        for username in ("alice", "Alicia", "alison", "bob", "carol"):
+            User.objects.create(username=username)
+        # The signal handlers keep the module's index current
+        patcher = mock.patch.object(search, "search_index", SearchIndex(refresh_interval=3600))
+        self.index = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_prefix_matches_ignore_case_in_order(self):
+        self.assertEqual(self.index.search("ali", fuzzy=False), ["alice", "Alicia", "alison"])
+        self.assertEqual(self.index.search("ALIC", fuzzy=False), ["alice", "Alicia"])
+        self.assertEqual(self.index.search("ali", limit=2, fuzzy=False), ["alice", "Alicia"])
+        self.assertEqual(self.index.search("dave", fuzzy=False), [])
+
+    def test_searching_user_is_excluded(self):
+        self.assertEqual(self.index.search("ali", fuzzy=False, exclude="alice"), ["Alicia", "alison"])
+
+    def test_fuzzy_matches_follow_prefix_matches(self):
+        self.assertEqual(self.index.search("carl"), ["carol"])
+        self.assertEqual(self.index.search("carl", fuzzy=False), [])
+        results = self.index.search("alis")
+        self.assertEqual(results[0], "alison")
+        self.assertIn("alice", results[1:])
+
+    def test_registration_updates_the_index(self):
+        self.index.search("a")
+        user = User.objects.create(username="alina")
+        self.assertEqual(self.index.search("alin", fuzzy=False), ["alina"])
+        user.delete()
+        self.assertEqual(self.index.search("alin", fuzzy=False), [])
+
+    def test_limit_is_clamped(self):
+        with self.settings(CHAT_SEARCH={"MAX_RESULTS": 10}):
+            self.assertEqual(search.get_limit(1000), 10)
+            self.assertEqual(search.get_limit(0), 1)
+            self.assertEqual(search.get_limit("many"), 10)
+
+
+class SuggestionTests(TestCase):
+    def setUp(self):
+        relationship_cache.clear()
+        user_map.clear()
+        search.suggestion_results.clear()
+        self.alice, self.bob, self.carol, self.dave, self.erin = [
+            User.objects.create(username=username)
+            for username in ("alice", "bob", "carol", "dave", "erin")
+        ]
+
+    def suggestions(self, user=None, limit=20):
+        return search.get_suggestions(user or self.alice, limit)
+
+    def test_friends_of_friends_by_mutual_connections(self):
+        befriend(self.alice, self.bob)
+        befriend(self.alice, self.carol)
+        befriend(self.bob, self.dave)
+        befriend(self.carol, self.dave)
+        befriend(self.carol, self.erin)
+        # An edge between two friends suggests neither
+        befriend(self.bob, self.carol)
+        self.assertEqual(
+            self.suggestions(),
+            [{"username": "dave", "mutual": 2}, {"username": "erin", "mutual": 1}],
+        )
+        self.assertEqual(self.suggestions(limit=1), [{"username": "dave", "mutual": 2}])
+
+    def test_users_with_a_request_are_not_suggested(self):
+        befriend(self.alice, self.bob)
+        befriend(self.bob, self.carol)
+        befriend(self.bob, self.dave)
+        services.send_connection_request(self.alice, "carol")
+        services.send_connection_request(self.dave, "alice")
+        self.assertEqual(self.suggestions(), [])
+
+    def test_expansion_is_bounded(self):
+        befriend(self.alice, self.bob)
+        befriend(self.alice, self.carol)
+        befriend(self.bob, self.dave)
+        befriend(self.carol, self.erin)
+        with mock.patch.dict(search._suggestion_options, {"MAX_FRIENDS": 1}):
+            # Only bob, the first friend, is expanded
+            self.assertEqual(self.suggestions(), [{"username": "dave", "mutual": 1}])
+        search.suggestion_results.clear()
+        with mock.patch.dict(search._suggestion_options, {"MAX_EDGES": 2}), \
+                CaptureQueriesContext(connection) as queries:
+            self.suggestions()
+        [edges] = [query["sql"] for query in queries if "chat_userconnection" in query["sql"]]
+        self.assertIn("LIMIT 2", edges)
+
+    def test_friends_connections_are_read_in_one_query(self):
+        befriend(self.alice, self.bob)
+        befriend(self.alice, self.carol)
+        befriend(self.bob, self.dave)
+        services.get_relationship_snapshot(self.alice)
+        user_map.usernames_for([self.dave.id])
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.suggestions()), 1)
+
+    def test_suggestions_are_cached(self):
+        befriend(self.alice, self.bob)
+        befriend(self.bob, self.dave)
+        self.suggestions()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggestions(limit=5), [{"username": "dave", "mutual": 1}])
+
+    def test_own_connections_refresh_cached_suggestions(self):
+        befriend(self.bob, self.dave)
+        self.assertEqual(self.suggestions(), [])
+        befriend(self.alice, self.bob)
+        self.assertEqual(self.suggestions(), [{"username": "dave", "mutual": 1}])
+
+
+class SearchActionTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        search.suggestion_results.clear()
+        self.alice = User.objects.create(username="alice")
+        self.alicia = User.objects.create(username="alicia")
+        self.bob = User.objects.create(username="bob")
+        patcher = mock.patch.object(search, "search_index", SearchIndex(refresh_interval=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_search_users(self):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "search_users", "query": "ali"})
+        results = await receive_type(communicator, "search_results")
+        await communicator.disconnect()
+        self.assertEqual((results["query"], results["users"]), ("ali", ["alicia"]))
+
+    async def test_suggestions(self):
+        await sync_to_async(befriend)(self.alice, self.bob)
+        await sync_to_async(befriend)(self.bob, self.alicia)
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "get_suggestions"})
+        suggestions = await receive_type(communicator, "suggestions")
+        await communicator.disconnect()
+        self.assertEqual(suggestions["users"], [{"username": "alicia", "mutual": 1}])
+
+    def test_search_endpoint(self):
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {AccessToken.for_user(self.bob)}"}
+        response = self.client.get("/chat/api/users/search/", {"q": "Ali", "fuzzy": "0"}, **headers)
+        self.assertEqual(response.json(), {"query": "Ali", "users": ["alice", "alicia"]})
+        self.assertEqual(self.client.get("/chat/api/users/search/", **headers).status_code, 400)
+
+    def test_suggestions_endpoint(self):
+        befriend(self.alice, self.bob)
+        befriend(self.bob, self.alicia)
+        response = self.client.get(
+            "/chat/api/users/suggestions/", HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.alice)}"
+        )
+        self.assertEqual(response.json(), {"users": [{"username": "alicia", "mutual": 1}]})
@@ -0,0 +1,191 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from chat import deltas, services
+from chat.models import UserConnection
+
+from .base import ChatTestCase, connect, receive_type
+
+
+def raw_created_at(sender, receiver):
+    """created_at of the sender -> receiver row as the database driver returns it."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT created_at FROM "{UserConnection._meta.db_table}" WHERE sender_id = %s AND receiver_id = %s',
+            [sender.id, receiver.id],
+        )
+        return cursor.fetchone()[0]
+
+
+def statements(queries, verb):
+    return [query["sql"] for query in queries if query["sql"].upper().startswith(verb)]
+
+
+class TransitionTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+
+    def connection(self):
+        return UserConnection.objects.get(sender=self.alice, receiver=self.bob)
+
+    def test_sent_request_is_stored_as_the_orm_stores_it(self):
+        services.send_connection_request(self.alice, "bob")
+        # Through the ORM, with the same time (created_at is auto_now_add)
+        UserConnection.objects.create(sender=self.bob, receiver=self.alice)
+        UserConnection.objects.filter(sender=self.bob).update(created_at=self.connection().created_at)
+        self.assertEqual(raw_created_at(self.alice, self.bob), raw_created_at(self.bob, self.alice))
+
+    def test_repeated_send_is_a_no_op(self):
+        self.assertEqual(services.send_connection_request(self.alice, "bob"), self.bob.id)
+        created_at = self.connection().created_at
+        revision = deltas.journal.current()
+
+        self.assertIsNone(services.send_connection_request(self.alice, "bob"))
+        self.assertEqual(UserConnection.objects.count(), 1)
+        self.assertEqual(self.connection().created_at, created_at)
+        self.assertEqual(deltas.journal.current(), revision)
+
+    def test_repeated_approve_is_a_no_op(self):
+        services.send_connection_request(self.alice, "bob")
+        self.assertEqual(services.approve_connection_request(self.bob, "alice"), self.alice.id)
+        updated_at = self.connection().updated_at
+        revision = deltas.journal.current()
+
+        self.assertIsNone(services.approve_connection_request(self.bob, "alice"))
+        self.assertEqual(self.connection().status, UserConnection.Status.APPROVED)
+        self.assertEqual(self.connection().updated_at, updated_at)
+        self.assertEqual(deltas.journal.current(), revision)
+        # Nor does sending again undo the approval
+        self.assertIsNone(services.send_connection_request(self.alice, "bob"))
+        self.assertEqual(self.connection().status, UserConnection.Status.APPROVED)
+
+    def test_repeated_reject_is_a_no_op(self):
+        services.send_connection_request(self.alice, "bob")
+        self.assertEqual(services.reject_connection_request(self.bob, "alice"), self.alice.id)
+        revision = deltas.journal.current()
+
+        self.assertIsNone(services.reject_connection_request(self.bob, "alice"))
+        self.assertFalse(UserConnection.objects.exists())
+        self.assertEqual(deltas.journal.current(), revision)
+
+    def test_reject_is_one_conditional_delete(self):
+        services.send_connection_request(self.alice, "bob")
+        services.resolve_user("alice")  # in the user map, as it is once warm
+        with self.assertNumQueries(1), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(services.reject_connection_request(self.bob, "alice"), self.alice.id)
+        [delete] = statements(queries, "DELETE")
+        self.assertIn('"status"', delete)
+        self.assertFalse(UserConnection.objects.exists())
+
+    def test_reject_leaves_approved_connection(self):
+        services.send_connection_request(self.alice, "bob")
+        services.approve_connection_request(self.bob, "alice")
+        self.assertIsNone(services.reject_connection_request(self.bob, "alice"))
+        self.assertEqual(self.connection().status, UserConnection.Status.APPROVED)
+
+
+class BulkTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="x")
+        self.peers = [User.objects.create_user(f"peer{i}", password="x") for i in range(4)]
+
+    def request_all(self):
+        for peer in self.peers:
+            services.send_connection_request(peer, "alice")
+
+    def test_send_reports_skipped(self):
+        services.send_connection_request(self.alice, "peer0")
+        sent, skipped = services.send_connection_requests(
+            self.alice, ["peer0", "peer1", "nobody", self.peers[2].id, 999999]
+        )
+        self.assertEqual(sorted(user.username for user in sent), ["peer1", "peer2"])
+        self.assertEqual(skipped, ["peer0", "nobody", 999999])
+        self.assertEqual(UserConnection.objects.filter(sender=self.alice).count(), 3)
+
+    def test_bulk_sent_request_is_stored_as_the_orm_stores_it(self):
+        services.send_connection_requests(self.alice, ["peer0"])
+        created_at = UserConnection.objects.get(sender=self.alice).created_at
+        self.assertIsNotNone(created_at.tzinfo)
+        UserConnection.objects.create(sender=self.peers[1], receiver=self.alice)
+        UserConnection.objects.filter(sender=self.peers[1]).update(created_at=created_at)
+        self.assertEqual(raw_created_at(self.alice, self.peers[0]), raw_created_at(self.peers[1], self.alice))
+
+    def test_approve_reports_skipped(self):
+        services.send_connection_request(self.peers[0], "alice")
+        services.send_connection_request(self.alice, "peer1")  # the other direction
+        approved, skipped = services.approve_connection_requests(self.alice, ["peer0", "peer1", "nobody"])
+        self.assertEqual([user.username for user in approved], ["peer0"])
+        self.assertEqual(skipped, ["peer1", "nobody"])
+
+    def test_reject_reports_skipped(self):
+        services.send_connection_request(self.peers[0], "alice")
+        rejected, skipped = services.reject_connection_requests(self.alice, ["peer0", "peer0x"])
+        self.assertEqual([user.username for user in rejected], ["peer0"])
+        self.assertEqual(skipped, ["peer0x"])
+        self.assertFalse(UserConnection.objects.exists())
+
+    def test_bulk_reject_is_one_conditional_delete(self):
+        self.request_all()
+        with CaptureQueriesContext(connection) as queries:
+            rejected, _ = services.reject_connection_requests(self.alice, ["peer0", "peer1"])
+        self.assertEqual(len(rejected), 2)
+        self.assertEqual(len(statements(queries, "SELECT")), 1)
+        [delete] = statements(queries, "DELETE")
+        self.assertIn('"status"', delete)
+        self.assertEqual(UserConnection.objects.count(), 2)
+
+    @override_settings(CHAT_BULK_MAX_SIZE=3)
+    def test_all_pending_is_capped_oldest_first(self):
+        self.request_all()
+        approved, skipped = services.approve_connection_requests(self.alice)
+        self.assertEqual([user.username for user in approved], ["peer0", "peer1", "peer2"])
+        self.assertEqual(skipped, [])
+        # The rest is left for the next call
+        approved, _ = services.approve_connection_requests(self.alice)
+        self.assertEqual([user.username for user in approved], ["peer3"])
+        self.assertEqual(services.approve_connection_requests(self.alice), ([], []))
+
+    @override_settings(CHAT_BULK_MAX_SIZE=2)
+    def test_named_senders_are_capped(self):
+        self.request_all()
+        rejected, _ = services.reject_connection_requests(self.alice, ["peer3", "peer2", "peer1"])
+        self.assertEqual(len(rejected), 2)
+        self.assertEqual(UserConnection.objects.count(), 2)
+
+
+class BulkActionTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user("alice", password="x")
+        self.peers = [User.objects.create_user(f"peer{i}", password="x") for i in range(3)]
+        for peer in self.peers:
+            services.send_connection_request(peer, "alice")
+
+    async def test_approve_all(self):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "approve_requests", "all": True})
+        result = await receive_type(communicator, "bulk_result")
+        await communicator.disconnect()
+        self.assertEqual((result["action"], result["count"], result["skipped"]), ("approve_requests", 3, []))
+        self.assertEqual(
+            await UserConnection.objects.filter(status=UserConnection.Status.APPROVED).acount(), 3
+        )
+
+    async def test_senders_or_all_is_required(self):
+        communicator = await connect(self.alice)
+        await communicator.send_json_to({"action": "reject_requests"})
+        error = await receive_type(communicator, "error")
+        await communicator.disconnect()
+        self.assertEqual(error["message"], "senders or all is required")
+        self.assertEqual(await UserConnection.objects.acount(), 3)
+
+    async def test_oversized_list_is_refused(self):
+        communicator = await connect(self.alice)
+        receivers = [f"user{i}" for i in range(services.get_bulk_max_size() + 1)]
+        await communicator.send_json_to({"action": "send_requests", "receivers": receivers})
+        error = await receive_type(communicator, "error")
+        await communicator.disconnect()
+        self.assertIn("at most", error["message"])
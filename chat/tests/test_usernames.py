@@ -0,0 +1,105 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from chat import search, services
+from chat.models import UserConnection
+from chat.search import SearchIndex
+from chat.usernames import UserMap, user_map
+from chat.writebehind import write_queue
+
+from .base import ChatTestCase, connect, receive_type
+
+
+class UserMapTests(TestCase):
+    def setUp(self):
+        user_map.clear()
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+    def test_lookups_both_ways(self):
+        users = UserMap()
+        self.assertEqual(users.ids_for(["alice", "bob", "nobody"]), {"alice": self.alice.id, "bob": self.bob.id})
+        self.assertEqual(users.usernames_for([self.alice.id]), {self.alice.id: "alice"})
+        with self.assertNumQueries(0):
+            self.assertEqual(users.id_for("bob"), self.bob.id)
+
+    def test_no_query_when_not_allowed(self):
+        users = UserMap()
+        with self.assertNumQueries(0):
+            self.assertEqual(users.ids_for(["alice"], query=False), {})
+
+    def test_saves_and_deletes_keep_it_current(self):
+        user_map.ids_for(["alice"])
+        self.alice.username = "alicia"
+        self.alice.save()
+        carol = User.objects.create(username="carol")
+        with self.assertNumQueries(0):
+            self.assertEqual(user_map.ids_for(["alice", "alicia", "carol"], query=False), {
+                "alicia": self.alice.id, "carol": carol.id,
+            })
+        self.bob.delete()
+        self.assertEqual(user_map.ids_for(["bob"], query=False), {})
+
+
+class IdModeTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.carol = User.objects.create(username="carol")
+        UserConnection.objects.create(sender=self.alice, receiver=self.bob, status=UserConnection.Status.APPROVED)
+        UserConnection.objects.create(sender=self.carol, receiver=self.alice)
+        patcher = mock.patch.object(search, "search_index", SearchIndex(refresh_interval=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect_ids(self, user):
+        communicator = await connect(user)
+        await communicator.send_json_to({"action": "init_connection", "user_ids": True})
+        presence = await receive_type(communicator, "presence")
+        users = await receive_type(communicator, "update_users")
+        return communicator, presence, users
+
+    async def test_user_lists_carry_ids(self):
+        communicator, _, users = await self.connect_ids(self.alice)
+        await communicator.disconnect()
+        self.assertEqual(users["users"], [self.bob.id, self.carol.id])
+        self.assertEqual(users["mutual_connections"], [self.bob.id])
+        self.assertEqual(users["pending_requests"], [self.carol.id])
+
+    async def test_presence_carries_ids(self):
+        bob = await connect(self.bob)
+        communicator, presence, _ = await self.connect_ids(self.alice)
+        await communicator.disconnect()
+        await bob.disconnect()
+        self.assertEqual(presence["online"], [self.bob.id])
+
+    async def test_actions_take_and_frames_carry_ids(self):
+        communicator, _, _ = await self.connect_ids(self.alice)
+        bob = await connect(self.bob)
+        await communicator.send_json_to({"action": "send_message", "receiver": self.bob.id, "body": "hi"})
+        received = await receive_type(bob, "message")
+        self.assertEqual((received["sender"], received["recipient"]), ("alice", "bob"))
+        # The sender's id-mode socket gets its copy with ids
+        echoed = await receive_type(communicator, "message")
+        self.assertEqual((echoed["sender"], echoed["recipient"]), (self.alice.id, self.bob.id))
+        await write_queue.sync()
+
+        await communicator.send_json_to({"action": "search_users", "query": "car"})
+        results = await receive_type(communicator, "search_results")
+        await communicator.disconnect()
+        await bob.disconnect()
+        self.assertEqual(results["users"], [self.carol.id])
+
+    async def test_requests_by_id(self):
+        communicator, _, _ = await self.connect_ids(self.alice)
+        await communicator.send_json_to({"action": "approve_request", "sender": self.carol.id})
+        users = await receive_type(communicator, "update_users")
+        await communicator.disconnect()
+        self.assertEqual(users["mutual_connections"], [self.bob.id, self.carol.id])
+        self.assertTrue(await sync_to_async(
+            UserConnection.objects.filter(sender=self.carol, status=UserConnection.Status.APPROVED).exists
+        )())
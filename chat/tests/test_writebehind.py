@@ -0,0 +1,105 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.db import IntegrityError, OperationalError
+
+from chat import consumers
+from chat.models import Message, UserConnection
+from chat.writebehind import WriteBehindQueue, WriteBehindQueueFull
+
+from .base import ChatTestCase, connect, receive_type
+
+
+class WriteBehindQueueTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+        self.queue = WriteBehindQueue(flush_interval=0.01, max_retry_delay=0)
+
+    def message(self, body="hello"):
+        return Message(
+            conversation=Message.conversation_key(self.alice.id, self.bob.id),
+            sender=self.alice, recipient=self.bob, body=body,
+        )
+
+    def bodies(self):
+        return sorted(Message.objects.values_list("body", flat=True))
+
+    def fail_first(self, count, error):
+        """Make the queue's first `count` writes raise `error`."""
+        write = self.queue._write
+        calls = []
+
+        def flaky(batch):
+            calls.append(len(batch))
+            if len(calls) <= count:
+                raise error
+            return write(batch)
+
+        return mock.patch.object(self.queue, "_write", side_effect=flaky), calls
+
+    def test_drain_sync_writes_batch_in_flight(self):
+        # As if the worker had taken the batch off the queue and the process
+        # exited before writing it
+        self.queue._pending = [(self.message("in flight"), None)]
+        self.queue.drain_sync()
+        self.assertEqual(self.bodies(), ["in flight"])
+        # Written once only
+        self.queue.drain_sync()
+        self.assertEqual(self.bodies(), ["in flight"])
+
+    async def test_aclose_writes_everything_queued(self):
+        for i in range(5):
+            await self.queue.submit(self.message(f"m{i}"))
+        await self.queue.aclose()
+        self.assertEqual(await sync_to_async(self.bodies)(), [f"m{i}" for i in range(5)])
+        with self.assertRaises(WriteBehindQueueFull):
+            await self.queue.submit(self.message())
+
+    async def test_unavailable_database_is_retried(self):
+        patch, calls = self.fail_first(3, OperationalError("database is locked"))
+        with patch, self.assertLogs("chat.writebehind", "ERROR"):
+            await self.queue.submit(self.message())
+            await self.queue.sync()
+        self.assertEqual(len(calls), 4)
+        self.assertEqual((self.queue.written, self.queue.failed), (1, 0))
+        self.assertEqual(await sync_to_async(self.bodies)(), ["hello"])
+        await self.queue.aclose()
+
+    async def test_refused_row_is_reported_and_the_rest_written(self):
+        reported = []
+
+        async def on_failure(error):
+            reported.append(error)
+
+        with self.assertLogs("chat.writebehind", "ERROR"):
+            await self.queue.submit(self.message("good"))
+            # NOT NULL body: the batch is refused, then this row on its own
+            await self.queue.submit(self.message(None), on_failure)
+            await self.queue.sync()
+        self.assertEqual(len(reported), 1)
+        self.assertIsInstance(reported[0], IntegrityError)
+        self.assertEqual((self.queue.written, self.queue.failed), (1, 1))
+        self.assertEqual(await sync_to_async(self.bodies)(), ["good"])
+        await self.queue.aclose()
+
+
+class UnsavedMessageTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user("alice", password="x")
+        self.bob = User.objects.create_user("bob", password="x")
+        UserConnection.objects.create(sender=self.alice, receiver=self.bob, status=UserConnection.Status.APPROVED)
+
+    async def test_sender_is_told_with_client_id(self):
+        queue = WriteBehindQueue(flush_interval=0)
+        refused = mock.patch.object(queue, "_write", side_effect=IntegrityError("refused"))
+        with mock.patch.object(consumers, "write_queue", queue), refused, self.assertLogs("chat.writebehind", "ERROR"):
+            communicator = await connect(self.alice)
+            await communicator.send_json_to({"action": "send_message", "receiver": "bob", "body": "hi", "client_id": "7"})
+            await receive_type(communicator, "message_ack")
+            error = await receive_type(communicator, "error")
+            await communicator.disconnect()
+        self.assertEqual((error["code"], error["client_id"]), ("message_not_saved", "7"))
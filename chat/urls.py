@@ -1,7 +1,18 @@
 from django.urls import path
-from .views import register_view, login_view
+from .views import (
+    register_view, login_view, get_user_lists, cache_stats, metrics_view,
+    send_requests, approve_requests, reject_requests, search_users, get_suggestions,
+)
 
 urlpatterns = [
     path("api/register/", register_view, name="register"),
     path("api/login/", login_view, name="login"),
+    path("api/users/", get_user_lists, name="user_lists"),
+    path("api/users/search/", search_users, name="search_users"),
+    path("api/users/suggestions/", get_suggestions, name="suggestions"),
+    path("api/requests/send/", send_requests, name="send_requests"),
+    path("api/requests/approve/", approve_requests, name="approve_requests"),
+    path("api/requests/reject/", reject_requests, name="reject_requests"),
+    path("api/stats/cache/", cache_stats, name="cache_stats"),
+    path("metrics/", metrics_view, name="metrics"),
 ]
@@ -0,0 +1,132 @@
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+
+
+class UserMap:
+    """
+    In-process map between user ids and usernames, in both directions, so
+    hot queries can select bare ids and actions addressed by username (or,
+    in id mode, by id) skip the user table.
+
+    The first lookup that may query loads every user, up to `warm_limit`;
+    after that only users the map has not seen cost a query. Saves and
+    deletes in this process keep it current. A user renamed or deleted by
+    another process keeps its old entry here until this process sees it.
+    """
+
+    def __init__(self, warm_limit=1_000_000):
+        self.warm_limit = warm_limit
+        self._usernames = {}  # user id -> username
+        self._ids = {}  # username -> user id
+        self._lock = threading.Lock()
+        self._warmed = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._usernames)
+
+    def warm(self):
+        users = User.objects.order_by("id").values_list("id", "username")[:self.warm_limit]
+        self.update(users.iterator(chunk_size=10000))
+        self._warmed = True
+
+    def _ensure_warm(self):
+        with self._lock:
+            if self._warmed:
+                return
+            # Other threads query for what they miss while this one loads
+            self._warmed = True
+        try:
+            self.warm()
+        except Exception:
+            self._warmed = False
+            raise
+
+    def update(self, pairs):
+        """Remember (user id, username) pairs."""
+        with self._lock:
+            for user_id, username in pairs:
+                previous = self._usernames.get(user_id)
+                if previous is not None and previous != username:
+                    self._ids.pop(previous, None)
+                self._usernames[user_id] = username
+                self._ids[username] = user_id
+
+    def forget(self, user_id):
+        with self._lock:
+            username = self._usernames.pop(user_id, None)
+            if username is not None and self._ids.get(username) == user_id:
+                del self._ids[username]
+
+    def ids_for(self, usernames, query=True):
+        """
+        {username: id} for those of `usernames` that exist. Usernames not in
+        the map are fetched in one query, unless `query` is False, in which
+        case they are left out.
+        """
+        if query:
+            self._ensure_warm()
+        found, missing = self._lookup(self._ids, usernames)
+        if missing and query:
+            users = list(User.objects.filter(username__in=missing).values_list("id", "username"))
+            self.update(users)
+            found.update((username, user_id) for user_id, username in users)
+        return found
+
+    def usernames_for(self, user_ids, query=True):
+        """{id: username}, the other way round from `ids_for`."""
+        if query:
+            self._ensure_warm()
+        found, missing = self._lookup(self._usernames, user_ids)
+        if missing and query:
+            users = list(User.objects.filter(id__in=missing).values_list("id", "username"))
+            self.update(users)
+            found.update(users)
+        return found
+
+    def id_for(self, username):
+        """Id of the user called `username`, or None; may query the database."""
+        return self.ids_for([username]).get(username)
+
+    def username_for(self, user_id):
+        """Username of the user with `user_id`, or None; may query the database."""
+        return self.usernames_for([user_id]).get(user_id)
+
+    def _lookup(self, mapping, keys):
+        found = {}
+        missing = set()
+        for key in keys:
+            value = mapping.get(key)
+            if value is None:
+                missing.add(key)
+            else:
+                found[key] = value
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def clear(self):
+        with self._lock:
+            self._usernames.clear()
+            self._ids.clear()
+            self._warmed = False
+
+
+_options = getattr(settings, "CHAT_USER_MAP", {})
+user_map = UserMap(warm_limit=_options.get("WARM_LIMIT", 1_000_000))
+
+
+def _user_saved(sender, instance, **kwargs):
+    user_map.update([(instance.id, instance.username)])
+
+
+def _user_deleted(sender, instance, **kwargs):
+    user_map.forget(instance.id)
+
+
+post_save.connect(_user_saved, sender=User, dispatch_uid="chat_user_map_save")
+post_delete.connect(_user_deleted, sender=User, dispatch_uid="chat_user_map_delete")
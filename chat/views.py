@@ -1,16 +1,19 @@
 import json
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.db.models import Q
 from rest_framework.decorators import api_view, authentication_classes, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .models import UserConnection
+from . import deltas
+from .notifications import notify, notify_many
+from . import search, services
+from .cache import relationship_cache
+from .metrics import registry
 
 @csrf_exempt
 def register_view(request):
@@ -18,7 +21,8 @@ def register_view(request):
         data = json.loads(request.body)
         if User.objects.filter(username=data["username"]).exists():
             return JsonResponse({"error": "Username already taken"}, status=400)
-        User.objects.create_user(username=data["username"], password=data["password"])
+        user = User.objects.create_user(username=data["username"], password=data["password"])
+        deltas.record_user_registered(user)
         return JsonResponse({"message": "User registered successfully"})
 
 @csrf_exempt
@@ -39,21 +43,15 @@ def send_request(request):
     receiver_username = data.get("receiver_username")
 
     try:
-        receiver = User.objects.get(username=receiver_username)
+        receiver_id = services.send_connection_request(request.user, receiver_username)
     except User.DoesNotExist:
         return JsonResponse({"error": "User does not exist"}, status=400)
 
-    if UserConnection.objects.filter(sender=request.user, receiver=receiver).exists():
+    if receiver_id is None:
         return JsonResponse({"error": "Request already sent"}, status=400)
-
-    UserConnection.objects.create(sender=request.user, receiver=receiver, status="pending")
     
     # Send real-time update
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        f"user_{receiver.id}",
-        {"type": "connection.update", "message": "New request received"}
-    )
+    notify(receiver_id, "New request received")
     return JsonResponse({"message": "Request sent successfully"})
 
 @api_view(["POST"])
@@ -61,80 +59,166 @@ def send_request(request):
 @permission_classes([IsAuthenticated])
 def accept_request(request, username):
     try:
-        sender = User.objects.get(username=username)
-        conn = UserConnection.objects.get(sender=sender, receiver=request.user, status="pending")
-        conn.status = "approved"
-        conn.save()
-        
-        # Notify both users about the mutual connection
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{sender.id}",
-            {"type": "connection.update", "message": "Your request was accepted"}
-        )
-        async_to_sync(channel_layer.group_send)(
-            f"user_{request.user.id}",
-            {"type": "connection.update", "message": "New mutual connection"}
-        )
-        return JsonResponse({"status": "Request accepted"})
-    except (User.DoesNotExist, UserConnection.DoesNotExist):
+        sender_id = services.approve_connection_request(request.user, username)
+    except User.DoesNotExist:
+        sender_id = None
+    if sender_id is None:
         return JsonResponse({"error": "Request not found"}, status=400)
 
+    # Notify both users about the mutual connection
+    notify(sender_id, "Your request was accepted")
+    notify(request.user.id, "New mutual connection")
+    return JsonResponse({"status": "Request accepted"})
+
 @api_view(["POST"])
 @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
 def reject_request(request, username):
     try:
-        sender = User.objects.get(username=username)
-        conn = UserConnection.objects.get(sender=sender, receiver=request.user, status="pending")
-        conn.delete()
-        
-        # Notify sender about rejection
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{sender.id}",
-            {"type": "connection.update", "message": "Your request was rejected"}
-        )
-        return JsonResponse({"status": "Request rejected"})
-    except (User.DoesNotExist, UserConnection.DoesNotExist):
+        sender_id = services.reject_connection_request(request.user, username)
+    except User.DoesNotExist:
+        sender_id = None
+    if sender_id is None:
         return JsonResponse({"error": "Request not found"}, status=400)
 
+    # Notify sender about rejection
+    notify(sender_id, "Your request was rejected")
+    return JsonResponse({"status": "Request rejected"})
+
+def _check_references(references):
+    # Users named by a bulk request: a list of usernames or ids
+    if not isinstance(references, list) or not all(
+        isinstance(reference, (str, int)) and not isinstance(reference, bool) for reference in references
+    ):
+        return "Expected a list of usernames or user ids"
+    if len(references) > services.get_bulk_max_size():
+        return f"At most {services.get_bulk_max_size()} users per request"
+    return None
+
+@api_view(["POST"])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def send_requests(request):
+    """
+    Send connection requests to every user in `receivers` at once.
+    """
+    receivers = json.loads(request.body).get("receivers")
+    error = _check_references(receivers)
+    if error:
+        return JsonResponse({"error": error}, status=400)
+
+    created, skipped = services.send_connection_requests(request.user, receivers)
+    notify_many([receiver.id for receiver in created], "New request received")
+    return JsonResponse({"count": len(created), "skipped": skipped})
+
+def _pending_senders(request):
+    # (senders, error) for the bulk approve and reject endpoints; senders is
+    # None when the request asks for every pending request
+    data = json.loads(request.body)
+    if data.get("all") is True:
+        return None, None
+    senders = data.get("senders")
+    return senders, _check_references(senders)
+
+@api_view(["POST"])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def approve_requests(request):
+    """
+    Approve the pending requests from every user in `senders`, or all of them
+    (up to CHAT_BULK_MAX_SIZE, oldest first) with `"all": true`.
+    """
+    senders, error = _pending_senders(request)
+    if error:
+        return JsonResponse({"error": error}, status=400)
+
+    approved, skipped = services.approve_connection_requests(request.user, senders)
+    if approved:
+        notify_many([sender.id for sender in approved], "Your request was accepted")
+        notify(request.user.id, "New mutual connection")
+    return JsonResponse({"count": len(approved), "skipped": skipped})
+
+@api_view(["POST"])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def reject_requests(request):
+    """
+    Reject the pending requests from every user in `senders`, or all of them
+    (up to CHAT_BULK_MAX_SIZE, oldest first) with `"all": true`.
+    """
+    senders, error = _pending_senders(request)
+    if error:
+        return JsonResponse({"error": error}, status=400)
+
+    rejected, skipped = services.reject_connection_requests(request.user, senders)
+    notify_many([sender.id for sender in rejected], "Your request was rejected")
+    return JsonResponse({"count": len(rejected), "skipped": skipped})
+
 @api_view(["GET"])
 @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
 def get_user_lists(request):
     """
-    Get all users, sent requests, pending requests, and mutual connections for the current user
+    Get a page of users, sent requests, pending requests, and mutual connections for the current user.
+    Accepts optional `cursor`, `prefix` and `page_size` query parameters for paging the user directory.
     """
-    # Get all users except the current user
-    all_users = User.objects.exclude(username=request.user.username).values_list("username", flat=True)
-    
-    # Get sent requests
-    sent_requests = UserConnection.objects.filter(
-        sender=request.user, 
-        status="pending"
-    ).values_list("receiver__username", flat=True)
-    
-    # Get pending requests
-    pending_requests = UserConnection.objects.filter(
-        receiver=request.user, 
-        status="pending"
-    ).values_list("sender__username", flat=True)
-    
-    # Get mutual connections (approved connections)
-    mutual_connections = list(UserConnection.objects.filter(
-        status="approved"
-    ).filter(
-        sender=request.user
-    ).values_list("receiver__username", flat=True)) + list(UserConnection.objects.filter(
-        status="approved"
-    ).filter(
-        receiver=request.user
-    ).values_list("sender__username", flat=True))
-    
-    return JsonResponse({
-        "users": list(all_users),
-        "sent_requests": list(sent_requests),
-        "pending_requests": list(pending_requests),
-        "mutual_connections": list(mutual_connections)
-    })
+    user_lists = services.get_user_lists(
+        request.user,
+        cursor=request.GET.get("cursor"),
+        prefix=request.GET.get("prefix"),
+        page_size=request.GET.get("page_size"),
+    )
+    return JsonResponse(user_lists)
+
+@api_view(["GET"])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def search_users(request):
+    """
+    Usernames matching `q`: prefix matches first, then similar ones unless
+    `fuzzy=0`. `limit` caps the number of results.
+    """
+    query = request.GET.get("q", "")
+    if not query:
+        return JsonResponse({"error": "q is required"}, status=400)
+    users = search.search_index.search(
+        query[:150],
+        search.get_limit(request.GET.get("limit")),
+        fuzzy=request.GET.get("fuzzy") not in ("0", "false"),
+        exclude=request.user.username,
+    )
+    return JsonResponse({"query": query, "users": users})
+
+@api_view(["GET"])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAuthenticated])
+def get_suggestions(request):
+    """
+    Friends of friends the user is not connected to, with their number of
+    mutual connections. `limit` caps the number of results.
+    """
+    suggestions = search.get_suggestions(request.user, search.get_limit(request.GET.get("limit")))
+    return JsonResponse({"users": suggestions})
+
+@api_view(["GET"])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    """
+    Hit/miss counters and size of this process's relationship cache
+    """
+    return JsonResponse(relationship_cache.stats())
+
+def metrics_view(request):
+    """
+    Prometheus text-format metrics for this process. When CHAT_METRICS_TOKEN
+    is set, scrapers must send it as a bearer token; otherwise only staff
+    sessions get them, or anyone with DEBUG on.
+    """
+    token = getattr(settings, "CHAT_METRICS_TOKEN", None)
+    if token:
+        if request.headers.get("Authorization") != f"Bearer {token}":
+            return HttpResponse(status=401)
+    elif not settings.DEBUG and not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,213 @@
+import asyncio
+import atexit
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+
+from . import metrics
+from .executors import database_write
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueueFull(Exception):
+    pass
+
+
+class WriteBehindQueue:
+    """
+    asyncio write-behind pipeline for rows that can be acknowledged before
+    they reach the database, such as chat messages.
+
+    `submit` only enqueues, so the caller can acknowledge right away. A single
+    worker task drains the queue and writes with one `bulk_create` per model
+    inside one transaction, flushing whenever `batch_size` items are waiting
+    or `flush_interval` seconds after the first item of a batch arrived. When
+    the queue is full `submit` waits up to `put_timeout` seconds for room and
+    then raises WriteBehindQueueFull, which pushes back on the sender.
+
+    Nothing acknowledged is dropped. A batch that fails for a reason that may
+    pass (the database is down, a lock timed out) is retried until it is
+    written, while the queue fills up and pushes back on senders. A batch the
+    database refuses outright is written item by item, and the items it still
+    refuses are handed to their `on_failure` callback. The batch being
+    written is kept as `_pending`, so a shutdown writes it along with
+    whatever is still queued.
+    """
+
+    def __init__(self, max_size=10000, batch_size=500, flush_interval=0.05, put_timeout=1.0, max_retry_delay=5.0):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retry_delay = max_retry_delay
+
+        self._queue = None
+        self._pending = []  # (instance, on_failure) items taken off the queue, not yet written
+        self._worker = None
+        self._closing = False
+        # Sequence numbers of submitted and of written (or given up) items
+        self._submitted = 0
+        self._flushed = 0
+        self._flushed_changed = None
+
+        self.written = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        if self._worker is None or self._worker.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue(maxsize=self.max_size)
+                self._flushed_changed = asyncio.Condition()
+            self._worker = asyncio.ensure_future(self._run())
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, instance, on_failure=None):
+        """
+        Queue an unsaved model instance for insertion. `on_failure(error)`
+        is awaited if the database refuses to store it.
+        """
+        if self._closing:
+            raise WriteBehindQueueFull("Server is shutting down")
+        self._ensure_started()
+        try:
+            await asyncio.wait_for(self._queue.put((instance, on_failure)), self.put_timeout)
+        except asyncio.TimeoutError:
+            raise WriteBehindQueueFull("Server is busy, please retry")
+        self._submitted += 1
+
+    async def sync(self):
+        """Wait until everything submitted so far has been flushed."""
+        if self._queue is None:
+            return
+        target = self._submitted
+        async with self._flushed_changed:
+            await self._flushed_changed.wait_for(lambda: self._flushed >= target)
+
+    async def aclose(self):
+        """Stop accepting items and wait until everything queued is written."""
+        self._closing = True
+        if self._queue is None:
+            return
+        if self._worker is not None and not self._worker.done():
+            await self._queue.join()
+            self._worker.cancel()
+        else:
+            # The worker died; write what is left from here
+            items, self._pending = self._pending + self._take_all(), []
+            await self._flush(items)
+
+    async def _run(self):
+        metrics.current_action.set("write_behind")
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self._pending = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+            async with self._flushed_changed:
+                self._flushed += len(batch)
+                self._flushed_changed.notify_all()
+
+    async def _flush(self, batch):
+        attempt = 0
+        while True:
+            try:
+                await database_write(self._write)(batch)
+                return
+            except (IntegrityError, DataError) as e:
+                # Refused for what is in it; retrying the same batch cannot help
+                logger.error(f"Write-behind flush of {len(batch)} items refused, writing them one by one: {e}")
+                await self._flush_each(batch)
+                return
+            except Exception as e:
+                attempt += 1
+                logger.error(f"Write-behind flush of {len(batch)} items failed (attempt {attempt}), retrying: {e}")
+                await asyncio.sleep(min(0.1 * 2 ** attempt, self.max_retry_delay))
+
+    async def _flush_each(self, batch):
+        remaining = list(batch)
+        if self._pending is batch:
+            self._pending = remaining
+        while remaining:
+            item = remaining[0]
+            try:
+                await self._flush_one(item)
+            except (IntegrityError, DataError) as e:
+                self.failed += 1
+                instance, on_failure = item
+                logger.error(f"Write-behind could not store a {type(instance).__name__}: {e}")
+                if on_failure is not None:
+                    try:
+                        await on_failure(e)
+                    except Exception as callback_error:
+                        logger.error(f"Error reporting an unsaved {type(instance).__name__}: {callback_error}")
+            remaining.pop(0)
+
+    async def _flush_one(self, item):
+        attempt = 0
+        while True:
+            try:
+                await database_write(self._write)([item])
+                return
+            except (IntegrityError, DataError):
+                raise
+            except Exception as e:
+                attempt += 1
+                logger.error(f"Write-behind write failed (attempt {attempt}), retrying: {e}")
+                await asyncio.sleep(min(0.1 * 2 ** attempt, self.max_retry_delay))
+
+    def _write(self, batch):
+        by_model = defaultdict(list)
+        for instance, _ in batch:
+            by_model[type(instance)].append(instance)
+        with transaction.atomic():
+            for model, instances in by_model.items():
+                model.objects.bulk_create(instances, batch_size=self.batch_size)
+        self.written += len(batch)
+        # Written; a shutdown from here on must not write the batch again
+        if self._pending is batch:
+            self._pending = []
+
+    def _take_all(self):
+        items = []
+        while self._queue is not None and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+            self._queue.task_done()
+        return items
+
+    def drain_sync(self):
+        """
+        Write the batch in flight and anything still queued; used at
+        interpreter exit, when no event loop is left to wait on.
+        """
+        items = self._pending + self._take_all()
+        self._pending = []
+        if items:
+            logger.info(f"Writing {len(items)} queued items before exit")
+            self._write(items)
+
+
+_options = getattr(settings, "CHAT_WRITE_BEHIND", {})
+write_queue = WriteBehindQueue(
+    max_size=_options.get("MAX_SIZE", 10000),
+    batch_size=_options.get("BATCH_SIZE", 500),
+    flush_interval=_options.get("FLUSH_INTERVAL", 0.05),
+    put_timeout=_options.get("PUT_TIMEOUT", 1.0),
+    max_retry_delay=_options.get("MAX_RETRY_DELAY", 5.0),
+)
+atexit.register(write_queue.drain_sync)
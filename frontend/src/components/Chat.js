@@ -1,13 +1,31 @@
 import React, { useState, useEffect, useCallback } from "react";
-import { connectWebSocket, sendMessage, disconnectWebSocket } from "../utils/websocket";
+import { connectWebSocket, sendMessage, disconnectWebSocket, setLastRevision } from "../utils/websocket";
+
+// Apply one users_delta op to the matching list. Ops are idempotent.
+const applyUsersDeltaOp = (setters, op) => {
+  if (op.op === "move") {
+    setters[op.from]?.(prev => prev.filter(user => user !== op.username));
+  }
+  const setter = setters[op.list];
+  if (!setter) {
+    return;
+  }
+  if (op.op === "remove") {
+    setter(prev => prev.filter(user => user !== op.username));
+  } else {
+    setter(prev => prev.includes(op.username) ? prev : [...prev, op.username]);
+  }
+};
 
 const ChatApp = () => {
   const [loggedInUser, setLoggedInUser] = useState(null);
   const [token, setToken] = useState(null);
   const [users, setUsers] = useState([]);
+  const [usersNextCursor, setUsersNextCursor] = useState(null);
   const [sentRequests, setSentRequests] = useState([]);
   const [pendingRequests, setPendingRequests] = useState([]);
   const [mutualConnections, setMutualConnections] = useState([]);
+  const [onlineUsers, setOnlineUsers] = useState([]);
   const [username, setUsername] = useState("");
   const [password, setPassword] = useState("");
   const [error, setError] = useState("");
@@ -44,20 +62,41 @@ const ChatApp = () => {
               setError("Invalid user data received");
             } else {
               setUsers(message.users || []);
+              setUsersNextCursor(message.users_next_cursor ?? null);
               setSentRequests(message.sent_requests || []);
               setPendingRequests(message.pending_requests || []);
               setMutualConnections(message.mutual_connections || []);
+              setLastRevision(message.revision ?? null, message.journal ?? null);
               setError(""); // Clear any previous errors
             }
+          } else if (message.type === "directory_page") {
+            setUsers(prev => [...prev, ...message.users.filter(user => !prev.includes(user))]);
+            setUsersNextCursor(message.next_cursor ?? null);
+          } else if (message.type === "users_delta") {
+            const setters = {
+              users: setUsers,
+              sent_requests: setSentRequests,
+              pending_requests: setPendingRequests,
+              mutual_connections: setMutualConnections,
+            };
+            message.ops.forEach(op => applyUsersDeltaOp(setters, op));
+            setLastRevision(message.revision, message.journal);
+          } else if (message.type === "presence") {
+            setOnlineUsers(message.online || []);
+          } else if (message.type === "presence_update") {
+            setOnlineUsers(prev => message.online
+              ? (prev.includes(message.username) ? prev : [...prev, message.username])
+              : prev.filter(user => user !== message.username));
           } else if (message.type === "notification") {
             // Handle incoming notification
             console.log("Received notification:", message);
             
-            // Add to notifications list
+            // Add to notifications list; a burst arrives as one frame
+            const messages = message.messages || [message.message];
             setNotifications(prev => [
-              { id: Date.now(), message: message.message },
-              ...prev.slice(0, 4) // Keep only the 5 most recent notifications
-            ]);
+              ...messages.slice().reverse().map((text, index) => ({ id: `${Date.now()}-${index}`, message: text })),
+              ...prev
+            ].slice(0, 5)); // Keep only the 5 most recent notifications
             
             // If the notification includes an action to refresh users, do it
             if (message.action === "refresh_users") {
@@ -105,6 +144,13 @@ const ChatApp = () => {
     });
   }, [users, sentRequests, pendingRequests, mutualConnections, loggedInUser]);
 
+  const loadMoreUsers = () => {
+    sendMessage({
+      action: "get_directory",
+      cursor: usersNextCursor
+    });
+  };
+
   const sendRequest = (receiver) => {
     sendMessage({ 
       action: "send_request", 
@@ -135,9 +181,11 @@ const ChatApp = () => {
     setToken(null);
     setLoggedInUser(null);
     setUsers([]);
+    setUsersNextCursor(null);
     setSentRequests([]);
     setPendingRequests([]);
     setMutualConnections([]);
+    setOnlineUsers([]);
     setError(""); // Clear error on logout
   };
 
@@ -199,6 +247,7 @@ const ChatApp = () => {
             <li>No available users found</li>
           }
         </ul>
+        {usersNextCursor && <button onClick={loadMoreUsers}>Load more users</button>}
         <h2>Requests Sent {sentRequests.length > 0 ? `(${sentRequests.length})` : '(None)'}</h2>
         <ul>{sentRequests.length > 0 ? sentRequests.map((user) => <li key={user}>{user}</li>) : <li>No requests sent</li>}</ul>
         <h2>Pending Requests {pendingRequests.length > 0 ? `(${pendingRequests.length})` : '(None)'}</h2>
@@ -218,7 +267,7 @@ const ChatApp = () => {
         <ul>
           {mutualConnections.length > 0 ? 
             mutualConnections.map((user) => (
-              <li key={user}>{user}</li>
+              <li key={user}>{user}{onlineUsers.includes(user) && " (online)"}</li>
             )) : 
             <li>No mutual connections</li>
           }
@@ -2,6 +2,19 @@ let socket = null;
 let messageHandler = null;
 let reconnectAttempts = 0;
 const maxReconnectAttempts = 5;
+// Last user-list revision applied by the client and the server journal it
+// came from, sent on (re)connect so the server can answer with a users_delta
+// instead of a full snapshot
+let lastRevision = null;
+let lastJournal = null;
+// Pings keep this user shown as online to their connections
+const heartbeatInterval = 30000;
+let heartbeatTimer = null;
+
+export const setLastRevision = (revision, journal) => {
+  lastRevision = revision;
+  lastJournal = journal;
+};
 
 export const connectWebSocket = (token, username, onMessageReceived) => {
   if (socket && socket.readyState === WebSocket.OPEN) {
@@ -19,11 +32,15 @@ export const connectWebSocket = (token, username, onMessageReceived) => {
     socket.onopen = () => {
       console.log("WebSocket connection established successfully");
       reconnectAttempts = 0;
+      clearInterval(heartbeatTimer);
+      heartbeatTimer = setInterval(() => sendMessage({ action: "ping" }), heartbeatInterval);
       
       // Send an initial message to verify connection
       sendMessage({
         action: "init_connection",
-        username: username
+        username: username,
+        revision: lastRevision,
+        journal: lastJournal
       });
     };
 
@@ -44,6 +61,7 @@ export const connectWebSocket = (token, username, onMessageReceived) => {
 
     socket.onclose = (event) => {
       console.log("WebSocket connection closed:", event);
+      clearInterval(heartbeatTimer);
       
       // Attempt to reconnect if not closed intentionally
       if (reconnectAttempts < maxReconnectAttempts) {
@@ -97,6 +115,7 @@ export const disconnectWebSocket = () => {
     } finally {
       socket = null;
       messageHandler = null;
+      lastRevision = null;
     }
   }
 };